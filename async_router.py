@@ -0,0 +1,585 @@
+import json
+import time
+import asyncio
+from contextlib import nullcontext
+from router import RELAY_BUFFER_SIZE, SPOOL_RETRY_INTERVAL, Router
+from protocol import (
+    KIND_CONTROL, KIND_TUNNEL, Header, ProtocolError, TraceHop,
+    discard_payload_async, encode_frame, read_header_async, tunnel_header)
+
+
+class AsyncConnectionPool:
+    """
+    A class to reuse connections towards other routers and clients from
+    coroutines, the asyncio counterpart of ConnectionPool.
+    """
+
+    def __init__(self, max_per_peer=8, idle_timeout=30.0,
+                 connect_timeout=5.0):
+        """
+        Constructs all the necessary attributes for the pool object.
+
+        Parameters
+        ----------
+            max_per_peer : int, optional
+                the maximum number of connections in use towards a single
+                peer (default is 8)
+            idle_timeout : float, optional
+                seconds an unused connection is kept open (default is 30)
+            connect_timeout : float, optional
+                seconds to wait for a new connection (default is 5)
+        """
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.idle = {}
+        self.slots = {}
+
+    async def acquire(self, host, port):
+        """
+        Takes a connection to a peer, waiting while the peer is at its cap.
+
+        Parameters
+        ----------
+            host : str
+                the host address of the peer
+            port : int
+                the port number of the peer
+
+        Returns
+        -------
+            reader : asyncio.StreamReader
+                the reading side of the connection
+            writer : asyncio.StreamWriter
+                the writing side of the connection
+        """
+        peer = (host, port)
+        slots = self.slots.setdefault(
+            peer, asyncio.Semaphore(self.max_per_peer))
+        await slots.acquire()
+
+        idle = self.idle.setdefault(peer, [])
+        now = time.monotonic()
+        while idle:
+            reader, writer, released = idle.pop()
+            # A peer that closed the connection already fed EOF to the reader
+            if (now - released <= self.idle_timeout and not reader.at_eof()
+                    and not writer.is_closing()):
+                return reader, writer
+            writer.close()
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(host, port), self.connect_timeout)
+        except asyncio.TimeoutError as error:
+            slots.release()
+            raise TimeoutError(
+                f"Connecting to {host}:{port} timed out") from error
+        except (OSError, asyncio.CancelledError):
+            slots.release()
+            raise
+
+    def release(self, host, port, reader, writer, reuse=True):
+        """
+        Gives a connection back to the pool.
+
+        Parameters
+        ----------
+            host : str
+                the host address of the peer
+            port : int
+                the port number of the peer
+            reader : asyncio.StreamReader
+                the reading side of the connection
+            writer : asyncio.StreamWriter
+                the writing side of the connection
+            reuse : bool, optional
+                False closes the connection, for instance after an error
+                (default is True)
+        """
+        peer = (host, port)
+        if reuse:
+            self.idle.setdefault(peer, []).append(
+                (reader, writer, time.monotonic()))
+        else:
+            writer.close()
+        self.slots[peer].release()
+
+
+class AsyncRouter(Router):
+    """
+    A router that serves every connection as a coroutine of a single event
+    loop instead of a thread per connection. It speaks the same protocol as
+    Router and shares its forwarding table logic.
+    """
+
+    def __init__(self, router_name=None, max_per_peer=8, shape_scale=None,
+                 report_interval=1.0, spool=None, scheduler=None,
+                 network_file="Json/network.json"):
+        """
+        Constructs all the necessary attributes for the router object.
+
+        Parameters
+        ----------
+            router_name : str, optional
+                the name of the router, asked for when not given
+            max_per_peer : int, optional
+                the maximum number of connections in use towards a single
+                router or client (default is 8)
+            shape_scale : float, optional
+                hold every link to its bandwidth in network.json times this
+                factor and report its utilization to the controller, links
+                are not shaped when not given
+            report_interval : float, optional
+                seconds between two utilization reports (default is 1)
+            spool : Spool, optional
+                holds the messages whose next hop is unreachable until the
+                routes change, they are dropped when not given
+            scheduler : Scheduler, optional
+                decides which messages go first, control ones before text
+                and text before audio, and holds messages back when its
+                classes are full; messages go as they come when not given
+            network_file : str, optional
+                the topology the router belongs to (default is
+                "Json/network.json")
+        """
+        super().__init__(router_name, shape_scale=shape_scale,
+                         report_interval=report_interval, spool=spool,
+                         scheduler=scheduler, network_file=network_file)
+        self.peers = AsyncConnectionPool(max_per_peer)
+        self.server = None
+        self.control_task = None
+        self.report_task = None
+        self.retry_task = None
+        self.routes_changed_async = None
+        self.control_writer = None
+
+    def start(self):
+        """
+        Starts the router.
+        """
+
+        asyncio.run(self.run())
+
+    def listen(self):
+        """
+        Accepts connections without registering with the controller.
+        """
+
+        asyncio.run(self.serve())
+
+    async def run(self):
+        """
+        Registers with the controller and serves connections.
+        """
+
+        await self.connect_to_controller_async("localhost", 8888)
+        await self.serve()
+
+    async def serve(self):
+        """
+        Accepts the connections of clients, routers and the controller.
+        """
+
+        port = self.network["Ports"][self.router_name]
+        self.server = await asyncio.start_server(
+            self.handle_connection_async, "localhost", port,
+            backlog=1024, reuse_address=True)
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    async def handle_connection_async(self, reader, writer):
+        """
+        Handles a connection until the other side closes it.
+
+        Parameters
+        ----------
+            reader : asyncio.StreamReader
+                the reading side of the connection
+            writer : asyncio.StreamWriter
+                the writing side of the connection
+        """
+
+        # Relayed chunks wait while a control frame is handled
+        control = nullcontext() if self.scheduler is None else \
+            self.scheduler.control()
+        self.active_connections.inc()
+        try:
+            while True:
+                header = await read_header_async(reader)
+                if header is None:
+                    break
+
+                if header.kind != KIND_CONTROL:
+                    await self.handle_client_async(header, reader)
+                    continue
+
+                payload = await reader.readexactly(header.payload_length)
+                with control:
+                    data = self.cipher.decrypt(
+                        payload, header.flow_id).decode()
+                    if not data or data == "Shutdown":
+                        self.running = False
+                        self.server.close()
+                        break
+
+                    elif data == "ACK":
+                        writer.write(self.ack_answer(header.flow_id))
+                        await writer.drain()
+
+                    elif data == "New Client":
+                        self.clients.append(header.src)
+                        if self.control_writer is not None:
+                            self.control_writer.write(
+                                self.registration_frame(header.src))
+                            await self.control_writer.drain()
+        except (ProtocolError, asyncio.IncompleteReadError) as error:
+            print(f"Dropping connection: {error}")
+        except ConnectionError:
+            pass
+        except OSError as error:
+            print(f"Dropping connection: {error}")
+        finally:
+            self.active_connections.dec()
+            writer.close()
+
+    async def handle_client_async(self, header, reader):
+        """
+        Forwards a message towards its destination, relaying the payload as
+        it arrives. Waiting for the next hop to drain keeps a slow receiver
+        from piling data up in memory.
+
+        Parameters
+        ----------
+            header : Header
+                the header of the message
+            reader : asyncio.StreamReader
+                the stream the payload is read from
+        """
+
+        if header.kind == KIND_TUNNEL and \
+                header.dst_router == self.router_name:
+            inner = await read_header_async(reader)
+            if inner is None:
+                raise ProtocolError(
+                    "Connection closed in the middle of a frame")
+            await self.handle_client_async(inner, reader)
+            return
+        started = time.perf_counter()
+        port = self.destination_port(header)
+        if port is None:
+            await discard_payload_async(reader, header.payload_length)
+            return
+        if self.scheduler is None:
+            await self.forward_message_async(header, reader, port, started)
+            return
+        ticket = await self.scheduler.admit_async(header)
+        if ticket is None:
+            self.dropped_messages.inc(1, ("admission",))
+            await discard_payload_async(reader, header.payload_length)
+            return
+        try:
+            await self.forward_message_async(header, reader, port, started,
+                                             ticket)
+        finally:
+            ticket.close()
+
+    async def forward_message_async(self, header, reader, port, started,
+                                    ticket=None):
+        """
+        Sends a message on to its next hop, or to the spool when the next
+        hop cannot be reached.
+
+        Parameters
+        ----------
+            header : Header
+                the header of the message
+            reader : asyncio.StreamReader
+                the stream the payload is read from
+            port : int
+                the port of the next router or the receiving client
+            started : float
+                the perf_counter time the header arrived
+            ticket : Ticket, optional
+                the turns of the message in the scheduler
+        """
+
+        received = time.time() if header.trace is not None else None
+        next_hop = self.port_names.get(port)
+        port, peer_reader, peer_writer, endpoint = \
+            await self.connect_next_hop_async(header, port)
+        if port is None:
+            await self.hold_message_async(header, reader, next_hop)
+            return
+        if received is not None:
+            header.trace.append(
+                TraceHop(self.router_name, received, time.time()))
+        bucket = self.link_bucket(port)
+        try:
+            if endpoint is not None:
+                peer_writer.write(tunnel_header(
+                    header, self.router_name, endpoint).encode())
+            peer_writer.write(header.encode())
+            remaining = header.payload_length
+            while remaining:
+                chunk = await reader.read(min(remaining, RELAY_BUFFER_SIZE))
+                if not chunk:
+                    raise ProtocolError(
+                        "Connection closed in the middle of a frame")
+                if bucket is not None:
+                    wait = bucket.reserve(len(chunk))
+                    if wait:
+                        await asyncio.sleep(wait)
+                if ticket is None:
+                    peer_writer.write(chunk)
+                    await peer_writer.drain()
+                else:
+                    await ticket.acquire_async(len(chunk))
+                    try:
+                        peer_writer.write(chunk)
+                        await peer_writer.drain()
+                    finally:
+                        ticket.release()
+                remaining -= len(chunk)
+            await peer_writer.drain()
+        except BaseException:
+            self.peers.release(
+                "localhost", port, peer_reader, peer_writer, reuse=False)
+            raise
+        self.peers.release("localhost", port, peer_reader, peer_writer)
+        self.count_forwarded(header, port, started)
+
+    async def connect_next_hop_async(self, header, port):
+        """
+        Takes a connection towards where a message goes next, failing over
+        to the backup of an unreachable next router as
+        Router.connect_next_hop does.
+
+        Parameters
+        ----------
+            header : Header
+                the header of the message
+            port : int
+                the port of the next router or the receiving client
+
+        Returns
+        -------
+            port : int
+                the port connected to, None when the message must be dropped
+            reader : asyncio.StreamReader
+                the reading side of the connection
+            writer : asyncio.StreamWriter
+                the writing side of the connection
+            endpoint : str
+                the router to tunnel the message to, None to send it as is
+        """
+
+        failed = self.port_names.get(port)
+        if failed not in self.unreachable:
+            try:
+                return (port, *await self.peers.acquire("localhost", port),
+                        None)
+            except OSError:
+                if failed is None:
+                    return None, None, None, None
+                self.unreachable.add(failed)
+        next_router, endpoint = self.failover_hop(header, failed)
+        if next_router is None:
+            return None, None, None, None
+        port = self.network["Ports"][next_router]
+        try:
+            return (port, *await self.peers.acquire("localhost", port),
+                    endpoint)
+        except OSError:
+            self.unreachable.add(next_router)
+            return None, None, None, None
+
+    async def hold_message_async(self, header, reader, next_hop):
+        """
+        Keeps a message whose next hop could not be reached in the spool
+        until the routes change, as Router.hold_message does. The spool
+        makes room first and the payload is read into it chunk by chunk,
+        or discarded when the spool refuses the message.
+
+        Parameters
+        ----------
+            header : Header
+                the header of the message
+            reader : asyncio.StreamReader
+                the stream the payload is read from
+            next_hop : str
+                the next router, None for a client
+        """
+
+        unreachable = next_hop or f"Client {header.dst}"
+        reserved = None
+        if self.spool is not None and next_hop is not None:
+            reserved = self.spool.reserve(next_hop, header)
+        if reserved is None:
+            print(f"{unreachable} unreachable, message to {header.dst} "
+                  f"dropped")
+            self.dropped_messages.inc(1, ("unreachable",))
+            await discard_payload_async(reader, header.payload_length)
+            return
+        message, view = reserved
+        try:
+            with view:
+                written = 0
+                while written < len(view):
+                    chunk = await reader.read(
+                        min(len(view) - written, RELAY_BUFFER_SIZE))
+                    if not chunk:
+                        raise ProtocolError(
+                            "Connection closed in the middle of a frame")
+                    view[written:written + len(chunk)] = chunk
+                    written += len(chunk)
+        except BaseException:
+            self.spool.cancel(message)
+            raise
+        self.spool.commit(message)
+        print(f"{unreachable} unreachable, message to {header.dst} spooled")
+
+    async def retry_spooled_async(self):
+        """
+        Sends the spooled messages again once the routes change, and at
+        least every retry interval.
+        """
+
+        while self.running:
+            try:
+                await asyncio.wait_for(
+                    self.routes_changed_async.wait(), SPOOL_RETRY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.routes_changed_async.clear()
+            for next_hop in self.spool.next_hops():
+                await self.send_spooled_async(next_hop)
+
+    async def send_spooled_async(self, next_hop):
+        """
+        Sends the messages spooled for a next hop over the current routes,
+        oldest first, until one cannot be sent.
+
+        Parameters
+        ----------
+            next_hop : str
+                the next hop the messages could not reach
+        """
+
+        while True:
+            message = self.spool.pop(next_hop)
+            if message is None:
+                return
+            started = time.perf_counter()
+            header = message.header
+            next_router = self.next_router(header.dst_router, header.flow_id)
+            port = None
+            if next_router is not None:
+                port, peer_reader, peer_writer, endpoint = \
+                    await self.connect_next_hop_async(
+                        header, self.network["Ports"][next_router])
+            if port is None:
+                self.spool.restore(message)
+                return
+            try:
+                if endpoint is not None:
+                    peer_writer.write(tunnel_header(
+                        header, self.router_name, endpoint).encode())
+                bucket = self.link_bucket(port)
+                if bucket is not None:
+                    wait = bucket.reserve(message.size)
+                    if wait:
+                        await asyncio.sleep(wait)
+                peer_writer.write(self.spool.frame(message))
+                await peer_writer.drain()
+            except OSError as error:
+                print(f"Could not send a spooled message: {error}")
+                self.peers.release(
+                    "localhost", port, peer_reader, peer_writer, reuse=False)
+                self.spool.restore(message)
+                return
+            self.peers.release("localhost", port, peer_reader, peer_writer)
+            self.spool.release(message)
+            self.count_forwarded(header, port, started)
+
+    async def connect_to_controller_async(self, server_host, server_port):
+        """
+        Connects to the controller and keeps the connection open as the
+        control channel the routes are pushed through.
+
+        Parameters
+        ----------
+            server_host : str
+                the host address of the server
+            server_port : int
+                the port number of the server
+        """
+
+        reader, writer = await asyncio.open_connection(server_host, server_port)
+        writer.write(encode_frame(
+            Header(KIND_CONTROL, src=self.router_name, flow_id=self.session),
+            self.cipher.encrypt(self.router_name.encode(), self.session)))
+        await writer.drain()
+        self.control_writer = writer
+        print(f"{self.router_name} Waiting for the paths")
+        self.control_task = asyncio.create_task(
+            self.listen_to_controller_async(reader, writer))
+        if self.shaper is not None:
+            self.report_task = asyncio.create_task(
+                self.report_utilization_async(writer))
+        if self.spool is not None:
+            self.routes_changed_async = asyncio.Event()
+            self.retry_task = asyncio.create_task(self.retry_spooled_async())
+
+    async def report_utilization_async(self, writer):
+        """
+        Reports the utilization of the links to the controller every report
+        interval, over the control channel.
+
+        Parameters
+        ----------
+            writer : asyncio.StreamWriter
+                the writing side of the control channel
+        """
+
+        while self.running:
+            await asyncio.sleep(self.report_interval)
+            try:
+                writer.write(self.utilization_frame())
+                await writer.drain()
+            except ConnectionError:
+                break
+
+    async def listen_to_controller_async(self, reader, writer):
+        """
+        Applies the route updates pushed by the controller and acknowledges
+        each routes version.
+
+        Parameters
+        ----------
+            reader : asyncio.StreamReader
+                the reading side of the control channel
+            writer : asyncio.StreamWriter
+                the writing side of the control channel
+        """
+
+        while True:
+            header = await read_header_async(reader)
+            if header is None:
+                break
+            payload = await reader.readexactly(header.payload_length)
+            update = json.loads(
+                self.cipher.decrypt(payload, self.session).decode())
+            self.apply_routes(update)
+            if self.routes_changed_async is not None:
+                self.routes_changed_async.set()
+            ack = json.dumps({"ack": update["version"]})
+            writer.write(encode_frame(
+                Header(KIND_CONTROL, src=self.router_name,
+                       flow_id=self.session),
+                self.cipher.encrypt(ack.encode(), self.session)))
+            await writer.drain()
+        print(f"{self.router_name} lost the connection with the controller")
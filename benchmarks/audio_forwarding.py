@@ -0,0 +1,63 @@
+"""
+Measures the time an audio message takes to cross a path of three routers
+when each router stores the whole payload before forwarding it and when it
+relays the payload while it arrives, against a single direct transfer.
+
+Run from the repository root:
+
+    python -m benchmarks.audio_forwarding
+"""
+import io
+import os
+import time
+from contextlib import redirect_stdout
+from connection_pool import ConnectionPool
+from protocol import KIND_AUDIO, Header, encode_frame
+from benchmarks.pooled_forwarding import PATH, SINK_PORT, Sink, start_routers
+
+AUDIO_SIZE = 64 * 1024 * 1024
+ROUNDS = 3
+
+
+def transfer(port, frame, sink):
+    """
+    Sends one audio frame and waits until the sink received all of it.
+
+    Returns
+    -------
+        elapsed : float
+            seconds until the sink got the whole frame
+    """
+
+    pool = ConnectionPool()
+    sink.expect(1)
+    start = time.perf_counter()
+    with pool.connection("localhost", port) as connection:
+        connection.sendall(frame)
+    if not sink.done.wait(120):
+        raise RuntimeError("The audio did not arrive")
+    elapsed = time.perf_counter() - start
+    pool.close()
+    return elapsed
+
+
+if __name__ == "__main__":
+    sink = Sink(SINK_PORT)
+    header = Header(KIND_AUDIO, "bench", PATH[0], str(SINK_PORT), PATH[-1])
+    frame = encode_frame(header, os.urandom(AUDIO_SIZE))
+
+    with redirect_stdout(io.StringIO()):
+        routers = start_routers()
+        first_port = routers[0].network["Ports"][PATH[0]]
+        direct = min(transfer(SINK_PORT, frame, sink) for _ in range(ROUNDS))
+        results = {}
+        for cut_through in (False, True):
+            for router in routers:
+                router.cut_through = cut_through
+            results[cut_through] = min(
+                transfer(first_port, frame, sink) for _ in range(ROUNDS))
+
+    print(f"{AUDIO_SIZE // (1024 * 1024)} MB audio, best of {ROUNDS}")
+    print(f"{'direct transfer':<30} {direct * 1000:8.1f} ms")
+    print(f"{'3 routers, store and forward':<30} {results[False] * 1000:8.1f} ms")
+    print(f"{'3 routers, cut-through':<30} {results[True] * 1000:8.1f} ms")
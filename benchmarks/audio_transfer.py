@@ -0,0 +1,130 @@
+"""
+Compares how the client sends and receives audio files: reading the whole
+file into memory and receiving the whole frame before writing it, against
+streaming it in encrypted chunks into a preallocated file through a reused
+buffer. Every transfer runs in its own process so its peak memory
+is measured alone.
+
+Run from the repository root:
+
+    python -m benchmarks.audio_transfer
+"""
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import tempfile
+import threading
+import subprocess
+from client import TCPClient
+from crypto import SEALED_CHUNK_SIZE
+from protocol import (
+    KIND_AUDIO, Header, new_flow_id, read_frame, read_header, send_frame)
+
+SIZES_MB = [10, 100, 1024]
+CHUNK = 1 << 20
+
+
+def make_audio(path, size):
+    """
+    Writes a file of the given size without holding it in memory.
+    """
+
+    chunk = os.urandom(CHUNK)
+    with open(path, "wb") as file:
+        for _ in range(size // CHUNK):
+            file.write(chunk)
+
+
+def transfer(mode, size):
+    """
+    Sends a file of the given size between two clients of this process,
+    called in its own process.
+
+    Parameters
+    ----------
+        mode : str
+            "buffered" or "streamed"
+        size : int
+            the size of the file in bytes
+
+    Returns
+    -------
+        result : dict
+            throughput and peak memory of the process
+    """
+
+    client = TCPClient("UT", "bench", 1)
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    os.mkdir("Audios received")
+    make_audio("audio.wav", size)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    listener = socket.create_server(("localhost", 0))
+    port = listener.getsockname()[1]
+    received = []
+
+    def receive():
+        connection, _ = listener.accept()
+        reader = connection.makefile("rb")
+        if mode == "buffered":
+            header, payload = read_frame(reader)
+            with open("Audios received/audio_copia.wav", "wb") as file:
+                file.write(payload)
+            received.append("Audios received/audio_copia.wav")
+        else:
+            header = read_header(reader)
+            received.append(client.receive_audio(
+                reader, header, bytearray(SEALED_CHUNK_SIZE)))
+        connection.close()
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    header = Header(KIND_AUDIO, "bench", "UT", str(port), "UT",
+                    flow_id=new_flow_id())
+    start = time.perf_counter()
+    if mode == "buffered":
+        with open("audio.wav", "rb") as file:
+            audio_data = file.read()
+        with socket.create_connection(("localhost", port)) as connection:
+            send_frame(connection, header, audio_data)
+        del audio_data
+    else:
+        client.send_audio("localhost", port, header, "audio.wav")
+    receiver.join()
+    elapsed = time.perf_counter() - start
+
+    assert os.path.getsize(received[0]) == size
+    os.remove(received[0])
+    os.remove("audio.wav")
+    os.rmdir("Audios received")
+    os.rmdir(directory)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "mode": mode,
+        "size_mb": size // CHUNK,
+        "throughput_mb_s": size / CHUNK / elapsed,
+        "peak_rss_mb": peak // 1024,
+        "growth_mb": (peak - baseline) // 1024,
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--transfer":
+        print(json.dumps(transfer(sys.argv[2], int(sys.argv[3]))))
+        sys.exit()
+
+    print(f"{'mode':>10} {'MB':>6} {'MB/s':>8} {'peak MB':>8} {'growth MB':>10}")
+    for size_mb in SIZES_MB:
+        for mode in ("buffered", "streamed"):
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.audio_transfer",
+                 "--transfer", mode, str(size_mb * CHUNK)],
+                capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.splitlines()[-1])
+            print(f"{result['mode']:>10} {result['size_mb']:>6} "
+                  f"{result['throughput_mb_s']:>8.0f} "
+                  f"{result['peak_rss_mb']:>8} {result['growth_mb']:>10}")
@@ -0,0 +1,113 @@
+"""
+Compares finding the router of a client in the former clients_directory.json,
+read and scanned for every message, with the in-memory client directory of
+the controller and the client side cache, with 100k registered clients.
+Registrations come from several threads at once, as they do from the
+routers' control channels, and none of them may be lost.
+
+Run from the repository root:
+
+    python -m benchmarks.client_directory
+"""
+import os
+import json
+import time
+import random
+import tempfile
+import threading
+from client_directory import ClientDirectory, DirectoryCache
+
+CLIENTS = 100000
+LOOKUPS = 20000
+LEGACY_LOOKUPS = 50
+FIRST_PORT = 10000
+
+
+def legacy_lookup(filename, port):
+    """
+    Finds the router of a client the way the client used to.
+    """
+
+    with open(filename, 'r', encoding='utf-8-sig') as file:
+        json_data = json.load(file)
+    for router, clients in json_data.items():
+        if port in clients:
+            return router
+    return "None"
+
+
+def register_all(directory, registrations, threads):
+    """
+    Registers every client from several threads.
+
+    Returns
+    -------
+        rate : float
+            registrations per second
+    """
+
+    def register(share):
+        for port, router in share:
+            directory.register(port, router)
+
+    workers = [
+        threading.Thread(target=register, args=(registrations[i::threads],))
+        for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return len(registrations) / (time.perf_counter() - start)
+
+
+def lookups_per_second(lookup, ports):
+    """
+    Runs a lookup for every port.
+
+    Returns
+    -------
+        rate : float
+            lookups per second
+    """
+
+    start = time.perf_counter()
+    for port in ports:
+        assert lookup(port) is not None
+    return len(ports) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    with open("Json/network.json", encoding="utf-8-sig") as file:
+        routers = list(json.load(file)["Nodes"])
+    rng = random.Random(0)
+    registrations = [
+        (str(port), rng.choice(routers))
+        for port in range(FIRST_PORT, FIRST_PORT + CLIENTS)]
+
+    legacy = {}
+    for port, router in registrations:
+        legacy.setdefault(router, []).append(port)
+    filename = os.path.join(tempfile.mkdtemp(), "clients_directory.json")
+    with open(filename, 'w', encoding='utf-8-sig') as file:
+        json.dump(legacy, file, indent=4)
+
+    directory = ClientDirectory()
+    register_rate = register_all(directory, registrations, threads=8)
+    assert len(directory) == CLIENTS
+
+    ports = [rng.choice(registrations)[0] for _ in range(LOOKUPS)]
+    cache = DirectoryCache(max_entries=CLIENTS)
+    for port in ports:
+        cache.put(port, directory.lookup(port))
+
+    print(f"{CLIENTS} clients, {register_rate:.0f} registrations/s "
+          f"from 8 threads, {len(directory)} kept")
+    print(f"{'lookup':>22} {'per second':>12}")
+    print(f"{'clients_directory.json':>22} "
+          f"{lookups_per_second(lambda port: legacy_lookup(filename, port), ports[:LEGACY_LOOKUPS]):>12.1f}")
+    print(f"{'directory':>22} "
+          f"{lookups_per_second(lambda port: directory.lookup(port, '9001'), ports):>12.0f}")
+    print(f"{'client cache':>22} {lookups_per_second(cache.get, ports):>12.0f}")
+    os.remove(filename)
+    os.rmdir(os.path.dirname(filename))
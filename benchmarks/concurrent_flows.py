@@ -0,0 +1,187 @@
+"""
+Compares how many concurrent flows the thread-per-connection router and the
+asyncio router sustain. Every flow keeps its own connection to the router
+and sends a message every FLOW_INTERVAL seconds; the router delivers them to
+a local client.
+
+Run from the repository root:
+
+    python -m benchmarks.concurrent_flows
+"""
+import io
+import sys
+import json
+import time
+import socket
+import asyncio
+import resource
+import threading
+import subprocess
+from contextlib import redirect_stdout
+from protocol import KIND_TEXT, Header, encode_frame
+from benchmarks.pooled_forwarding import SINK_PORT, Sink
+
+ROUTER = "UT"
+FLOWS = [100, 1000, 3000]
+FLOW_INTERVAL = 0.5
+DURATION = 5.0
+
+
+def raise_file_limit():
+    """
+    Allows as many open sockets as the hard limit permits.
+    """
+
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(engine):
+    """
+    Runs the router under test, called in its own process.
+
+    Parameters
+    ----------
+        engine : str
+            "threads" or "asyncio"
+    """
+
+    raise_file_limit()
+    with redirect_stdout(io.StringIO()):
+        if engine == "asyncio":
+            from async_router import AsyncRouter
+            router = AsyncRouter(ROUTER)
+        else:
+            from router import Router
+            router = Router(ROUTER)
+        router.listen()
+
+
+def process_status(pid):
+    """
+    Reads the peak resident memory and thread count of a process.
+
+    Returns
+    -------
+        rss : int
+            peak resident memory in MB
+        threads : int
+            number of threads
+    """
+
+    status = {}
+    with open(f"/proc/{pid}/status", encoding="utf-8") as file:
+        for line in file:
+            name, _, value = line.partition(":")
+            status[name] = value.split()
+    return int(status["VmHWM"][0]) // 1024, int(status["Threads"][0])
+
+
+async def flow(port, frame, deadline, opening, stats):
+    """
+    A single flow: one connection sending a message every FLOW_INTERVAL.
+    """
+
+    try:
+        async with opening:
+            _, writer = await asyncio.open_connection("localhost", port)
+    except OSError:
+        stats["failed"] += 1
+        return
+    try:
+        while time.monotonic() < deadline:
+            writer.write(frame)
+            await writer.drain()
+            stats["sent"] += 1
+            await asyncio.sleep(FLOW_INTERVAL)
+    except OSError:
+        stats["failed"] += 1
+    finally:
+        writer.close()
+
+
+async def load(port, flows):
+    """
+    Runs the given number of concurrent flows against the router.
+
+    Returns
+    -------
+        stats : dict
+            messages sent and flows that failed
+    """
+
+    header = Header(KIND_TEXT, "bench", ROUTER, str(SINK_PORT), ROUTER)
+    frame = encode_frame(header, b"x" * 100)
+    stats = {"sent": 0, "failed": 0}
+    opening = asyncio.Semaphore(100)
+    deadline = time.monotonic() + DURATION
+    await asyncio.gather(*[
+        flow(port, frame, deadline, opening, stats) for _ in range(flows)])
+    return stats
+
+
+def run(engine, flows, sink):
+    """
+    Measures one engine with the given number of concurrent flows.
+
+    Returns
+    -------
+        result : dict
+            delivered rate, failed flows and the router's peak memory
+    """
+
+    with open("Json/network.json", encoding="utf-8-sig") as file:
+        port = json.load(file)["Ports"][ROUTER]
+    router = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.concurrent_flows", "--serve", engine])
+    peak_threads = []
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("localhost", port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        # Count the threads while every flow is open
+        sampler = threading.Timer(
+            DURATION * 0.8,
+            lambda: peak_threads.append(process_status(router.pid)[1]))
+        sampler.start()
+        sink.expect(-1)
+        start = time.perf_counter()
+        stats = asyncio.run(load(port, flows))
+        time.sleep(1)
+        elapsed = time.perf_counter() - start
+        sampler.join()
+        rss, _ = process_status(router.pid)
+    finally:
+        router.kill()
+        router.wait()
+    return {
+        "engine": engine,
+        "flows": flows,
+        "sent": stats["sent"],
+        "delivered_rate": sink.received / elapsed,
+        "failed": stats["failed"],
+        "rss_mb": rss,
+        "threads": peak_threads[0],
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--serve":
+        serve(sys.argv[2])
+        sys.exit()
+
+    raise_file_limit()
+    sink = Sink(SINK_PORT)
+    print(f"{'engine':>8} {'flows':>6} {'sent':>7} {'delivered/s':>12} "
+          f"{'failed':>7} {'peak MB':>8} {'threads':>8}")
+    for flows in FLOWS:
+        for engine in ("threads", "asyncio"):
+            result = run(engine, flows, sink)
+            print(f"{result['engine']:>8} {result['flows']:>6} "
+                  f"{result['sent']:>7} {result['delivered_rate']:>12.0f} "
+                  f"{result['failed']:>7} {result['rss_mb']:>8} "
+                  f"{result['threads']:>8}")
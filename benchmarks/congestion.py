@@ -0,0 +1,71 @@
+"""
+Measures congestion-aware routing in the simulation of the NSFNET: the
+throughput, loss and route changes under regional traffic with static
+link costs, with costs following every utilization report, and with the
+damped costs of the congestion tracker.
+
+Run from the repository root:
+
+    python -m benchmarks.congestion
+"""
+import io
+from contextlib import redirect_stdout
+from shaping import CongestionTracker
+from simulation import Simulation
+
+RATE = 40000
+SIZE = 100000
+START = 0.1
+DURATION = 20.0
+PATTERNS = [
+    # name, routers sending, routers receiving (None for any)
+    ("west->east", ["WA", "CA1", "CA2", "UT", "CO"],
+     ["NY", "NJ", "DC", "PA", "MI", "IL", "GA"]),
+    ("any->northeast", None, ["NY", "NJ", "DC"]),
+    ("northeast->any", ["NY", "NJ", "DC"], None),
+]
+TRACKERS = [
+    ("static", lambda: None),
+    # A single mark, no smoothing and no hold down
+    ("undamped", lambda: CongestionTracker(0.8, 0.8, 1.0, 4.0, 0.0)),
+    ("damped", CongestionTracker),
+]
+
+
+def run(congestion, routers, destinations):
+    """
+    Simulates the traffic of a pattern.
+
+    Returns
+    -------
+        gbps : float
+            the bits delivered per second of traffic
+        loss : float
+            the fraction of the messages dropped
+        changes : int
+            the times a link became congested or clear
+    """
+    with redirect_stdout(io.StringIO()):
+        simulation = Simulation(
+            "Json/network.json", "dijkstra", congestion=congestion)
+        simulation.start()
+        simulation.add_traffic(RATE, SIZE, start=START, stop=DURATION,
+                               routers=routers, destinations=destinations)
+        simulation.run(until=DURATION + 1.0)
+    stats = simulation.stats
+    lost = sum(stats.dropped.values())
+    changes = sum(simulation.controller.link_changes.collect().values())
+    return (stats.delivered_bytes * 8 / (DURATION - START) / 1e9,
+            lost / (stats.delivered + lost), changes)
+
+
+if __name__ == "__main__":
+    print(f"{RATE} messages/s of {SIZE // 1000} KB for {DURATION:g} s, "
+          f"{RATE * SIZE * 8 / 1e9:.0f} Gbps offered")
+    print(f"{'pattern':>15} {'costs':>9} {'Gbps':>6} {'loss':>6} "
+          f"{'link changes':>13}")
+    for name, routers, destinations in PATTERNS:
+        for costs, tracker in TRACKERS:
+            gbps, loss, changes = run(tracker(), routers, destinations)
+            print(f"{name:>15} {costs:>9} {gbps:>6.1f} {loss:>6.1%} "
+                  f"{changes:>13}")
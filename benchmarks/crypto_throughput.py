@@ -0,0 +1,110 @@
+"""
+Compares the previous Fernet encryption with the session ciphers: control
+messages per second, with the session key cached and derived for every
+message, and MB/s for a large payload encrypted whole with Fernet against
+the chunked stream.
+
+Run from the repository root:
+
+    python -m benchmarks.crypto_throughput
+"""
+import json
+import time
+from cryptography.fernet import Fernet
+from crypto import STREAM_CHUNK_SIZE, SessionCipher
+from protocol import new_flow_id
+
+KEY = b'HcEnve-04K7wN5sgrz1JgKufDMIYBbbTXr0Wueg3v7I='
+MESSAGES = 20000
+PAYLOAD_MB = 64
+ACK = b"ACK"
+UPDATE = json.dumps({
+    "version": 12, "full": False,
+    "routes": {name: "CO" for name in ("WA", "CA1", "CA2", "UT", "NE", "IL")},
+    "removed": ["TX"]}).encode()
+
+
+def messages_per_second(encrypt, decrypt, message):
+    """
+    Encrypts and decrypts a message MESSAGES times.
+
+    Returns
+    -------
+        rate : float
+            round trips per second
+    """
+
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        decrypt(encrypt(message))
+    return MESSAGES / (time.perf_counter() - start)
+
+
+def fernet_payload(payload):
+    """
+    Encrypts and decrypts a whole payload with Fernet.
+
+    Returns
+    -------
+        rate : float
+            MB per second
+    """
+
+    fernet = Fernet(KEY)
+    start = time.perf_counter()
+    assert len(fernet.decrypt(fernet.encrypt(payload))) == len(payload)
+    return PAYLOAD_MB / (time.perf_counter() - start)
+
+
+def stream_payload(payload):
+    """
+    Encrypts and decrypts a payload as a stream of authenticated chunks.
+
+    Returns
+    -------
+        rate : float
+            MB per second
+    """
+
+    cipher = SessionCipher()
+    flow_id = new_flow_id()
+    view = memoryview(payload)
+    sender = cipher.stream(flow_id)
+    receiver = cipher.stream(flow_id, sender.salt)
+    received = 0
+    start = time.perf_counter()
+    for position in range(0, len(payload), STREAM_CHUNK_SIZE):
+        last = position + STREAM_CHUNK_SIZE >= len(payload)
+        chunk = sender.seal(view[position:position + STREAM_CHUNK_SIZE], last)
+        received += len(receiver.open(chunk, last))
+    assert received == len(payload)
+    return PAYLOAD_MB / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    fernet = Fernet(KEY)
+    cipher = SessionCipher()
+    session = new_flow_id()
+
+    def fresh_session(message):
+        new_session = new_flow_id()
+        return new_session, cipher.encrypt(message, new_session)
+
+    print(f"{'message':>8} {'fernet/s':>10} {'session/s':>10} "
+          f"{'new key/s':>10}")
+    for name, message in (("ack", ACK), ("update", UPDATE)):
+        fernet_rate = messages_per_second(
+            fernet.encrypt, fernet.decrypt, message)
+        session_rate = messages_per_second(
+            lambda data: cipher.encrypt(data, session),
+            lambda data: cipher.decrypt(data, session), message)
+        fresh_rate = messages_per_second(
+            fresh_session, lambda sealed: cipher.decrypt(sealed[1], sealed[0]),
+            message)
+        print(f"{name:>8} {fernet_rate:>10.0f} {session_rate:>10.0f} "
+              f"{fresh_rate:>10.0f}")
+
+    payload = bytes(PAYLOAD_MB << 20)
+    print(f"\n{PAYLOAD_MB} MB payload")
+    print(f"  fernet whole payload {fernet_payload(payload):>8.0f} MB/s")
+    print(f"  chacha20 stream      {stream_payload(payload):>8.0f} MB/s")
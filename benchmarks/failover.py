@@ -0,0 +1,90 @@
+"""
+Measures the loss window when a transit router of the NSFNET dies in the
+simulation: the messages between the other routers lost, and the time from
+the failure to the last of them, when routers wait for the controller to
+route around the dead router and when they fail over to the loop-free
+alternates it computed beforehand. Also counts the destinations each
+router can protect with an alternate.
+
+Run from the repository root:
+
+    python -m benchmarks.failover
+"""
+import io
+from contextlib import redirect_stdout
+from simulation import Simulation
+
+RATE = 20000
+SIZE = 1000
+FAILURE = 1.0
+DURATION = 3.0
+FAILING = ["CO", "IL", "PA", "TX", "NE", "GA"]
+
+
+def run(failing, backup_routes):
+    """
+    Simulates traffic between every router but the failing one, which dies
+    at FAILURE.
+
+    Returns
+    -------
+        lost : int
+            the messages dropped
+        window : float
+            seconds from the failure to the last message dropped
+        failovers : int
+            the messages sent to an alternate
+        convergence : float
+            seconds for the routes around the failure to reach every router
+    """
+    with redirect_stdout(io.StringIO()):
+        simulation = Simulation(
+            "Json/network.json", "dijkstra", backup_routes=backup_routes)
+        simulation.start()
+        simulation.fail_router(failing, FAILURE)
+        routers = [name for name in simulation.routers if name != failing]
+        simulation.add_traffic(RATE, SIZE, start=0.1, stop=DURATION,
+                               routers=routers)
+        simulation.run(until=DURATION + 1.0)
+    stats = simulation.stats
+    times = [at for at in stats.drop_times if at >= FAILURE]
+    window = max(times) - FAILURE if times else 0.0
+    convergence = simulation.controller.convergence_times
+    return (len(stats.drop_times), window, stats.failovers,
+            convergence[-1] if convergence else 0.0)
+
+
+def protected_destinations():
+    """
+    Counts the destinations every router has an alternate for, out of
+    those that are not its neighbors.
+    """
+    with redirect_stdout(io.StringIO()):
+        simulation = Simulation(
+            "Json/network.json", "dijkstra", backup_routes=True)
+        simulation.start()
+        simulation.run(until=0.1)
+    controller = simulation.controller
+    protected = total = 0
+    for name in simulation.routers:
+        total += sum(
+            len(path) > 2
+            for path in controller.shortest_paths[name].values())
+        protected += len(controller.backup_table(name))
+    return protected, total
+
+
+if __name__ == "__main__":
+    protected, total = protected_destinations()
+    print(f"Destinations with an alternate: {protected} of {total} "
+          f"({protected / total:.0%})")
+    print(f"{RATE} messages/s between the other routers, one dies at "
+          f"{FAILURE:g} s")
+    print(f"{'failing':>8} {'backups':>8} {'lost':>6} {'window ms':>10} "
+          f"{'failovers':>10} {'converged ms':>13}")
+    for failing in FAILING:
+        for backup_routes in (False, True):
+            lost, window, failovers, convergence = run(failing, backup_routes)
+            print(f"{failing:>8} {'yes' if backup_routes else 'no':>8} "
+                  f"{lost:>6} {window * 1000:>10.1f} {failovers:>10} "
+                  f"{convergence * 1000:>13.1f}")
@@ -0,0 +1,168 @@
+"""
+Measures the status checks on hundreds of routers: how long a round of
+probes takes, how long it takes to detect routers that die or hang, and
+whether routers that answer late once are wrongly declared down.
+
+The routers are minimal ACK responders served from one asyncio loop.
+
+Run from the repository root:
+
+    python -m benchmarks.health_check
+"""
+import time
+import random
+import asyncio
+import threading
+from crypto import SessionCipher
+from connection_pool import ConnectionPool
+from health import HealthChecker, MissedHeartbeatsDetector, PhiAccrualDetector
+from protocol import (
+    KIND_CONTROL, Header, ProtocolError, encode_frame, read_frame,
+    read_header_async, send_frame)
+
+ROUTERS = 300
+FIRST_PORT = 20000
+DEAD = 5
+HUNG = 5
+SLOW = 20
+INTERVAL = 0.25
+PROBE_TIMEOUT = 0.2
+DURATION = 6.0
+FAILURE_AT = 3.0
+
+
+class FakeRouters:
+    """
+    ACK responders whose behaviour can be changed while they run.
+    """
+
+    def __init__(self, ports):
+        self.answer = encode_frame(
+            Header(KIND_CONTROL), SessionCipher().encrypt(b"I am ok"))
+        self.ports = ports
+        self.servers = {}
+        self.writers = {}
+        self.hung = set()
+        self.slow_once = set()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+
+    async def start(self):
+        for port in self.ports:
+            self.servers[port] = await asyncio.start_server(
+                lambda reader, writer, port=port: self.serve(port, reader, writer),
+                "localhost", port, backlog=128, reuse_address=True)
+
+    async def serve(self, port, reader, writer):
+        self.writers.setdefault(port, set()).add(writer)
+        try:
+            while await read_header_async(reader) is not None:
+                if port in self.hung:
+                    await asyncio.sleep(3600)
+                if port in self.slow_once:
+                    self.slow_once.discard(port)
+                    await asyncio.sleep(PROBE_TIMEOUT * 1.5)
+                writer.write(self.answer)
+                await writer.drain()
+        except (ConnectionError, ProtocolError):
+            pass
+        finally:
+            writer.close()
+
+    def kill(self, port):
+        async def close():
+            server = self.servers.pop(port)
+            server.close()
+            for writer in self.writers.pop(port, ()):
+                writer.close()
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+
+
+def make_probe():
+    """
+    Builds a probe doing what Controller.probe_router does.
+    """
+
+    pool = ConnectionPool()
+    cipher = SessionCipher()
+
+    def probe(port):
+        try:
+            with pool.connection("localhost", port, PROBE_TIMEOUT) as connection:
+                connection.settimeout(PROBE_TIMEOUT)
+                send_frame(connection, Header(KIND_CONTROL),
+                           cipher.encrypt(b"ACK"))
+                header, _ = read_frame(connection.makefile("rb", buffering=0))
+                if header is None:
+                    raise ConnectionResetError
+                connection.settimeout(None)
+            return True
+        except (OSError, ProtocolError):
+            return False
+
+    return probe
+
+
+def run(name, detector):
+    """
+    Runs the scenario with a failure detector.
+
+    Returns
+    -------
+        result : dict
+            round time, detection latencies and wrong detections
+    """
+
+    ports = list(range(FIRST_PORT, FIRST_PORT + ROUTERS))
+    routers = FakeRouters(ports)
+    rng = random.Random(0)
+    failing = rng.sample(ports, DEAD + HUNG)
+    dead, hung = failing[:DEAD], failing[DEAD:]
+    slow = rng.sample([port for port in ports if port not in failing], SLOW)
+
+    checker = HealthChecker(make_probe(), detector, INTERVAL, max_workers=128)
+    alive = list(ports)
+    detected = {}
+    round_times = []
+    failed_at = None
+    start = time.monotonic()
+    while time.monotonic() - start < DURATION:
+        round_start = time.monotonic()
+        if failed_at is None and round_start - start > FAILURE_AT:
+            for port in dead:
+                routers.kill(port)
+            routers.hung.update(hung)
+            routers.slow_once.update(slow)
+            failed_at = time.monotonic()
+        for port in checker.check(alive):
+            detected[port] = time.monotonic()
+            alive.remove(port)
+        round_times.append(time.monotonic() - round_start)
+        time.sleep(max(0.0, INTERVAL - (time.monotonic() - round_start)))
+
+    latencies = [detected[port] - failed_at for port in failing if port in detected]
+    for port in list(routers.servers):
+        routers.kill(port)
+    return {
+        "detector": name,
+        "round_ms": 1000 * sum(round_times) / len(round_times),
+        "detected": len(latencies),
+        "max_detection_ms": 1000 * max(latencies) if latencies else float("nan"),
+        "false": len([port for port in detected if port not in failing]),
+    }
+
+
+if __name__ == "__main__":
+    print(f"{ROUTERS} routers, {DEAD} killed, {HUNG} hung, {SLOW} late once")
+    print(f"{'detector':>10} {'round ms':>9} {'detected':>9} "
+          f"{'max detect ms':>14} {'false':>6}")
+    for name, detector in [
+            ("phi", PhiAccrualDetector(
+                expected_interval=INTERVAL, min_std_deviation=INTERVAL / 5)),
+            ("missed", MissedHeartbeatsDetector(3))]:
+        result = run(name, detector)
+        print(f"{result['detector']:>10} {result['round_ms']:>9.1f} "
+              f"{result['detected']:>4}/{DEAD + HUNG:<4} "
+              f"{result['max_detection_ms']:>14.0f} {result['false']:>6}")
+        time.sleep(1)
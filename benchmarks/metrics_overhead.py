@@ -0,0 +1,113 @@
+"""
+Measures what the metrics cost on the forwarding path: nanoseconds per
+counter increment and histogram observation, against a counter behind a
+lock, with 1 to 8 threads updating at once, and the time to render the
+metrics once thousands of connection threads came and went.
+
+Run from the repository root:
+
+    python -m benchmarks.metrics_overhead
+"""
+import time
+import random
+import threading
+from metrics import MetricsRegistry
+
+UPDATES = 200000
+THREADS = [1, 2, 4, 8]
+RETIRED_THREADS = 5000
+LABELS = [("CO",), ("TX",), ("DC",), ("client",)]
+
+
+class LockedCounter:
+    """
+    A counter of every label behind a single lock.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+def per_update(update, threads):
+    """
+    Runs UPDATES updates in every thread at once.
+
+    Returns
+    -------
+        nanoseconds : float
+            the wall time per update
+    """
+    labels = [random.Random(seed).choice(LABELS) for seed in range(64)]
+    barrier = threading.Barrier(threads + 1)
+
+    def work():
+        barrier.wait()
+        for index in range(UPDATES):
+            update(1, labels[index & 63])
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return 1e9 * (time.perf_counter() - start) / (UPDATES * threads)
+
+
+def render_after_threads():
+    """
+    Updates the metrics of a router from many short-lived threads, as its
+    connections do, and renders them.
+
+    Returns
+    -------
+        seconds : float
+            the time of the first render, folding the ended threads
+        text : int
+            the bytes rendered
+    """
+    registry = MetricsRegistry()
+    messages = registry.counter("messages_total", "", ("next_hop",))
+    seconds = registry.histogram("forwarding_seconds", "", ("next_hop",))
+
+    def connection():
+        for labels in LABELS:
+            messages.inc(1, labels)
+            seconds.observe(0.001, labels)
+
+    for _ in range(RETIRED_THREADS):
+        thread = threading.Thread(target=connection)
+        thread.start()
+        thread.join()
+    start = time.perf_counter()
+    text = registry.render()
+    return time.perf_counter() - start, len(text)
+
+
+if __name__ == "__main__":
+    registry = MetricsRegistry()
+    counter = registry.counter("counter_total", "", ("next_hop",))
+    histogram = registry.histogram("histogram_seconds", "", ("next_hop",))
+    locked = LockedCounter()
+    cases = [
+        ("locked counter", locked.inc),
+        ("counter", counter.inc),
+        ("histogram", histogram.observe),
+    ]
+
+    print(f"{'metric':>15} " + " ".join(
+        f"{f'{threads} thr ns':>11}" for threads in THREADS))
+    for name, update in cases:
+        results = [per_update(update, threads) for threads in THREADS]
+        print(f"{name:>15} " + " ".join(
+            f"{result:>11.0f}" for result in results))
+
+    seconds, size = render_after_threads()
+    print(f"Render after {RETIRED_THREADS} ended threads: "
+          f"{seconds * 1000:.1f} ms, {size} bytes")
@@ -0,0 +1,73 @@
+"""
+Measures the aggregate throughput of the NSFNET in the simulation with a
+single shortest path per destination and with flows spread over several
+loop-free paths, under traffic patterns that load some regions more than
+others. Links have the default bandwidth of 10 Gbps and messages are
+100 KB.
+
+Run from the repository root:
+
+    python -m benchmarks.multipath
+"""
+import io
+from contextlib import redirect_stdout
+from simulation import Simulation
+
+RATE = 60000
+SIZE = 100000
+# Traffic starts once the first routes reached every router
+START = 0.1
+DURATION = 2.0
+PATTERNS = [
+    # name, routers sending, routers receiving (None for any)
+    ("uniform", None, None),
+    ("west->east", ["WA", "CA1", "CA2", "UT", "CO"],
+     ["NY", "NJ", "DC", "PA", "MI", "IL", "GA"]),
+    ("any->northeast", None, ["NY", "NJ", "DC"]),
+    ("northeast->any", ["NY", "NJ", "DC"], None),
+]
+CONFIGURATIONS = [
+    # max paths, stretch
+    (1, 1.0),
+    (2, 1.5),
+    (4, 2.0),
+    (4, 8.0),
+]
+
+
+def run(max_paths, stretch, routers, destinations):
+    """
+    Simulates the traffic of a pattern.
+
+    Returns
+    -------
+        gbps : float
+            the bits delivered per second of traffic
+        loss : float
+            the fraction of the messages dropped
+    """
+    with redirect_stdout(io.StringIO()):
+        simulation = Simulation(
+            "Json/network.json", "dijkstra", max_paths=max_paths,
+            stretch=stretch)
+        simulation.start()
+        simulation.add_traffic(RATE, SIZE, start=START, stop=DURATION,
+                               routers=routers, destinations=destinations)
+        simulation.run(until=DURATION + 1.0)
+    stats = simulation.stats
+    lost = sum(stats.dropped.values())
+    return (stats.delivered_bytes * 8 / (DURATION - START) / 1e9,
+            lost / (stats.delivered + lost))
+
+
+if __name__ == "__main__":
+    print(f"{RATE} messages/s of {SIZE // 1000} KB, "
+          f"{RATE * SIZE * 8 / 1e9:.0f} Gbps offered")
+    print(f"{'pattern':>15} " + " ".join(
+        f"{f'{paths} paths x{stretch:g}':>16}"
+        for paths, stretch in CONFIGURATIONS))
+    for name, routers, destinations in PATTERNS:
+        results = [run(paths, stretch, routers, destinations)
+                   for paths, stretch in CONFIGURATIONS]
+        print(f"{name:>15} " + " ".join(
+            f"{f'{gbps:.1f} Gbps {loss:.0%}':>16}" for gbps, loss in results))
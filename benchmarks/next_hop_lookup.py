@@ -0,0 +1,178 @@
+"""
+Compares the legacy next hop lookup, which scans every path of the network,
+with the forwarding table the controller pushes to the router, applied and
+looked up by Router itself.
+
+Run from the repository root:
+
+    python -m benchmarks.next_hop_lookup
+"""
+import io
+import random
+import time
+from contextlib import redirect_stdout
+import networkx as nx
+from router import Router
+
+# Any router of network.json, the tables do not have to match the topology
+ROUTER = "UT"
+SIZES = [14, 500, 5000]
+LOOKUPS = 2000
+
+
+def build_topology(size, seed=0):
+    """
+    Builds a connected random topology with routers named R1..RN.
+
+    Parameters
+    ----------
+        size : int
+            the number of routers
+        seed : int, optional
+            the seed of the random generator
+
+    Returns
+    -------
+        graph : NetworkX graph
+            the weighted topology
+    """
+
+    graph = nx.connected_watts_strogatz_graph(size, 4, 0.1, seed=seed)
+    rng = random.Random(seed)
+    graph = nx.relabel_nodes(graph, {node: f"R{node + 1}" for node in graph})
+    for from_node, to_node in graph.edges:
+        graph[from_node][to_node]["weight"] = 1 / rng.randint(300, 5000)
+    return graph
+
+
+def build_legacy_routes(graph, source):
+    """
+    Builds the N^2 route list a router used to keep in memory.
+
+    Only the rows of the measured router hold real paths; every other entry
+    points to the same filler dictionary so large topologies fit in memory
+    while the scan still visits N^2 entries.
+
+    Parameters
+    ----------
+        graph : NetworkX graph
+            the topology
+        source : str
+            the router whose paths are real
+
+    Returns
+    -------
+        routes : list
+            the route list in paths.json order
+        own_routes : list
+            the real routes of the source router
+    """
+
+    paths = nx.single_source_dijkstra_path(graph, source)
+    filler = {"source": None, "destination": None, "path": []}
+    own_routes = [
+        {"source": source, "destination": destination, "path": path}
+        for destination, path in paths.items()
+    ]
+    own_routes.sort(key=lambda route: route["destination"])
+
+    routes = []
+    for node in sorted(graph.nodes):
+        if node == source:
+            routes.extend(own_routes)
+        else:
+            routes.extend([filler] * len(paths))
+    return routes, own_routes
+
+
+def compile_next_hops(routes):
+    """
+    Builds the forwarding table the controller pushes to a router.
+    """
+
+    return {
+        route["destination"]: route["path"][1]
+        for route in routes if len(route["path"]) > 1
+    }
+
+
+def legacy_next_router(routes, source, destination):
+    """
+    The forwarding lookup as it was done before the compiled table.
+    """
+
+    for dictionary in routes:
+        if dictionary["source"] == source and dictionary["destination"] == destination:
+            path = dictionary["path"]
+            return path[path.index(source) + 1]
+    return None
+
+
+def run(size):
+    """
+    Measures both lookups on a topology of the given size.
+
+    Parameters
+    ----------
+        size : int
+            the number of routers
+
+    Returns
+    -------
+        result : dict
+            the timings in microseconds per lookup
+    """
+
+    graph = build_topology(size)
+    # A router in the middle of paths.json, as an average router sees it
+    source = sorted(graph.nodes)[size // 2]
+    routes, own_routes = build_legacy_routes(graph, source)
+    destinations = [node for node in graph.nodes if node != source]
+    rng = random.Random(1)
+    queries = [rng.choice(destinations) for _ in range(LOOKUPS)]
+
+    # The legacy scan is O(N^2), keep the number of probes reasonable
+    legacy_queries = queries[:max(1, LOOKUPS * 1000 // len(routes))]
+    start = time.perf_counter()
+    for destination in legacy_queries:
+        legacy_next_router(routes, source, destination)
+    legacy = (time.perf_counter() - start) / len(legacy_queries)
+
+    start = time.perf_counter()
+    next_hops = compile_next_hops(own_routes)
+    compile_time = time.perf_counter() - start
+
+    # The router prints every next router it picks
+    with redirect_stdout(io.StringIO()):
+        router = Router(ROUTER)
+        start = time.perf_counter()
+        router.apply_routes({"version": 1, "full": True, "routes": next_hops})
+        apply_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for destination in queries:
+            router.next_router(destination)
+        compiled = (time.perf_counter() - start) / len(queries)
+
+        for destination in legacy_queries:
+            assert router.next_router(destination) == legacy_next_router(
+                routes, source, destination)
+
+    return {
+        "nodes": size,
+        "routes": len(routes),
+        "legacy_us": legacy * 1e6,
+        "compiled_us": compiled * 1e6,
+        "compile_ms": compile_time * 1e3,
+        "apply_ms": apply_time * 1e3,
+    }
+
+
+if __name__ == "__main__":
+    print(f"{'nodes':>6} {'routes':>10} {'legacy us':>12} "
+          f"{'compiled us':>12} {'compile ms':>11} {'apply ms':>9}")
+    for size in SIZES:
+        result = run(size)
+        print(f"{result['nodes']:>6} {result['routes']:>10} "
+              f"{result['legacy_us']:>12.1f} {result['compiled_us']:>12.3f} "
+              f"{result['compile_ms']:>11.1f} {result['apply_ms']:>9.1f}")
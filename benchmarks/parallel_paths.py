@@ -0,0 +1,52 @@
+"""
+Measures how computing every shortest path tree and merging its next hops
+into the route store scales with the worker processes of the parallel path
+engine, on random networks of 1000 and 2000 routers, against the single
+process numpy engine. The pool is started before timing, as the controller
+keeps it between computations.
+
+The speedup is bounded by the CPUs of the machine, printed first.
+
+Run from the repository root:
+
+    python -m benchmarks.parallel_paths
+"""
+import os
+import time
+from benchmarks.path_engines import random_graph
+from path_engines import get_path_engine
+from route_store import NextHopMatrix
+
+SIZES = [1000, 2000]
+WORKERS = [1, 2, 4, 8]
+
+
+def seconds(engine, graph):
+    """
+    Returns the next hop matrix of every router and the time the trees and
+    the matrix took, as the controller stores them.
+    """
+
+    start = time.perf_counter()
+    matrix = NextHopMatrix(list(graph.nodes))
+    for source, (_, paths) in engine.trees(graph).items():
+        matrix.set_next_hops(source, paths.names, paths.next_hops)
+    return matrix, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{'routers':>8} {'engine':>9} {'workers':>8} "
+          f"{'trees+store s':>14} {'speedup':>8}")
+    for size in SIZES:
+        graph = random_graph(size)
+        reference, serial = seconds(get_path_engine("numpy"), graph)
+        print(f"{size:>8} {'numpy':>9} {1:>8} {serial:>14.2f} {1:>8.2f}")
+        for workers in WORKERS:
+            engine = get_path_engine("parallel", workers=workers)
+            engine.trees(graph, list(graph.nodes)[:workers])
+            matrix, elapsed = seconds(engine, graph)
+            engine.close()
+            assert (matrix.entries == reference.entries).all()
+            print(f"{size:>8} {'parallel':>9} {workers:>8} {elapsed:>14.2f} "
+                  f"{serial / elapsed:>8.2f}")
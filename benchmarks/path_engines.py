@@ -0,0 +1,54 @@
+"""
+Times the path engines computing every shortest path tree of random
+networks of 100, 300 and 1000 routers, and cross-checks their path costs
+against Dijkstra. Bellman-Ford is left out of the largest network.
+
+Run from the repository root:
+
+    python -m benchmarks.path_engines
+"""
+import time
+import random
+import networkx as nx
+from path_engines import PATH_ENGINES, cross_check, get_path_engine
+
+SIZES = [100, 300, 1000]
+LINKS_PER_NODE = 3
+BELLMAN_FORD_MAX_SIZE = 300
+
+
+def random_graph(size):
+    """
+    Builds a connected random graph weighted like the controller's, by the
+    inverse of the link distance.
+    """
+
+    rng = random.Random(size)
+    graph = nx.Graph()
+    graph.add_nodes_from(f"R{node}" for node in range(size))
+    for node in range(1, size):
+        graph.add_edge(f"R{node}", f"R{rng.randrange(node)}",
+                       weight=1 / rng.randint(100, 5000))
+    for _ in range(size * (LINKS_PER_NODE - 1)):
+        first, second = rng.sample(range(size), 2)
+        graph.add_edge(f"R{first}", f"R{second}",
+                       weight=1 / rng.randint(100, 5000))
+    return graph
+
+
+if __name__ == "__main__":
+    print(f"{'routers':>8} {'engine':>13} {'all trees s':>12} "
+          f"{'mismatches':>11}")
+    for size in SIZES:
+        graph = random_graph(size)
+        for name in sorted(PATH_ENGINES):
+            if name == "bellman_ford" and size > BELLMAN_FORD_MAX_SIZE:
+                continue
+            engine = get_path_engine(name)
+            start = time.perf_counter()
+            engine.trees(graph)
+            elapsed = time.perf_counter() - start
+            mismatches = "" if name == "dijkstra" else \
+                len(cross_check(graph, [get_path_engine("dijkstra"), engine]))
+            engine.close()
+            print(f"{size:>8} {name:>13} {elapsed:>12.2f} {mismatches:>11}")
@@ -0,0 +1,136 @@
+"""
+Measures messages per second through a path of three routers, with a
+connection per message and with pooled connections.
+
+Run from the repository root:
+
+    python -m benchmarks.pooled_forwarding
+"""
+import io
+import socket
+import threading
+import time
+from contextlib import redirect_stdout
+from connection_pool import ConnectionPool
+from protocol import KIND_TEXT, Header, encode_frame, read_header
+from router import Router
+
+MESSAGES = 2000
+SINK_PORT = 9901
+# WA -> CA1 -> UT, then the client listening on SINK_PORT
+PATH = ["WA", "CA1", "UT"]
+
+
+class Sink:
+    """
+    A client that only counts the messages it receives.
+    """
+
+    def __init__(self, port):
+        self.received = 0
+        self.done = threading.Event()
+        self.expected = 0
+        self.lock = threading.Lock()
+        self.server_socket = socket.create_server(("localhost", port))
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            connection, _ = self.server_socket.accept()
+            threading.Thread(
+                target=self.count, args=(connection,), daemon=True).start()
+
+    def count(self, connection):
+        reader = connection.makefile("rb")
+        view = memoryview(bytearray(65536))
+        while True:
+            header = read_header(reader)
+            if header is None:
+                break
+            remaining = header.payload_length
+            while remaining:
+                remaining -= reader.readinto(view[:min(remaining, len(view))])
+            with self.lock:
+                self.received += 1
+                if self.received == self.expected:
+                    self.done.set()
+        connection.close()
+
+    def expect(self, expected):
+        with self.lock:
+            self.received = 0
+            self.expected = expected
+            self.done.clear()
+
+
+def start_routers():
+    """
+    Starts the routers of the path with static forwarding tables.
+
+    Returns
+    -------
+        routers : list
+            the running routers
+    """
+
+    routers = []
+    for position, name in enumerate(PATH):
+        router = Router(name)
+        if position + 1 < len(PATH):
+            router.next_hops = {PATH[-1]: PATH[position + 1]}
+        threading.Thread(target=router.listen, daemon=True).start()
+        routers.append(router)
+    time.sleep(0.2)
+    return routers
+
+
+def run(routers, sink, pooled):
+    """
+    Sends MESSAGES text messages through the path.
+
+    Parameters
+    ----------
+        routers : list
+            the routers of the path
+        sink : Sink
+            the receiving client
+        pooled : bool
+            whether connections are reused
+
+    Returns
+    -------
+        rate : float
+            messages per second
+    """
+
+    idle_timeout = 30.0 if pooled else 0
+    for router in routers:
+        router.pool.close()
+        router.pool = ConnectionPool(idle_timeout=idle_timeout)
+    pool = ConnectionPool(idle_timeout=idle_timeout)
+    first = routers[0]
+    port = first.network["Ports"][first.router_name]
+    header = Header(KIND_TEXT, "bench", PATH[0], str(SINK_PORT), PATH[-1])
+    frame = encode_frame(header, first.cipher.encrypt(b"hello", header.flow_id))
+
+    sink.expect(MESSAGES)
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        with pool.connection("localhost", port) as connection:
+            connection.sendall(frame)
+    if not sink.done.wait(60):
+        raise RuntimeError(f"Only {sink.received} messages arrived")
+    elapsed = time.perf_counter() - start
+    pool.close()
+    return MESSAGES / elapsed
+
+
+if __name__ == "__main__":
+    sink = Sink(SINK_PORT)
+    with redirect_stdout(io.StringIO()):
+        routers = start_routers()
+        unpooled = run(routers, sink, pooled=False)
+        pooled = run(routers, sink, pooled=True)
+    print(f"3-hop path, {MESSAGES} messages")
+    print(f"connection per message: {unpooled:10.0f} msg/s")
+    print(f"pooled connections:     {pooled:10.0f} msg/s")
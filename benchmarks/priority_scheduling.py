@@ -0,0 +1,175 @@
+"""
+Measures how long a router takes to answer the status checks of the
+controller while bulk audio flows saturate it, with both engines, without
+and with the scheduler that sends control messages first: the round trip
+percentiles of a check every 20 ms, and the audio MB per second that still
+got through.
+
+Run from the repository root:
+
+    python -m benchmarks.priority_scheduling
+"""
+import io
+import sys
+import json
+import time
+import socket
+import threading
+import subprocess
+from contextlib import redirect_stdout
+from crypto import SessionCipher
+from protocol import (
+    KIND_AUDIO, KIND_CONTROL, Header, encode_frame, read_frame, send_frame)
+
+ROUTER = "UT"
+SINK_PORT = 9901
+AUDIO_SIZE = 2**20
+FLOWS = [0, 8, 64, 256]
+SETTLE = 2.0
+DURATION = 5.0
+CHECK_INTERVAL = 0.02
+
+
+def serve(engine, scheduled):
+    """
+    Runs the router under test without a controller, called in its own
+    process.
+    """
+
+    from scheduler import Scheduler
+    scheduler = Scheduler() if scheduled else None
+    with redirect_stdout(io.StringIO()):
+        if engine == "asyncio":
+            from async_router import AsyncRouter
+            router = AsyncRouter(ROUTER, scheduler=scheduler)
+        else:
+            from router import Router
+            router = Router(ROUTER, scheduler=scheduler)
+        router.listen()
+
+
+def load(port, flows, duration):
+    """
+    Sends audios to a sink behind the router over flows connections and
+    prints the bytes the sink received.
+    """
+    sink = socket.create_server(("localhost", SINK_PORT), backlog=1024)
+    received = [0]
+
+    def drain(connection):
+        buffer = bytearray(65536)
+        while True:
+            count = connection.recv_into(buffer)
+            if not count:
+                return
+            received[0] += count
+
+    def accept():
+        while True:
+            connection, _ = sink.accept()
+            threading.Thread(
+                target=drain, args=(connection,), daemon=True).start()
+
+    def send(flow_id):
+        frame = encode_frame(Header(
+            KIND_AUDIO, "bench", ROUTER, str(SINK_PORT), ROUTER,
+            AUDIO_SIZE, flow_id=flow_id), bytes(AUDIO_SIZE))
+        connection = socket.create_connection(("localhost", port))
+        while True:
+            connection.sendall(frame)
+
+    threading.Thread(target=accept, daemon=True).start()
+    for flow_id in range(1, flows + 1):
+        threading.Thread(target=send, args=(flow_id,), daemon=True).start()
+    time.sleep(SETTLE)
+    start = received[0]
+    time.sleep(duration)
+    print(received[0] - start, flush=True)
+
+
+def check(port):
+    """
+    Sends status checks to the router for DURATION seconds.
+
+    Returns
+    -------
+        rtts : list
+            the sorted round trips in milliseconds
+    """
+    cipher = SessionCipher()
+    connection = socket.create_connection(("localhost", port))
+    reader = connection.makefile("rb", buffering=0)
+    rtts = []
+    end = time.monotonic() + DURATION
+    while time.monotonic() < end:
+        start = time.perf_counter()
+        send_frame(connection, Header(KIND_CONTROL, flow_id=7),
+                   cipher.encrypt(b"ACK", 7))
+        read_frame(reader)
+        rtts.append((time.perf_counter() - start) * 1000)
+        time.sleep(CHECK_INTERVAL)
+    connection.close()
+    return sorted(rtts)
+
+
+def run(port, engine, scheduled, flows):
+    """
+    Checks the router while flows audio flows go through it.
+
+    Returns
+    -------
+        rtts : list
+            the sorted round trips in milliseconds
+        rate : float
+            the audio MB per second the sink received
+    """
+    command = [sys.executable, "-m", "benchmarks.priority_scheduling"]
+    router = subprocess.Popen(
+        command + ["--serve", engine, str(int(scheduled))])
+    loader = None
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("localhost", port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        if flows:
+            loader = subprocess.Popen(
+                command + ["--load", str(port), str(flows), str(DURATION)],
+                stdout=subprocess.PIPE, text=True)
+        time.sleep(SETTLE)
+        rtts = check(port)
+        rate = 0.0
+        if loader is not None:
+            rate = int(loader.communicate()[0]) / DURATION / 2**20
+    finally:
+        router.kill()
+        router.wait()
+        if loader is not None:
+            loader.kill()
+            loader.wait()
+    return rtts, rate
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--serve"]:
+        serve(sys.argv[2], sys.argv[3] == "1")
+        sys.exit()
+    if sys.argv[1:2] == ["--load"]:
+        load(int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4]))
+        sys.exit()
+    with open("Json/network.json", encoding="utf-8-sig") as file:
+        port = json.load(file)["Ports"][ROUTER]
+    print(f"Status checks every {CHECK_INTERVAL * 1000:g} ms while 1 MB "
+          f"audios go through {ROUTER}")
+    print(f"{'engine':>8} {'scheduler':>10} {'flows':>6} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8} {'audio MB/s':>11}")
+    for engine in ("threads", "asyncio"):
+        for scheduled in (False, True):
+            for flows in FLOWS:
+                rtts, rate = run(port, engine, scheduled, flows)
+                print(f"{engine:>8} {'yes' if scheduled else 'no':>10} "
+                      f"{flows:>6} {rtts[len(rtts) // 2]:>8.2f} "
+                      f"{rtts[int(len(rtts) * 0.99)]:>8.2f} "
+                      f"{rtts[-1]:>8.2f} {rate:>11.0f}")
@@ -0,0 +1,142 @@
+"""
+Compares paths.json, every full path of every pair of routers as indented
+JSON, with the binary next-hop route store: file size, write time, the
+time for a router to read its own table and for a client to rebuild one
+path. The networks are square grids routed along x first and then along
+y, so their routes are known without computing them.
+
+paths.json is only measured on the smaller grids; on 10k routers it would
+hold 100 million paths.
+
+Run from the repository root:
+
+    python -m benchmarks.route_store
+"""
+import os
+import json
+import time
+import tempfile
+import numpy as np
+from route_store import NextHopMatrix, RouteStore
+
+SIDES = [16, 32, 100]
+JSON_MAX_SIDE = 32
+
+
+def grid_matrix(side):
+    """
+    Builds the next hops of a side x side grid.
+
+    Returns
+    -------
+        matrix : NextHopMatrix
+            the next hop of every router towards every other
+    """
+
+    count = side * side
+    matrix = NextHopMatrix([f"R{position}" for position in range(count)])
+    targets = np.arange(count)
+    target_x, target_y = targets % side, targets // side
+    for source in range(count):
+        x, y = source % side, source // side
+        next_x = x + np.sign(target_x - x)
+        next_y = np.where(target_x == x, y + np.sign(target_y - y), y)
+        matrix.entries[source] = next_y * side + next_x
+    return matrix
+
+
+def write_paths_json(store, filename):
+    """
+    Writes every full path the way the controller used to.
+    """
+
+    the_json = []
+    for source in store.names:
+        for destination in store.names:
+            the_json.append({
+                "source": source,
+                "destination": destination,
+                "path": store.path(source, destination),
+            })
+    with open(filename, 'w', encoding='utf-8-sig') as file:
+        json.dump(the_json, file, indent=4)
+
+
+def find_path_json(filename, source, destination):
+    """
+    Finds a path the way the client used to.
+    """
+
+    with open(filename, 'r', encoding='utf-8-sig') as file:
+        json_paths = json.load(file)
+    for paths in json_paths:
+        if paths["source"] == source and paths["destination"] == destination:
+            return paths["path"]
+    return []
+
+
+def timed(function, *args):
+    """
+    Runs a function once.
+
+    Returns
+    -------
+        result : object
+            what the function returned
+        elapsed : float
+            milliseconds it took
+    """
+
+    start = time.perf_counter()
+    result = function(*args)
+    return result, 1000 * (time.perf_counter() - start)
+
+
+def open_table(filename, router):
+    """
+    Reads the table of a router the way a router can.
+    """
+
+    with RouteStore(filename) as store:
+        return store.next_hops(router)
+
+
+def open_path(filename, source, destination):
+    """
+    Rebuilds a path the way the client does.
+    """
+
+    with RouteStore(filename) as store:
+        return store.path(source, destination)
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    store_name = os.path.join(directory, "routes.bin")
+    json_name = os.path.join(directory, "paths.json")
+    print(f"{'routers':>8} {'format':>7} {'MB':>9} {'write ms':>10} "
+          f"{'own table ms':>13} {'one path ms':>12}")
+    for side in SIDES:
+        count = side * side
+        first, last = "R0", f"R{count - 1}"
+        matrix = grid_matrix(side)
+        _, write_ms = timed(matrix.save, store_name)
+        table, table_ms = timed(open_table, store_name, first)
+        path, path_ms = timed(open_path, store_name, first, last)
+        assert len(table) == count - 1 and len(path) == 2 * side - 1
+        print(f"{count:>8} {'binary':>7} "
+              f"{os.path.getsize(store_name) / 2**20:>9.2f} {write_ms:>10.1f} "
+              f"{table_ms:>13.2f} {path_ms:>12.3f}")
+
+        if side <= JSON_MAX_SIDE:
+            with RouteStore(store_name) as store:
+                _, write_ms = timed(write_paths_json, store, json_name)
+            path, path_ms = timed(find_path_json, json_name, first, last)
+            assert len(path) == 2 * side - 1
+            # A router reading its table from it has to parse all of it too
+            print(f"{count:>8} {'json':>7} "
+                  f"{os.path.getsize(json_name) / 2**20:>9.2f} "
+                  f"{write_ms:>10.1f} {path_ms:>13.2f} {path_ms:>12.3f}")
+            os.remove(json_name)
+    os.remove(store_name)
+    os.rmdir(directory)
@@ -0,0 +1,175 @@
+"""
+Times every stage of the routing pipeline on generated topologies, one
+stage at a time, and writes the results as JSON to compare releases:
+
+- generate: building the topology and writing its network.json
+- build: the controller adding the routers and links to its Network
+- compute: the path engine computing every shortest path tree, kept by
+  the controller along with the next hop matrix
+- serialize: writing the route store
+- load: a router reading its own table from the route store
+- lookup: a router finding the next hop of a destination in its table
+- snapshot: the controller encoding the topology snapshot for clients
+
+Run from the repository root, for example:
+
+    python -m benchmarks.scale_suite --sizes 200 1000 --output scale.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+from datetime import datetime, timezone
+import numpy as np
+from controller import Controller
+from path_engines import PATH_ENGINES
+from route_store import RouteStore
+from router import Router
+from topology_generator import TOPOLOGIES, generate_network, write_network
+
+SIZES = [200, 500, 1000]
+LOADED_ROUTERS = 10
+LOOKUPS = 100000
+
+
+def elapsed(function, *args):
+    """
+    Runs a function once.
+
+    Returns
+    -------
+        result : object
+            what the function returned
+        seconds : float
+            how long it took
+    """
+
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def run(kind, size, engine, directory):
+    """
+    Measures every stage on one generated topology.
+
+    Returns
+    -------
+        result : dict
+            the topology and the measures of every stage
+    """
+
+    network_file = os.path.join(directory, "network.json")
+    routes_file = os.path.join(directory, "routes.bin")
+
+    def generate():
+        network = generate_network(kind, size)
+        write_network(network, network_file)
+        return network
+
+    network, generate_s = elapsed(generate)
+    controller = Controller(0, algorithm=engine, network_file=network_file,
+                            routes_file=routes_file)
+
+    def build():
+        for name, node_id in network["Nodes"].items():
+            controller.nsfnet.add_node(node_id, name)
+        for link in network["Links"]:
+            controller.nsfnet.add_link(
+                link["from"], link["to"], 1 / link["distance"])
+
+    def compute():
+        graph = controller.nsfnet.graph
+        for source, tree in controller.path_engine.trees(graph).items():
+            controller.store_tree(graph, source, tree)
+
+    _, build_s = elapsed(build)
+    _, compute_s = elapsed(compute)
+    _, serialize_s = elapsed(controller.write_routes, controller.nsfnet)
+
+    names = list(network["Nodes"])
+    loaded = names[::max(1, len(names) // LOADED_ROUTERS)][:LOADED_ROUTERS]
+
+    def load(name):
+        with RouteStore(routes_file) as store:
+            return store.next_hops(name)
+
+    load_s = [elapsed(load, name)[1] for name in loaded]
+
+    router = Router(loaded[0], network_file=network_file)
+    router.apply_routes({"full": True, "version": 1,
+                         "routes": controller.next_hop_table(loaded[0])})
+    rng = random.Random(size)
+    destinations = [rng.choice(names) for _ in range(LOOKUPS)]
+    lookup = router.next_hops.get
+    _, lookup_s = elapsed(lambda: [lookup(name) for name in destinations])
+
+    snapshot, snapshot_s = elapsed(controller.topology_answer, None)
+
+    result = {
+        "topology": kind,
+        "routers": size,
+        "links": len(network["Links"]),
+        "network_json_bytes": os.path.getsize(network_file),
+        "generate_s": generate_s,
+        "build_s": build_s,
+        "compute_s": compute_s,
+        "serialize_s": serialize_s,
+        "route_store_bytes": os.path.getsize(routes_file),
+        "load_ms": 1000 * float(np.mean(load_s)),
+        "lookup_ns": 1e9 * lookup_s / LOOKUPS,
+        "snapshot_s": snapshot_s,
+        "snapshot_bytes": len(snapshot),
+    }
+    os.remove(network_file)
+    os.remove(routes_file)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the routing pipeline on generated topologies.")
+    parser.add_argument(
+        "--kinds", nargs="+", choices=sorted(TOPOLOGIES),
+        default=sorted(TOPOLOGIES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES)
+    parser.add_argument(
+        "--engine", choices=sorted(PATH_ENGINES), default="numpy")
+    parser.add_argument(
+        "--output", default="scale_suite.json",
+        help="file to write the results to")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    results = []
+    print(f"{'topology':>10} {'routers':>8} {'links':>7} {'compute s':>10} "
+          f"{'serialize s':>12} {'load ms':>8} {'lookup ns':>10} "
+          f"{'snapshot KB':>12}")
+    for kind in args.kinds:
+        for size in args.sizes:
+            result = run(kind, size, args.engine, directory)
+            results.append(result)
+            print(f"{kind:>10} {size:>8} {result['links']:>7} "
+                  f"{result['compute_s']:>10.2f} "
+                  f"{result['serialize_s']:>12.3f} {result['load_ms']:>8.2f} "
+                  f"{result['lookup_ns']:>10.0f} "
+                  f"{result['snapshot_bytes'] / 1024:>12.1f}")
+    os.rmdir(directory)
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "engine": args.engine,
+        "command": sys.argv,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=4)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,75 @@
+"""
+Measures the discrete-event simulation: events processed per second and
+virtual seconds simulated per real second, on the NSFNET with a million
+messages and on a generated Waxman topology of 1000 routers, both with a
+router failing and coming back.
+
+Run from the repository root:
+
+    python -m benchmarks.simulation
+"""
+import io
+import os
+import time
+import tempfile
+from contextlib import redirect_stdout
+from simulation import Simulation
+from topology_generator import generate_network, write_network
+
+RATE = 100000
+SIZE = 1000
+CASES = [
+    # name, routers of a Waxman topology or None for the NSFNET, seconds,
+    # failing router
+    ("nsfnet", None, 10.0, "CO"),
+    ("waxman", 1000, 2.0, "R10"),
+]
+
+
+def run(network_file, duration, failing):
+    """
+    Simulates traffic for a duration, the failing router going down after
+    a fifth of it and back after half of it.
+
+    Returns
+    -------
+        simulation : Simulation
+            the simulation once run
+        setup : float
+            seconds to compute the first routes
+        elapsed : float
+            seconds the run took
+    """
+
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        simulation = Simulation(network_file, "numpy")
+        simulation.start()
+        setup = time.perf_counter() - start
+        simulation.fail_router(failing, duration / 5)
+        simulation.recover_router(failing, duration / 2)
+        simulation.add_traffic(RATE, SIZE, stop=duration)
+        start = time.perf_counter()
+        simulation.run(until=duration + 1.0)
+    return simulation, setup, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    print(f"{'topology':>9} {'routers':>8} {'messages':>9} {'setup s':>8} "
+          f"{'run s':>7} {'events/s':>9} {'x real time':>12} {'lost':>6}")
+    for name, size, duration, failing in CASES:
+        network_file = "Json/network.json"
+        if size is not None:
+            network_file = os.path.join(directory, "network.json")
+            write_network(generate_network(name, size), network_file)
+        simulation, setup, elapsed = run(network_file, duration, failing)
+        stats = simulation.stats
+        lost = sum(stats.dropped.values())
+        print(f"{name:>9} {len(simulation.routers):>8} "
+              f"{stats.delivered + lost:>9} {setup:>8.2f} {elapsed:>7.1f} "
+              f"{simulation.processed / elapsed:>9.0f} "
+              f"{simulation.now / elapsed:>12.2f} {lost:>6}")
+        if size is not None:
+            os.remove(network_file)
+    os.rmdir(directory)
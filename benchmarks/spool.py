@@ -0,0 +1,67 @@
+"""
+Measures the spool that holds messages for unreachable next hops: messages
+and MB per second put in and taken out, and the peak Python memory while
+a backlog of texts or audios waits, with frames kept in memory and in
+mmap'd segment files.
+
+Run from the repository root:
+
+    python -m benchmarks.spool
+"""
+import io
+import time
+import shutil
+import tempfile
+import tracemalloc
+from protocol import KIND_AUDIO, KIND_TEXT, Header
+from spool import Spool
+
+CASES = [
+    # name, kind, payload bytes, messages held at once
+    ("text 1 KB", KIND_TEXT, 1024, 20000),
+    ("audio 10 MB", KIND_AUDIO, 10 * 2**20, 20),
+]
+
+
+def run(kind, size, count, directory):
+    """
+    Holds count messages for a next hop and takes them all out.
+
+    Returns
+    -------
+        rate : float
+            the messages per second, put in and taken out
+        peak : int
+            the peak bytes of Python memory
+    """
+    payload = bytes(size)
+    header = Header(kind, "9001", "WA", "9002", "DC", size, flow_id=1)
+    spool = Spool(max_messages=count, max_bytes=(size + 1024) * count,
+                  directory=directory)
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(count):
+        spool.hold("CO", header, io.BytesIO(payload))
+    while True:
+        message = spool.pop("CO")
+        if message is None:
+            break
+        spool.frame(message).release()
+        spool.release(message)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    spool.close()
+    return count / elapsed, peak
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    print(f"{'messages':>12} {'frames':>9} {'msg/s':>9} {'MB/s':>8} "
+          f"{'peak MB':>8}")
+    for name, kind, size, count in CASES:
+        for storage, path in (("memory", None), ("segments", directory)):
+            rate, peak = run(kind, size, count, path)
+            print(f"{name:>12} {storage:>9} {rate:>9.0f} "
+                  f"{rate * size / 2**20:>8.0f} {peak / 2**20:>8.1f}")
+    shutil.rmtree(directory)
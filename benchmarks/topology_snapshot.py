@@ -0,0 +1,121 @@
+"""
+Compares fetching the topology as a pickled Network, as clients used to
+after every message, with the versioned JSON snapshots of the controller:
+a full fetch and a fetch of a topology the client already has. Measured on
+random networks of 1k and 10k routers.
+
+Run from the repository root:
+
+    python -m benchmarks.topology_snapshot
+"""
+import io
+import json
+import time
+import random
+import pickle
+import socket
+import threading
+from contextlib import redirect_stdout
+from client import TCPClient
+from controller import Controller
+from network import Network
+from protocol import KIND_CONTROL, Header, read_frame, send_frame
+
+SIZES = [1000, 10000]
+LINKS_PER_NODE = 3
+FETCHES = 20
+CONTROLLER_PORT = 9895
+PICKLE_PORT = 9896
+
+
+def random_network(size):
+    """
+    Builds a connected random network.
+    """
+
+    rng = random.Random(size)
+    network = Network()
+    for node_id in range(size):
+        network.add_node(node_id, f"R{node_id}")
+    for node_id in range(1, size):
+        network.add_link(node_id, rng.randrange(node_id), rng.random())
+    for _ in range(size * (LINKS_PER_NODE - 1)):
+        network.add_link(rng.randrange(size), rng.randrange(size), rng.random())
+    return network
+
+
+def serve_pickle(network):
+    """
+    Answers every connection with the pickled network, as the controller
+    used to.
+    """
+
+    server = socket.create_server(("localhost", PICKLE_PORT), reuse_port=True)
+
+    def serve():
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            read_frame(connection.makefile("rb"))
+            send_frame(connection, Header(KIND_CONTROL), pickle.dumps(network))
+            connection.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+
+def fetch_pickle():
+    """
+    Fetches the pickled network the way the client used to.
+    """
+
+    with socket.create_connection(("localhost", PICKLE_PORT)) as connection:
+        send_frame(connection, Header(KIND_CONTROL), b"nsfnet")
+        _, payload = read_frame(connection.makefile("rb"))
+    return pickle.loads(payload)
+
+
+def milliseconds(fetch):
+    """
+    Returns the mean time of a fetch in milliseconds.
+    """
+
+    start = time.perf_counter()
+    for _ in range(FETCHES):
+        fetch()
+    return 1000 * (time.perf_counter() - start) / FETCHES
+
+
+if __name__ == "__main__":
+    controller = Controller(CONTROLLER_PORT, algorithm="dijkstra")
+    with redirect_stdout(io.StringIO()):
+        threading.Thread(target=controller.start, daemon=True).start()
+        time.sleep(0.5)
+    client = TCPClient("UT", "bench", 1)
+    client.controller_address = ("localhost", CONTROLLER_PORT)
+
+    print(f"{'nodes':>6} {'links':>6} {'pickle KB':>10} {'snapshot KB':>12} "
+          f"{'pickle ms':>10} {'full ms':>8} {'unchanged ms':>13}")
+    for size in SIZES:
+        network = random_network(size)
+        controller.nsfnet = network
+        server = serve_pickle(network)
+
+        def fetch_full():
+            client.topology_etag = None
+            client.get_nsfnet()
+
+        pickle_size = len(pickle.dumps(network))
+        snapshot_size = len(json.dumps(
+            network.to_snapshot(), separators=(",", ":")))
+        pickle_ms = milliseconds(fetch_pickle)
+        full_ms = milliseconds(fetch_full)
+        assert client.nsfnet.graph.number_of_edges() == \
+            network.graph.number_of_edges()
+        unchanged_ms = milliseconds(client.get_nsfnet)
+        print(f"{size:>6} {len(network.links):>6} {pickle_size // 1024:>10} "
+              f"{snapshot_size // 1024:>12} {pickle_ms:>10.1f} "
+              f"{full_ms:>8.1f} {unchanged_ms:>13.2f}")
+        server.close()
@@ -0,0 +1,64 @@
+"""
+Measures what hop tracing adds to a message: the time to encode and decode
+a header and its size without a trace and with the trace of the sender and
+0 to 8 routers, and the mean cost per header once 1 message in N is
+traced.
+
+Run from the repository root:
+
+    python -m benchmarks.trace_overhead
+"""
+import io
+import time
+from protocol import KIND_TEXT, Header, TraceHop, read_header
+
+ROUNDS = 50000
+HOPS = [0, 1, 4, 8]
+SAMPLING = [1, 10, 100, 1000]
+
+
+def round_trip(header):
+    """
+    Encodes and decodes a header ROUNDS times.
+
+    Returns
+    -------
+        nanoseconds : float
+            the time per round trip
+        size : int
+            the bytes of the encoded header
+    """
+    data = header.encode()
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        read_header(io.BytesIO(header.encode()))
+    return 1e9 * (time.perf_counter() - start) / ROUNDS, len(data)
+
+
+def traced_header(hops):
+    """
+    Builds a header carrying the trace of its sender and of hops routers,
+    or no trace at all for None.
+    """
+    trace = None
+    if hops is not None:
+        now = time.time()
+        trace = [TraceHop("alice", now, now)] + [
+            TraceHop(f"R{hop}", now, now) for hop in range(hops)]
+    return Header(KIND_TEXT, "alice", "WA", "9002", "DC", 1024,
+                  flow_id=1, trace=trace)
+
+
+if __name__ == "__main__":
+    plain, plain_size = round_trip(traced_header(None))
+    print(f"{'trace':>10} {'bytes':>6} {'ns':>7} {'extra ns':>9}")
+    print(f"{'none':>10} {plain_size:>6} {plain:>7.0f} {0:>9}")
+    traced = {}
+    for hops in HOPS:
+        traced[hops], size = round_trip(traced_header(hops))
+        print(f"{f'{hops} hops':>10} {size:>6} {traced[hops]:>7.0f} "
+              f"{traced[hops] - plain:>9.0f}")
+
+    print(f"\nMean extra ns per header with {HOPS[-1]} hops")
+    for every in SAMPLING:
+        print(f"  1 in {every:<5} {(traced[HOPS[-1]] - plain) / every:>7.1f}")
@@ -1,8 +1,21 @@
+import os
 import json
-import pickle
+import time
 import socket
+import argparse
+import itertools
 import threading
-from cryptography.fernet import Fernet
+from network import Network
+from metrics import MetricsRegistry
+from route_store import RouteStore
+from connection_pool import ConnectionPool
+from client_directory import DirectoryCache
+from crypto import (
+    SALT_SIZE, SEALED_CHUNK_SIZE, STREAM_CHUNK_SIZE, SessionCipher,
+    plain_length, sealed_length)
+from protocol import (
+    KIND_AUDIO, KIND_CONTROL, KIND_NAMES, KIND_TEXT, Header, ProtocolError,
+    TraceHop, new_flow_id, read_exact, read_frame, read_header, send_frame)
 
 
 class TCPClient:
@@ -10,55 +23,171 @@ class TCPClient:
     A class to work as a client in the network.
     """
 
-    def __init__(self):
-        self.router_name = input(
+    def __init__(self, router_name=None, client_name=None, client_port=None,
+                 trace_every=0, trace_file=None):
+        """
+        Constructs all the necessary attributes for the client object.
+
+        Parameters
+        ----------
+            router_name : str, optional
+                the router to connect to, asked for when not given
+            client_name : str, optional
+                the name of the client, asked for when not given
+            client_port : int, optional
+                the port the client listens on, asked for when not given
+            trace_every : int, optional
+                trace the hops of 1 message sent in this many, 0 traces
+                none (default is 0)
+            trace_file : str, optional
+                where the traces of the messages received are appended as
+                JSON lines, not written when not given
+        """
+        self.router_name = router_name or input(
             "write the name of the router to connect to: ")
         self.client_socket = None
-        self.client_name = input("Enter your name: ")
-        self.client_port = int(input("Enter the client port: "))
-        key = b'HcEnve-04K7wN5sgrz1JgKufDMIYBbbTXr0Wueg3v7I='
-        self.fernet = Fernet(key)
+        self.client_name = client_name or input("Enter your name: ")
+        self.client_port = int(client_port or input("Enter the client port: "))
+        self.cipher = SessionCipher()
+        self.session = new_flow_id()
         self.nsfnet = None
+        self.topology_etag = None
+        self.controller_address = ("localhost", 8888)
+        self.router_port = None
+        self.pool = ConnectionPool()
+        self.directory = DirectoryCache()
+        self.trace_every = trace_every
+        self.trace_file = trace_file
+        self.messages_sent = itertools.count()
+        self.trace_lock = threading.Lock()
+        # Opened on the first untraced message, again once the controller
+        # replaced the file
+        self.route_store = None
+        self.route_store_file = None
+        self.route_store_lock = threading.Lock()
+        self.create_metrics()
 
-    def connect(self):
+    def create_metrics(self):
         """
-        Connect the client to the router and send the messages
+        Creates the metrics of the client, exposed once metrics.serve is
+        called.
+        """
+
+        self.metrics = MetricsRegistry()
+        self.sent_messages = self.metrics.counter(
+            "client_sent_messages_total", "Messages sent, by kind", ("kind",))
+        self.sent_bytes = self.metrics.counter(
+            "client_sent_bytes_total", "Payload bytes sent, by kind",
+            ("kind",))
+        self.received_messages = self.metrics.counter(
+            "client_received_messages_total", "Messages received, by kind",
+            ("kind",))
+        self.received_bytes = self.metrics.counter(
+            "client_received_bytes_total", "Payload bytes received, by kind",
+            ("kind",))
+        self.directory_lookups = self.metrics.counter(
+            "client_directory_lookups_total",
+            "Destination routers found in the cache (hit) or asked to the "
+            "controller (miss)", ("result",))
+        self.active_receptions = self.metrics.gauge(
+            "client_active_receptions", "Connections messages are received on")
+
+    def register(self):
+        """
+        Starts receiving messages and registers the client with its router.
         """
 
         client_reception_thread = threading.Thread(
-            target=self.client_reception)
+            target=self.client_reception, daemon=True)
         client_reception_thread.start()
 
         network = self.read_json("Json/network.json")
-        server_port = network["Ports"][self.router_name]
-        self.send_to_server("localhost", server_port,
-                            f"New Client-{self.client_port}")
+        self.router_port = network["Ports"][self.router_name]
+        self.send_to_server(
+            "localhost", self.router_port,
+            Header(KIND_CONTROL, src=str(self.client_port),
+                   flow_id=self.session),
+            self.cipher.encrypt("New Client".encode(), self.session))
 
+    def connect(self):
+        """
+        Connect the client to the router and send the messages
+        """
+
+        self.register()
+        server_port = self.router_port
         while True:
             destiny = input("Enter the destiny port: ")
             message = input("Enter the message: ")
-            clients_directory = self.read_json("Json/clients_directory.json")
-            destiny_router = self.destination_router(
-                destiny, clients_directory)
-            data = "-".join(
-                [self.client_name, self.router_name,
-                    destiny, destiny_router, message]
-            )
 
             if message == "audio(°_°)":
                 audio_name = input(
                     "Enter the name of the audio you want to send: ")
                 try:
-                    with open(f"Audios to send/{audio_name}", "rb") as file:
-                        audio_data = file.read()
-                        self.send_to_server(
-                            "localhost", server_port, data, audio_data)
+                    self.send_audio("localhost", server_port,
+                                    self.message_header(destiny, KIND_AUDIO),
+                                    f"Audios to send/{audio_name}")
                 except FileNotFoundError:
                     print("File not found.")
             elif message == "Shutdown":
-                self.send_to_server("localhost", server_port, message)
+                self.send_to_server(
+                    "localhost", server_port,
+                    Header(KIND_CONTROL, flow_id=self.session),
+                    self.cipher.encrypt(message.encode(), self.session))
             else:
-                self.send_to_server("localhost", server_port, data)
+                self.send_text(destiny, message)
+
+    def message_header(self, destiny, kind=KIND_TEXT):
+        """
+        Builds the header of a new message to another client.
+
+        Parameters
+        ----------
+            destiny : str
+                the port of the receiving client
+            kind : int, optional
+                KIND_TEXT or KIND_AUDIO (default is KIND_TEXT)
+
+        Returns
+        -------
+            header : Header
+                the header, with a new flow id, and a trace when the
+                message is sampled
+        """
+
+        trace = None
+        # The count is shared by the threads sending, next is atomic
+        if self.trace_every and \
+                next(self.messages_sent) % self.trace_every == 0:
+            now = time.time()
+            trace = [TraceHop(self.client_name, now, now)]
+        return Header(
+            kind, self.client_name, self.router_name, destiny,
+            self.destination_router(destiny), flow_id=new_flow_id(),
+            trace=trace)
+
+    def send_text(self, destiny, message):
+        """
+        Sends a text message to another client through the router.
+
+        Parameters
+        ----------
+            destiny : str
+                the port of the receiving client
+            message : str
+                the text
+
+        Returns
+        -------
+            header : Header
+                the header the message was sent with
+        """
+
+        header = self.message_header(destiny)
+        self.send_to_server(
+            "localhost", self.router_port, header,
+            self.cipher.encrypt(message.encode(), header.flow_id))
+        return header
 
     def client_reception(self):
         """
@@ -66,32 +195,224 @@ class TCPClient:
         and showing the path the message followed.
         """
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Restarting must not wait for old connections in TIME_WAIT
+        self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.client_socket.bind(("localhost", self.client_port))
-        self.client_socket.listen(5)
+        self.client_socket.listen(128)
         while True:
             new_socket, _ = self.client_socket.accept()
-            data = self.fernet.decrypt(new_socket.recv(1024)).decode()
-            source, source_router, _, _, message = data.split("-")
-            print(f"\n{source}: {message}")
+            # Routers reuse their connections, so each one gets its own reader
+            reception_thread = threading.Thread(
+                target=self.handle_reception, args=(new_socket,))
+            reception_thread.start()
 
-            json_paths = self.read_json("Json/paths.json")
-            for paths in json_paths:
-                if paths["source"] == source_router and paths["destination"] == self.router_name:
-                    path = paths["path"]
+    def handle_reception(self, new_socket):
+        """
+        Receives the messages of a single connection until the router
+        closes it, or sends something that cannot be read, which drops
+        the connection.
 
-            if message == "audio(°_°)":
-                new_socket.sendall(self.fernet.encrypt("send it".encode()))
+        Parameters
+        ----------
+            new_socket : socket
+                the connection opened by the router
+        """
+        reader = new_socket.makefile("rb")
+        buffer = bytearray(SEALED_CHUNK_SIZE)
+        self.active_receptions.inc()
+        try:
+            while True:
+                header = read_header(reader)
+                if header is None:
+                    break
+                arrived = time.time()
+                self.count_message(
+                    self.received_messages, self.received_bytes, header)
+
+                if header.kind == KIND_CONTROL:
+                    payload = read_exact(reader, header.payload_length)
+                    notice = json.loads(
+                        self.cipher.decrypt(payload, header.flow_id).decode())
+                    self.directory.invalidate(notice["invalidate"])
+                    continue
+
+                if header.kind == KIND_AUDIO:
+                    print(f"\n{header.src}: audio")
+                    filename = self.receive_audio(reader, header, buffer)
+                    print(f"Received audio in {filename}")
+                else:
+                    payload = read_exact(reader, header.payload_length)
+                    message = self.cipher.decrypt(
+                        payload, header.flow_id).decode()
+                    print(f"\n{header.src}: {message}")
+
+                if header.trace:
+                    # The routers the message actually went through
+                    path = [hop.node for hop in header.trace[1:]]
+                    self.export_trace(self.trace_record(header, arrived))
+                else:
+                    path = self.route_path(header.src_router)
+
+                self.get_nsfnet()
+                self.nsfnet.visualize_path(path)
+        except (ProtocolError, OSError, ValueError, KeyError) as error:
+            print(f"Dropping connection: {error}")
+        finally:
+            self.active_receptions.dec()
+            new_socket.close()
+
+    def route_path(self, source):
+        """
+        Rebuilds the path the controller routes from a router to this
+        client's router with, from the route store.
+
+        Parameters
+        ----------
+            source : str
+                the name of the router the message came from
 
-                with open("Audios received/audio_copia.wav", "wb") as file:
-                    while True:
-                        audio_data = new_socket.recv(32768)
-                        if not audio_data:
-                            break
-                        file.write(audio_data)
-                print("Received audio")
+        Returns
+        -------
+            path : list
+                the names of the routers on the path
+        """
+        stat = os.stat("Json/routes.bin")
+        with self.route_store_lock:
+            if self.route_store_file != (stat.st_ino, stat.st_mtime_ns):
+                if self.route_store is not None:
+                    self.route_store.close()
+                    self.route_store = None
+                self.route_store = RouteStore("Json/routes.bin")
+                self.route_store_file = (stat.st_ino, stat.st_mtime_ns)
+            return self.route_store.path(source, self.router_name)
 
-            self.get_nsfnet()
-            self.nsfnet.visualize_path(path)
+    def trace_record(self, header, arrived):
+        """
+        Turns the trace of a message received into the time spent on each
+        hop. A hop waits from the moment the previous one found where to
+        send the header until it reads it, which covers getting a
+        connection, the link and the queueing, and then takes its
+        forwarding time to find the next hop.
+
+        Parameters
+        ----------
+            header : Header
+                the header of the message, with its trace
+            arrived : float
+                the wall clock time the header reached this client
+
+        Returns
+        -------
+            record : dict
+                the message, its path and the latencies of every hop in
+                seconds
+        """
+        sender, *routers = header.trace
+        hops = []
+        previous = sender.forwarded
+        for hop in routers:
+            hops.append({
+                "router": hop.node,
+                "received": hop.received,
+                "forwarded": hop.forwarded,
+                "wait": hop.received - previous,
+                "forwarding": hop.forwarded - hop.received,
+            })
+            previous = hop.forwarded
+        return {
+            "flow_id": header.flow_id,
+            "kind": KIND_NAMES.get(header.kind, str(header.kind)),
+            "src": header.src,
+            "dst": header.dst,
+            "sent": sender.forwarded,
+            "arrived": arrived,
+            "latency": arrived - sender.forwarded,
+            "path": [hop.node for hop in routers],
+            "hops": hops,
+            "last_wait": arrived - previous,
+        }
+
+    def export_trace(self, record):
+        """
+        Prints the hops of a traced message and appends its record to the
+        trace file.
+
+        Parameters
+        ----------
+            record : dict
+                the record of the message, as trace_record gives it
+        """
+        hops = ", ".join(
+            f"{hop['router']} {hop['wait'] * 1000:.2f}+"
+            f"{hop['forwarding'] * 1000:.2f} ms" for hop in record["hops"])
+        print(f"Trace of {record['flow_id']:016x}: {hops}, "
+              f"{record['latency'] * 1000:.2f} ms in total")
+        if self.trace_file is None:
+            return
+        with self.trace_lock:
+            with open(self.trace_file, "a", encoding="utf-8") as file:
+                file.write(json.dumps(record) + "\n")
+
+    def count_message(self, messages, payload_bytes, header):
+        """
+        Records a message sent or received in the metrics.
+
+        Parameters
+        ----------
+            messages : Counter
+                the counter of messages
+            payload_bytes : Counter
+                the counter of bytes
+            header : Header
+                the header of the message
+        """
+        labels = (KIND_NAMES.get(header.kind, str(header.kind)),)
+        messages.inc(1, labels)
+        payload_bytes.inc(header.payload_length, labels)
+
+    def receive_audio(self, reader, header, buffer):
+        """
+        Writes a received audio to its own file, so receptions running at the
+        same time never share one. The file is allocated at its final size
+        first and the audio goes to disk chunk by chunk through a reused
+        buffer, each chunk decrypted and authenticated on its own, so memory
+        does not grow with the size of the audio.
+
+        Parameters
+        ----------
+            reader : file
+                the buffered reader the audio is read from
+            header : Header
+                the header of the audio
+            buffer : bytearray
+                the buffer to receive into, SEALED_CHUNK_SIZE bytes long
+
+        Returns
+        -------
+            filename : str
+                the file the audio was written to
+        """
+        filename = f"Audios received/audio_{header.flow_id:016x}.wav"
+        view = memoryview(buffer)
+        size = plain_length(header.payload_length)
+        stream = self.cipher.stream(
+            header.flow_id, read_exact(reader, SALT_SIZE))
+        remaining = header.payload_length - SALT_SIZE
+        with open(filename, "wb") as file:
+            if size and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(file.fileno(), 0, size)
+            while remaining:
+                chunk = view[:min(remaining, SEALED_CHUNK_SIZE)]
+                filled = 0
+                while filled < len(chunk):
+                    received = reader.readinto(chunk[filled:])
+                    if not received:
+                        raise ProtocolError(
+                            "Connection closed in the middle of a frame")
+                    filled += received
+                remaining -= filled
+                file.write(stream.open(chunk, last=not remaining))
+        return filename
 
     def read_json(self, filename):
         """
@@ -112,30 +433,82 @@ class TCPClient:
             data = json.load(file)
         return data
 
-    def destination_router(self, port, json_data):
+    def destination_router(self, port):
         """
-        Find which router a certain client is connected to
+        Find which router a certain client is connected to, asking the
+        client directory of the controller when it is not cached
 
         Parameters
         ----------
-            port : int
+            port : str
                 the client port to which a message is to be sent
 
-            json_data: dict
-                the json dictionary containing the client directory
-
         Returns
         -------
             router: str
                 name of the router to which that client is connected
         """
 
-        for router, clients in json_data.items():
-            if port in clients:
-                return router
-        return "None"
+        router = self.directory.get(port)
+        self.directory_lookups.inc(
+            1, ("miss",) if router is None else ("hit",))
+        if router is None:
+            router = self.lookup_client(port)
+            if router is None:
+                return "None"
+            self.directory.put(port, router)
+        return router
+
+    def lookup_client(self, port):
+        """
+        Asks the controller which router a client is connected to. The
+        controller remembers who asked, to tell this client when the answer
+        changes.
+
+        Parameters
+        ----------
+            port : str
+                the port of the client
+
+        Returns
+        -------
+            router: str
+                name of the router of the client, or None if it is unknown
+        """
+
+        answer = self.ask_controller(
+            {"lookup": port, "watcher": str(self.client_port)})
+        return answer["router"]
+
+    def ask_controller(self, request):
+        """
+        Sends a request to the controller and returns its answer.
+
+        Parameters
+        ----------
+            request : dict
+                the request
+
+        Returns
+        -------
+            answer: dict
+                the answer of the controller
+        """
+
+        host, port = self.controller_address
+        with self.pool.connection(host, port) as server_socket:
+            send_frame(server_socket, Header(KIND_CONTROL, flow_id=self.session),
+                       self.cipher.encrypt(
+                           json.dumps(request).encode(), self.session))
+            # Unbuffered so nothing is lost when the connection goes back to
+            # the pool
+            header, payload = read_frame(
+                server_socket.makefile("rb", buffering=0))
+            if header is None:
+                raise ConnectionResetError
+        return json.loads(self.cipher.decrypt(payload, header.flow_id))
 
-    def send_to_server(self, server_host, server_port, message, audio=None):
+    def send_to_server(self, server_host, server_port, header, payload):
         """
         Sends a message to the server.
 
@@ -145,36 +518,104 @@ class TCPClient:
                 the host address of the server
             server_port : int
                 the port number of the server
-            message : str
-                the message to be sent
-            audio : Any
-                the audio to be sent
+            header : Header
+                the header of the message
+            payload : bytes
+                the payload of the message
         """
 
-        try:
-            # Create a TCP client socket
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # Connect to the server
-            server_socket.connect((server_host, server_port))
-            # Send the message to the server
-            server_socket.sendall(self.fernet.encrypt(message.encode()))
-
-            if audio is not None:
-                server_socket.recv(1024)
-                server_socket.sendall(audio)
-        finally:
-            # Close the client socket
-            server_socket.close()
+        with self.pool.connection(server_host, server_port) as server_socket:
+            send_frame(server_socket, header, payload)
+        if header.kind != KIND_CONTROL:
+            self.count_message(self.sent_messages, self.sent_bytes, header)
+
+    def send_audio(self, server_host, server_port, header, audio_path):
+        """
+        Sends an audio file to the server, encrypted as a stream of chunks
+        so the audio is never loaded in memory and routers can forward each
+        chunk as soon as it arrives.
+
+        Parameters
+        ----------
+            server_host : str
+                the host address of the server
+            server_port : int
+                the port number of the server
+            header : Header
+                the header of the message
+            audio_path : str
+                the path of the audio file
+        """
+
+        with open(audio_path, "rb") as file:
+            self.stream_audio(server_host, server_port, header, file,
+                              os.fstat(file.fileno()).st_size)
+
+    def stream_audio(self, server_host, server_port, header, file, size):
+        """
+        Sends an audio read from a file object as a stream of encrypted
+        chunks, after the salt of its key. Every byte goes through the
+        cipher, so the file cannot be handed to sendfile.
+
+        Parameters
+        ----------
+            server_host : str
+                the host address of the server
+            server_port : int
+                the port number of the server
+            header : Header
+                the header of the message
+            file : file
+                the audio, read with readinto
+            size : int
+                the number of bytes of the audio
+        """
+
+        buffer = memoryview(bytearray(STREAM_CHUNK_SIZE))
+        stream = self.cipher.stream(header.flow_id)
+        remaining = size
+        header.payload_length = sealed_length(remaining)
+        with self.pool.connection(server_host, server_port) as server_socket:
+            server_socket.sendall(header.encode() + stream.salt)
+            while True:
+                read = file.readinto(buffer[:min(remaining, len(buffer))])
+                if remaining and not read:
+                    raise ProtocolError("Audio file shrank while sending")
+                remaining -= read
+                server_socket.sendall(
+                    stream.seal(buffer[:read], last=not remaining))
+                if not remaining:
+                    break
+        self.count_message(self.sent_messages, self.sent_bytes, header)
 
     def get_nsfnet(self):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.connect(("localhost", 8888))
-        server_socket.sendall(self.fernet.encrypt("nsfnet".encode()))
-        self.nsfnet = pickle.loads(server_socket.recv(32768))
-        server_socket.close()
+        """
+        Brings the topology up to date, fetching it from the controller only
+        when it changed since the last time.
+        """
+
+        answer = self.ask_controller({"snapshot": self.topology_etag})
+        if "topology" in answer:
+            self.nsfnet = Network.from_snapshot(answer["topology"])
+        self.topology_etag = answer["etag"]
 
 
 # Example usage
 if __name__ == "__main__":
-    server_client = TCPClient()
+    parser = argparse.ArgumentParser(description="Start a client.")
+    parser.add_argument(
+        "--metrics-port", type=int,
+        help="serve the metrics over HTTP on this port")
+    parser.add_argument(
+        "--trace-every", type=int, default=0,
+        help="trace the hops of 1 message sent in this many")
+    parser.add_argument(
+        "--trace-file",
+        help="append the traces of the messages received to this file")
+    args = parser.parse_args()
+
+    server_client = TCPClient(
+        trace_every=args.trace_every, trace_file=args.trace_file)
+    if args.metrics_port is not None:
+        server_client.metrics.serve(args.metrics_port)
     server_client.connect()
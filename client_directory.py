@@ -0,0 +1,131 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class ClientDirectory:
+    """
+    A class to keep which router every client is connected to, in memory.
+
+    The controller hosts the directory: routers report the clients that
+    register with them and clients look up the router of the client they
+    write to. Clients that looked up a port are remembered as its watchers,
+    so they can be told to drop their cached answer when it changes.
+    """
+
+    def __init__(self):
+        """
+        Constructs all the necessary attributes for the directory object.
+        """
+        self.routers = {}
+        self.watchers = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.routers)
+
+    def register(self, port, router):
+        """
+        Records the router a client is connected to.
+
+        Parameters
+        ----------
+            port : str
+                the port the client listens on
+            router : str
+                the router the client registered with
+
+        Returns
+        -------
+            watchers : list
+                the ports of the clients whose cached answer is now stale
+        """
+        with self.lock:
+            previous = self.routers.get(port)
+            self.routers[port] = router
+            if previous is None or previous == router:
+                return []
+            # Watchers subscribe again on their next lookup
+            return list(self.watchers.pop(port, ()))
+
+    def lookup(self, port, watcher=None):
+        """
+        Finds the router a client is connected to.
+
+        Parameters
+        ----------
+            port : str
+                the port of the client
+            watcher : str, optional
+                the port of the client asking, to notify it when the answer
+                changes
+
+        Returns
+        -------
+            router : str
+                the router of the client, or None if it never registered
+        """
+        with self.lock:
+            router = self.routers.get(port)
+            if router is not None and watcher is not None:
+                self.watchers.setdefault(port, set()).add(watcher)
+            return router
+
+
+class DirectoryCache:
+    """
+    A class to keep the answers of the client directory on the client side,
+    bounded both in age and in number of entries.
+    """
+
+    def __init__(self, ttl=30.0, max_entries=10000):
+        """
+        Constructs all the necessary attributes for the cache object.
+
+        Parameters
+        ----------
+            ttl : float, optional
+                seconds an answer is trusted without asking again (default
+                is 30)
+            max_entries : int, optional
+                the number of answers kept, the least recently used going
+                first (default is 10000)
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, port):
+        """
+        Returns the cached router of a client, or None if it is not cached
+        or too old.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(port)
+            if entry is None:
+                return None
+            router, stored = entry
+            if now - stored > self.ttl:
+                del self.entries[port]
+                return None
+            self.entries.move_to_end(port)
+            return router
+
+    def put(self, port, router):
+        """
+        Caches the router of a client.
+        """
+        with self.lock:
+            self.entries[port] = (router, time.monotonic())
+            self.entries.move_to_end(port)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, port):
+        """
+        Drops the cached router of a client.
+        """
+        with self.lock:
+            self.entries.pop(port, None)
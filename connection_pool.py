@@ -0,0 +1,212 @@
+import time
+import select
+import socket
+import threading
+from contextlib import contextmanager
+
+
+class PoolExhausted(TimeoutError):
+    """
+    Raised when every connection to a peer stayed in use for the whole
+    timeout, while the peer itself may be fine.
+    """
+
+
+class ConnectionPool:
+    """
+    A class to reuse TCP connections between the components of the network.
+
+    Connections are kept per (host, port). A connection is handed to a single
+    user at a time and goes back to the pool once the message was sent, so
+    the next message to the same peer skips the TCP handshake.
+    """
+
+    def __init__(self, max_per_peer=8, idle_timeout=30.0, connect_timeout=5.0):
+        """
+        Constructs all the necessary attributes for the pool object.
+
+        Parameters
+        ----------
+            max_per_peer : int, optional
+                the maximum number of open connections to a single peer
+                (default is 8)
+            idle_timeout : float, optional
+                seconds an unused connection is kept open, 0 closes every
+                connection as soon as it is released (default is 30)
+            connect_timeout : float, optional
+                seconds to wait for a new connection, or for a free one when
+                the peer is at its cap (default is 5)
+        """
+        self.max_per_peer = max_per_peer
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.idle = {}
+        self.open_count = {}
+        self.condition = threading.Condition()
+
+    def acquire(self, host, port, timeout=None):
+        """
+        Takes a connection to a peer, reusing an idle one when possible.
+
+        Parameters
+        ----------
+            host : str
+                the host address of the peer
+            port : int
+                the port number of the peer
+            timeout : float, optional
+                overrides connect_timeout for this call
+
+        Returns
+        -------
+            connection : socket
+                a connected socket owned by the caller until released
+        """
+        peer = (host, port)
+        if timeout is None:
+            timeout = self.connect_timeout
+        deadline = time.monotonic() + timeout
+
+        with self.condition:
+            while True:
+                self.evict_idle(peer)
+                idle = self.idle.get(peer)
+                while idle:
+                    connection, _ = idle.pop()
+                    if self.is_alive(connection):
+                        return connection
+                    self.discard(peer, connection)
+
+                if self.open_count.get(peer, 0) < self.max_per_peer:
+                    self.open_count[peer] = self.open_count.get(peer, 0) + 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhausted(
+                        f"No free connection to {host}:{port}")
+                self.condition.wait(remaining)
+
+        try:
+            connection = socket.create_connection(peer, timeout=timeout)
+            connection.settimeout(None)
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            with self.condition:
+                self.open_count[peer] -= 1
+                self.condition.notify()
+            raise
+        return connection
+
+    def release(self, host, port, connection, reuse=True):
+        """
+        Gives a connection back to the pool.
+
+        Parameters
+        ----------
+            host : str
+                the host address of the peer
+            port : int
+                the port number of the peer
+            connection : socket
+                the connection taken with acquire
+            reuse : bool, optional
+                False closes the connection, for instance after an error
+                (default is True)
+        """
+        peer = (host, port)
+        with self.condition:
+            if reuse and self.idle_timeout > 0:
+                self.idle.setdefault(peer, []).append(
+                    (connection, time.monotonic()))
+            else:
+                self.discard(peer, connection)
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self, host, port, timeout=None):
+        """
+        Lends a connection for the duration of a with block. The connection
+        is closed instead of reused if the block raises.
+
+        Parameters
+        ----------
+            host : str
+                the host address of the peer
+            port : int
+                the port number of the peer
+            timeout : float, optional
+                overrides connect_timeout for this call
+        """
+        connection = self.acquire(host, port, timeout)
+        try:
+            yield connection
+        except BaseException:
+            self.release(host, port, connection, reuse=False)
+            raise
+        self.release(host, port, connection)
+
+    def evict_idle(self, peer=None):
+        """
+        Closes the connections that stayed unused longer than the idle
+        timeout. Must be called with the condition held.
+
+        Parameters
+        ----------
+            peer : tuple, optional
+                only check the connections of this peer (default is every
+                peer)
+        """
+        now = time.monotonic()
+        peers = [peer] if peer is not None else list(self.idle)
+        for current in peers:
+            idle = self.idle.get(current, [])
+            fresh = []
+            for connection, released in idle:
+                if now - released > self.idle_timeout:
+                    self.discard(current, connection)
+                else:
+                    fresh.append((connection, released))
+            self.idle[current] = fresh
+
+    def discard(self, peer, connection):
+        """
+        Closes a connection and frees its slot. Must be called with the
+        condition held.
+        """
+        connection.close()
+        self.open_count[peer] -= 1
+
+    def is_alive(self, connection):
+        """
+        Checks that an idle connection was not closed by the peer. An idle
+        connection has nothing to read, so a readable one either reached EOF
+        or holds data nobody will ever claim.
+
+        Parameters
+        ----------
+            connection : socket
+                an idle connection
+
+        Returns
+        -------
+            alive : bool
+                whether the connection can be reused
+        """
+        try:
+            readable, _, _ = select.select([connection], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def close(self):
+        """
+        Closes every idle connection.
+        """
+        with self.condition:
+            for peer, idle in self.idle.items():
+                for connection, _ in idle:
+                    self.discard(peer, connection)
+            self.idle = {}
+            self.condition.notify_all()
+
@@ -1,11 +1,23 @@
+import os
+import math
 import time
+import argparse
 import json
+import queue
 import socket
-import pickle
 import threading
-import networkx as nx
-from cryptography.fernet import Fernet
 from network import Network
+from path_engines import (
+    PATH_ENGINES, PredecessorPaths, cross_check, get_path_engine)
+from health import HealthChecker, MissedHeartbeatsDetector, PhiAccrualDetector
+from crypto import SessionCipher
+from client_directory import ClientDirectory
+from route_store import NextHopMatrix
+from connection_pool import ConnectionPool
+from metrics import MetricsRegistry
+from shaping import DEFAULT_BANDWIDTH_GBPS, CongestionTracker
+from protocol import (
+    KIND_CONTROL, Header, ProtocolError, new_flow_id, read_frame, send_frame)
 
 
 class Controller:
@@ -13,7 +25,13 @@ class Controller:
     A class to represent a controller for network routing.
     """
 
-    def __init__(self, port):
+    def __init__(self, port, incremental=True, check_interval=0.25,
+                 probe_timeout=0.2, detector="phi", phi_threshold=8.0,
+                 max_missed=3, algorithm=None, paths_json=False,
+                 check_engine=False, workers=None,
+                 network_file="Json/network.json",
+                 routes_file="Json/routes.bin", max_paths=1, stretch=1.0,
+                 congestion=None, backup_routes=False):
         """
         Constructs all the necessary attributes for the controller object.
 
@@ -23,22 +41,182 @@ class Controller:
                 The host address of the controller.
             port : int
                 The port number of the controller.
+            incremental : bool, optional
+                Recompute only the shortest path trees affected by a topology
+                change instead of every tree (default is True).
+            check_interval : float, optional
+                Seconds between two rounds of status checks (default is 0.25).
+            probe_timeout : float, optional
+                Seconds a router has to answer a status check (default is 0.2).
+            detector : str, optional
+                The failure detector, 'phi' for phi accrual or 'missed' for a
+                number of consecutive missed checks (default is 'phi').
+            phi_threshold : float, optional
+                Suspicion level above which the phi detector declares a router
+                down (default is 8).
+            max_missed : int, optional
+                Consecutive missed checks before the 'missed' detector declares
+                a router down (default is 3).
+            algorithm : str, optional
+                The path engine, 'dijkstra', 'bellman_ford', 'numpy' or
+                'parallel'. Taken from the PathEngine entry of network.json,
+                and asked for when neither gives one.
+            paths_json : bool, optional
+                Also write every full path to paths.json besides the route
+                store (default is False).
+            check_engine : bool, optional
+                Compare the path costs of the engine with Dijkstra after every
+                full computation (default is False).
+            workers : int, optional
+                The worker processes of the parallel engine (default is the
+                number of CPUs).
+            network_file : str, optional
+                The topology to build (default is "Json/network.json").
+            routes_file : str, optional
+                Where the route store is written (default is
+                "Json/routes.bin").
+            max_paths : int, optional
+                The next hops a router may spread flows over towards a
+                destination (default is 1, a single shortest path).
+            stretch : float, optional
+                How much costlier than the shortest path the other paths
+                may be, 1 keeping only equal-cost paths (default is 1).
+            congestion : CongestionTracker, optional
+                Raises the cost of the links the routers report congested,
+                link utilization is ignored when not given.
+            backup_routes : bool, optional
+                Also send every router a backup for the next router of each
+                destination, a loop-free alternate or a remote one, used
+                when the next router cannot be reached (default is False).
         """
         self.port = port
         self.nsfnet = Network()
-        self.network = self.read_json("Json/network.json")
+        self.network = self.read_json(network_file)
+        self.routes_file = routes_file
         self.node_ports = list(self.network["Ports"].values())
-        key = b'HcEnve-04K7wN5sgrz1JgKufDMIYBbbTXr0Wueg3v7I='
-        self.fernet = Fernet(key)
+        self.port_names = {
+            port: name for name, port in self.network["Ports"].items()}
+        self.incremental = incremental
+        self.shortest_paths = {}
+        self.distances = {}
+        self.transit_nodes = {}
+        self.next_hop_matrix = NextHopMatrix(self.network["Nodes"])
+        self.paths_json = paths_json
+        self.check_engine = check_engine
+        self.max_paths = max_paths
+        self.stretch = stretch
+        self.congestion = congestion
+        self.backup_routes = backup_routes
+        self.link_bandwidths = {}
+        # The cost of every link when it is not congested
+        self.link_costs = {}
+        names = {
+            node_id: name for name, node_id in self.network["Nodes"].items()}
+        for link in self.network["Links"]:
+            first, second = link["from"], link["to"]
+            self.link_bandwidths[first, second] = \
+                self.link_bandwidths[second, first] = \
+                link.get("bandwidth", DEFAULT_BANDWIDTH_GBPS)
+            self.link_costs[names[first], names[second]] = \
+                self.link_costs[names[second], names[first]] = \
+                1 / link["distance"]
+        self.converged = False
+        self.routes_lock = threading.Lock()
+        self.control_channels = {}
+        self.control_sessions = {}
+        # Routes versions waiting to be sent, one queue per control channel
+        self.control_outboxes = {}
+        self.pushed_tables = {}
+        self.acked_versions = {}
+        self.routes_version = 0
+        self.version_started = {}
+        # The routers yet to acknowledge each routes version
+        self.awaiting = {}
+        self.convergence_times = []
+        # Convergence is measured with it, a simulation swaps in its own
+        self.clock = time.perf_counter
+        self.channels_lock = threading.Lock()
+        self.cipher = SessionCipher()
+        self.directory = ClientDirectory()
+        self.session = new_flow_id()
+        self.pool = ConnectionPool()
         self.routers_quantity = 0
-
-        dijkstra = input("Use dijkstra? (Y)/(N): ")
-        if dijkstra == "N":
-            print("Bellman-Ford algorithm established")
-            self.algorithm = "bellman_ford"
+        self.probe_timeout = probe_timeout
+        if detector == "phi":
+            failure_detector = PhiAccrualDetector(
+                phi_threshold, expected_interval=check_interval,
+                min_std_deviation=check_interval / 5)
+        elif detector == "missed":
+            failure_detector = MissedHeartbeatsDetector(max_missed)
         else:
-            print("Dijkstra algorithm set by default")
-            self.algorithm = "dijkstra"
+            raise ValueError(
+                "Invalid detector specified. Use 'phi' or 'missed'.")
+        self.health = HealthChecker(
+            self.probe_router, failure_detector, check_interval)
+
+        self.snapshot = None
+        if algorithm is None:
+            algorithm = self.network.get("PathEngine")
+        if algorithm is None:
+            dijkstra = input("Use dijkstra? (Y)/(N): ")
+            if dijkstra == "N":
+                print("Bellman-Ford algorithm established")
+                algorithm = "bellman_ford"
+            else:
+                print("Dijkstra algorithm set by default")
+                algorithm = "dijkstra"
+        self.algorithm = algorithm
+        options = {} if workers is None else {"workers": workers}
+        self.path_engine = get_path_engine(algorithm, **options)
+        self.create_metrics()
+
+    def create_metrics(self):
+        """
+        Creates the metrics of the controller, exposed once metrics.serve is
+        called.
+        """
+        self.metrics = MetricsRegistry()
+        self.recompute_seconds = self.metrics.histogram(
+            "controller_recompute_seconds",
+            "Seconds to recompute the shortest path trees, by kind",
+            ("kind",))
+        self.recomputed_trees = self.metrics.counter(
+            "controller_recomputed_trees_total",
+            "Shortest path trees computed")
+        self.convergence_seconds = self.metrics.histogram(
+            "controller_convergence_seconds",
+            "Seconds until every router applied a routes version")
+        self.probe_seconds = self.metrics.histogram(
+            "controller_probe_rtt_seconds",
+            "Round trip time of the answered status checks")
+        self.probe_failures = self.metrics.counter(
+            "controller_probe_failures_total",
+            "Status checks left without answer, by router", ("router",))
+        self.failures_detected = self.metrics.counter(
+            "controller_failures_detected_total",
+            "Routers declared down by the failure detector")
+        self.detection_seconds = self.metrics.histogram(
+            "controller_detection_seconds",
+            "Seconds from the last answer of a router to declaring it down")
+        self.link_changes = self.metrics.counter(
+            "controller_link_cost_changes_total",
+            "Links that became congested or clear", ("state",))
+        self.metrics.gauge(
+            "controller_congested_links", "Links currently congested",
+            function=lambda: len(self.congestion.congested)
+            if self.congestion is not None else 0)
+        self.metrics.gauge(
+            "controller_routes_version", "Last routes version pushed",
+            function=lambda: self.routes_version)
+        self.metrics.gauge(
+            "controller_routers", "Routers in the network",
+            function=lambda: self.routers_quantity)
+        self.metrics.gauge(
+            "controller_control_channels", "Open control channels",
+            function=lambda: len(self.control_channels))
+        self.metrics.gauge(
+            "controller_threads", "Threads of the controller process",
+            function=threading.active_count)
 
     def start(self):
         """
@@ -46,6 +224,8 @@ class Controller:
         """
         # Create a TCP server socket
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Restarting must not wait for old connections in TIME_WAIT
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # Bind the socket to the address and port
         server_socket.bind(("localhost", self.port))
         # Listen for incoming connections
@@ -56,62 +236,269 @@ class Controller:
         while True:
             # Accept a new connection
             router_socket, _ = server_socket.accept()
-            new_info = self.fernet.decrypt(router_socket.recv(1024)).decode()
+            reader = router_socket.makefile("rb")
+            try:
+                header, payload = read_frame(reader)
+            except ProtocolError as error:
+                print(f"Dropping connection: {error}")
+                header = None
+            if header is None:
+                router_socket.close()
+                continue
+            try:
+                new_info = self.cipher.decrypt(payload, header.flow_id).decode()
+            except ProtocolError as error:
+                print(f"Dropping connection: {error}")
+                router_socket.close()
+                continue
+
+            if new_info.startswith("{"):
+                # Clients keep their connection open for further requests
+                client_thread = threading.Thread(
+                    target=self.serve_client,
+                    args=(router_socket, reader, header, new_info))
+                client_thread.start()
 
-            if new_info == "nsfnet":
-                router_socket.sendall(pickle.dumps(self.nsfnet))
+            elif self.converged:
+                self.open_control_channel(
+                    new_info, router_socket, reader, header.flow_id)
+                self.rejoin_router(new_info)
 
             elif self.routers_quantity < total_routers:
                 router_name = new_info
+                self.open_control_channel(
+                    router_name, router_socket, reader, header.flow_id)
                 node_id = self.network["Nodes"][router_name]
-                self.nsfnet.add_node(node_id, router_name)
+                # Clients may be reading the topology meanwhile
+                with self.routes_lock:
+                    self.nsfnet.add_node(node_id, router_name)
                 self.routers_quantity += 1
 
                 if self.routers_quantity == total_routers:
-                    for link in self.network["Links"]:
-                        from_node = link["from"]
-                        to_node = link["to"]
-                        distance = link["distance"]
-                        self.nsfnet.add_link(from_node, to_node, 1/distance)
-
                     self.node_ports = list(self.network["Ports"].values())
-                    self.compute_all_shortest_paths(self.nsfnet)
-
-                    for port in self.node_ports:
-                        path_thread = threading.Thread(
-                            target=self.paths_updated, args=(port, ))
-                        path_thread.start()
+                    with self.routes_lock:
+                        for link in self.network["Links"]:
+                            from_node = link["from"]
+                            to_node = link["to"]
+                            distance = link["distance"]
+                            self.nsfnet.add_link(from_node, to_node, 1/distance)
+                        self.compute_all_shortest_paths(self.nsfnet)
+                        self.push_routes()
+                    self.converged = True
 
                     print("Starting node status checking")
                     ack_thread = threading.Thread(
                         target=self.check_nodes_status)
                     ack_thread.start()
 
-    def compute_all_shortest_paths(self, network):
+    def rejoin_router(self, router_name):
         """
-        Computes all shortest paths in the network and stores them in JSON format.
+        Adds back a router that went down after the network converged and
+        restores its links towards the routers that are still alive.
 
         Parameters
         ----------
-        network : NetworkX graph
+        router_name : str
+            The name of the router that reconnected.
+        """
+        node_id = self.network["Nodes"][router_name]
+        port = self.network["Ports"][router_name]
+
+        with self.routes_lock:
+            if node_id in self.nsfnet.nodes:
+                # Restarted before it was detected as down, it only needs
+                # its table again
+                self.push_routes()
+                return
+            self.nsfnet.add_node(node_id, router_name)
+            for link in self.network["Links"]:
+                if node_id not in (link["from"], link["to"]):
+                    continue
+                other = link["to"] if link["from"] == node_id else link["from"]
+                if other in self.nsfnet.nodes:
+                    # Congestion seen meanwhile on the link still counts
+                    self.nsfnet.add_link(
+                        link["from"], link["to"], self.link_cost(
+                            router_name, self.nsfnet.nodes[other].name))
+            self.node_ports.append(port)
+            self.routers_quantity += 1
+            self.update_shortest_paths(self.nsfnet, added=[router_name])
+            self.push_routes()
+
+        print(f"Router {router_name} rejoined the network")
+
+    def single_source_shortest_paths(self, graph, source):
+        """
+        Computes the shortest path tree rooted at a single source.
+
+        Parameters
+        ----------
+        graph : NetworkX graph
             The network graph.
+        source : str
+            The name of the source router.
 
         Returns
         -------
-        json_to_send : str
-            A JSON string representing all shortest paths in the network.
+        distances : dict
+            The cost from the source to every reachable router.
+        paths : dict
+            The shortest path from the source to every reachable router.
         """
-        the_json = []
-        if self.algorithm == 'dijkstra':
-            all_paths = dict(nx.all_pairs_dijkstra_path(network.graph))
-        elif self.algorithm == 'bellman_ford':
-            all_paths = dict(nx.all_pairs_bellman_ford_path(network.graph))
-        else:
-            raise ValueError(
-                "Invalid algorithm specified. Use 'dijkstra' or 'bellman_ford'.")
+        return self.path_engine.tree(graph, source)
+
+    def store_tree(self, graph, source, tree=None):
+        """
+        Computes and keeps the shortest path tree of a source, along with
+        the routers the tree goes through.
+
+        Parameters
+        ----------
+        graph : NetworkX graph
+            The network graph.
+        source : str
+            The name of the source router.
+        tree : tuple, optional
+            The distances and paths of the source when already computed.
+        """
+        if tree is None:
+            tree = self.single_source_shortest_paths(graph, source)
+        distances, paths = tree
+        self.distances[source] = distances
+        self.shortest_paths[source] = paths
+        if isinstance(paths, PredecessorPaths):
+            # Read from the rows, the paths are only built if used
+            self.transit_nodes[source] = paths.transit_nodes()
+            self.next_hop_matrix.set_next_hops(
+                source, paths.names, paths.next_hops)
+            return
+        self.transit_nodes[source] = {
+            path[-2] for path in paths.values() if len(path) > 2}
+        self.next_hop_matrix.set_tree(source, paths)
+
+    def compute_all_shortest_paths(self, network):
+        """
+        Computes all shortest paths in the network and stores their next hops
+        in the route store.
+
+        Parameters
+        ----------
+        network : NetworkX graph
+            The network graph.
+        """
+        started = time.perf_counter()
+        self.shortest_paths = {}
+        self.distances = {}
+        self.transit_nodes = {}
+        self.next_hop_matrix = NextHopMatrix(self.network["Nodes"])
+        trees = self.path_engine.trees(network.graph)
+        for source, tree in trees.items():
+            self.store_tree(network.graph, source, tree)
+        self.recompute_seconds.observe(
+            time.perf_counter() - started, ("full",))
+        self.recomputed_trees.inc(len(trees))
+        self.write_routes(network)
+        if self.check_engine and self.path_engine.name != "dijkstra":
+            mismatches = cross_check(
+                network.graph, [get_path_engine("dijkstra"), self.path_engine])
+            print(f"Cross-check of {self.path_engine.name} against dijkstra: "
+                  f"{len(mismatches)} mismatching path costs")
+            for mismatch in mismatches[:10]:
+                print("    {} {} -> {}: {} != {}".format(*mismatch))
+
+    def update_shortest_paths(self, network, removed=(), added=()):
+        """
+        Brings the stored shortest path trees up to date after routers left
+        or rejoined the network.
+
+        Only the trees that went through a removed router are recomputed.
+        A rejoining router gets its own tree, and any other tree is
+        recomputed only if going through the new router is shorter than
+        what it already has.
+
+        Parameters
+        ----------
+        network : Network
+            The network, already updated.
+        removed : list, optional
+            The names of the routers that were removed.
+        added : list, optional
+            The names of the routers that were added.
+        """
+        if not self.incremental or not self.shortest_paths:
+            self.compute_all_shortest_paths(network)
+            return
+
+        started = time.perf_counter()
+        graph = network.graph
+        removed = set(removed)
+        stale = set()
+
+        for source in removed:
+            self.shortest_paths.pop(source, None)
+            self.distances.pop(source, None)
+            self.transit_nodes.pop(source, None)
+            self.next_hop_matrix.clear(source)
+
+        for source, transit in self.transit_nodes.items():
+            if transit & removed:
+                stale.add(source)
+            else:
+                # The removed routers were only leaves of this tree
+                for node in removed:
+                    self.shortest_paths[source].pop(node, None)
+                    self.distances[source].pop(node, None)
+
+        for new_node in added:
+            if new_node not in graph:
+                continue
+            self.store_tree(graph, new_node)
+            new_distances = self.distances[new_node]
+            for source, distances in self.distances.items():
+                if source == new_node or source in stale:
+                    continue
+                to_new = new_distances.get(source)
+                if to_new is None:
+                    continue
+                if any(to_new + cost < distances.get(destination, float("inf"))
+                       for destination, cost in new_distances.items()
+                       if destination not in (source, new_node)):
+                    stale.add(source)
+                else:
+                    # The new router is only a leaf of this tree
+                    path = list(reversed(self.shortest_paths[new_node][source]))
+                    self.distances[source][new_node] = to_new
+                    self.shortest_paths[source][new_node] = path
+                    self.next_hop_matrix.set_route(source, new_node, path[1])
+                    if len(path) > 2:
+                        self.transit_nodes[source].add(path[-2])
+
+        for source, tree in self.path_engine.trees(graph, stale).items():
+            self.store_tree(graph, source, tree)
+
+        self.recompute_seconds.observe(
+            time.perf_counter() - started, ("incremental",))
+        self.recomputed_trees.inc(len(stale) + len(added))
+        print(f"Recomputed {len(stale) + len(added)} of "
+              f"{len(self.shortest_paths)} shortest path trees")
+        self.write_routes(network)
+
+    def write_routes(self, network):
+        """
+        Writes the next hops to the route store, and every full path to
+        paths.json when asked to.
 
-        for source, destinations in all_paths.items():
-            for destination, path in destinations.items():
+        Parameters
+        ----------
+        network : Network
+            The network the trees belong to.
+        """
+        self.next_hop_matrix.save(self.routes_file)
+        if not self.paths_json:
+            return
+        the_json = []
+        for source in network.graph.nodes:
+            for destination, path in self.shortest_paths[source].items():
                 the_json.append(
                     {
                         "source": source,
@@ -121,23 +508,572 @@ class Controller:
                 )
         self.write_json(the_json)
 
-    def paths_updated(self, port):
+    def link_cost(self, first, second):
+        """
+        Returns the cost of the link between two routers, raised while the
+        link is congested.
+        """
+        cost = self.link_costs[first, second]
+        if self.congestion is not None:
+            cost *= self.congestion.multiplier(first, second)
+        return cost
+
+    def open_control_channel(self, router_name, router_socket, reader,
+                             session):
+        """
+        Keeps the registration connection of a router open to push route
+        updates over it, and starts sending them and listening for its
+        acknowledgements.
+
+        Parameters
+        ----------
+        router_name : str
+            The name of the router.
+        router_socket : socket
+            The connection the router registered with.
+        reader : file
+            The buffered reader of the connection.
+        session : int
+            The session the router opened the channel with.
+        """
+        outbox = queue.Queue()
+        with self.channels_lock:
+            old_socket = self.control_channels.get(router_name)
+            if old_socket is not None:
+                old_socket.close()
+                self.control_outboxes[router_name].put(None)
+            self.control_channels[router_name] = router_socket
+            self.control_sessions[router_name] = session
+            self.control_outboxes[router_name] = outbox
+            # A new channel always starts from an empty table
+            self.pushed_tables.pop(router_name, None)
+            self.acked_versions.pop(router_name, None)
+
+        send_thread = threading.Thread(
+            target=self.send_updates,
+            args=(router_name, router_socket, session, outbox), daemon=True)
+        send_thread.start()
+        ack_thread = threading.Thread(
+            target=self.listen_to_router, args=(router_name, reader, session))
+        ack_thread.start()
+
+    def close_control_channel(self, router_name):
+        """
+        Forgets the control channel of a router that left the network.
+
+        Parameters
+        ----------
+        router_name : str
+            The name of the router.
+        """
+        with self.channels_lock:
+            router_socket = self.control_channels.pop(router_name, None)
+            self.control_sessions.pop(router_name, None)
+            outbox = self.control_outboxes.pop(router_name, None)
+            if outbox is not None:
+                outbox.put(None)
+            self.pushed_tables.pop(router_name, None)
+            self.acked_versions.pop(router_name, None)
+            for awaiting in self.awaiting.values():
+                awaiting.discard(router_name)
+        if router_socket is not None:
+            router_socket.close()
+
+    def next_hop_table(self, source):
+        """
+        Extracts the forwarding table of a router from the next hop matrix.
+
+        Parameters
+        ----------
+        source : str
+            The name of the router.
+
+        Returns
+        -------
+        next_hops : dict
+            The next router for every reachable destination, or the
+            [next router, weight] of every path when there are several.
+        """
+        if source not in self.shortest_paths:
+            return {}
+        table = self.next_hop_matrix.next_hops(source)
+        if self.max_paths > 1:
+            for destination, next_router in table.items():
+                hops = self.multipath_hops(source, destination, next_router)
+                if len(hops) > 1:
+                    table[destination] = hops
+        return table
+
+    def multipath_hops(self, source, destination, next_router):
+        """
+        Finds the neighbors a router may send to for a destination besides
+        its shortest path. Only neighbors closer to the destination than
+        the router itself qualify, so every hop gets closer and no flow can
+        loop. Their path must also cost at most stretch times the shortest
+        one.
+
+        Parameters
+        ----------
+        source : str
+            The name of the router.
+        destination : str
+            The name of the destination.
+        next_router : str
+            The next router of the shortest path, always kept first.
+
+        Returns
+        -------
+        hops : list
+            The [next router, weight] of up to max_paths paths, weighted by
+            the bandwidth of the link towards the next router and the cost
+            of the shortest path over their own.
+        """
+        best = self.distances[source][destination]
+        # Relative tolerance so equal costs summed differently still match
+        bound = best * self.stretch * (1 + 1e-9)
+        candidates = []
+        for neighbor, attributes in self.nsfnet.graph[source].items():
+            if neighbor == next_router:
+                continue
+            remaining = self.distances.get(neighbor, {}).get(destination)
+            if remaining is None or remaining >= best:
+                continue
+            cost = attributes["weight"] + remaining
+            if cost <= bound:
+                candidates.append((cost, neighbor))
+        candidates.sort()
+        nodes = self.network["Nodes"]
+        hops = [(best, next_router)] + candidates[:self.max_paths - 1]
+        return [
+            [hop,
+             self.link_bandwidths[nodes[source], nodes[hop]] * best / cost]
+            for cost, hop in hops
+        ]
+
+    def backup_table(self, source):
+        """
+        Finds a backup for the next router of every destination of a router,
+        used when the next router dies and before any other router changed
+        its routes. It is a loop-free alternate when one of the neighbors
+        qualifies, a remote one the message is tunneled to otherwise.
+        Destinations that are neighbors have none, the next router being the
+        destination itself.
+
+        Parameters
+        ----------
+        source : str
+            The name of the router.
+
+        Returns
+        -------
+        backups : dict
+            The backup of every destination that has one, the cheapest when
+            several qualify.
         """
-        Sends the shortest paths information to a router at the specified port.
+        if not self.backup_routes:
+            return {}
+        if source not in self.shortest_paths:
+            return {}
+        backups = {}
+        for destination, next_router in \
+                self.next_hop_matrix.next_hops(source).items():
+            if next_router == destination:
+                continue
+            best = None
+            for neighbor, attributes in self.nsfnet.graph[source].items():
+                if neighbor != next_router and self.protects(
+                        neighbor, source, next_router, destination):
+                    cost = attributes["weight"] + \
+                        self.distances[neighbor][destination]
+                    if best is None or cost < best[0]:
+                        best = (cost, neighbor)
+            if best is None:
+                best = self.remote_backup(source, next_router, destination)
+            if best is not None:
+                backups[destination] = best[1]
+        return backups
+
+    def remote_backup(self, source, next_router, destination):
+        """
+        Finds a remote loop-free alternate: a router the shortest path of the
+        source reaches without crossing its next router, and whose own path
+        to the destination avoids both. The source tunnels the message to it
+        and it forwards the message on as usual.
 
         Parameters
         ----------
-        port : int
-            The port number of the router to which the shortest paths information
-            will be sent.
+        source : str
+            The name of the router.
+        next_router : str
+            The next router of the source towards the destination.
+        destination : str
+            The name of the destination.
+
+        Returns
+        -------
+        backup : tuple
+            The cost through the alternate and its name, None when no router
+            qualifies.
+        """
+        own = self.distances[source]
+        through_next = self.distances.get(next_router, {})
+        best = None
+        for node, distance in own.items():
+            if node in (source, next_router, destination):
+                continue
+            if distance >= own[next_router] + through_next.get(
+                    node, math.inf):
+                continue
+            if self.protects(node, source, next_router, destination):
+                cost = distance + self.distances[node][destination]
+                if best is None or cost < best[0]:
+                    best = (cost, node)
+        return best
 
+    def protects(self, node, source, next_router, destination):
+        """
+        Checks that the shortest path of a router to a destination neither
+        comes back through the source nor crosses its next router. A tie
+        may mean a shortest path through either, so it does not qualify.
         """
-        router_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        router_socket.connect(("localhost", port))
-        router_socket.sendall(self.fernet.encrypt("New Path".encode()))
-        router_socket.close()
+        distances = self.distances.get(node, {})
+        remaining = distances.get(destination)
+        if remaining is None:
+            return False
+        back_through_source = distances.get(source, math.inf) + \
+            self.distances[source][destination]
+        through_next_router = distances.get(next_router, math.inf) + \
+            self.distances.get(next_router, {}).get(destination, math.inf)
+        return remaining < back_through_source and \
+            remaining < through_next_router
 
-    def send_to_server(self, server_host, server_port, message):
+    def route_update(self, router_name, version):
+        """
+        Builds the routes version of a router: its whole table the first
+        time, only the changes from the table it last got afterwards.
+
+        Parameters
+        ----------
+        router_name : str
+            The name of the router.
+        version : int
+            The routes version.
+
+        Returns
+        -------
+        update : dict
+            The routes version to send.
+        tables : tuple
+            The next hops and the backup next hops of the router once the
+            update is applied.
+        """
+        table = self.next_hop_table(router_name)
+        backups = self.backup_table(router_name)
+        previous = self.pushed_tables.get(router_name)
+        if previous is None:
+            update = {"version": version, "full": True, "routes": table}
+            if self.backup_routes:
+                update["backups"] = backups
+            return update, (table, backups)
+        previous_table, previous_backups = previous
+        routes, removed = table_changes(previous_table, table)
+        update = {
+            "version": version,
+            "full": False,
+            "routes": routes,
+            "removed": removed,
+        }
+        if self.backup_routes:
+            update["backups"], update["removed_backups"] = table_changes(
+                previous_backups, backups)
+        return update, (table, backups)
+
+    def push_routes(self):
+        """
+        Sends every live router the changes of its forwarding table as a new
+        routes version. Routers whose table did not change still get the
+        version so convergence can be measured over every live router.
+        """
+        with self.channels_lock:
+            self.routes_version += 1
+            version = self.routes_version
+            self.version_started[version] = self.clock()
+            self.awaiting[version] = set()
+
+            for router_name in list(self.control_channels):
+                if router_name not in self.shortest_paths:
+                    continue
+                update, tables = self.route_update(router_name, version)
+                if self.send_update(router_name, update):
+                    self.pushed_tables[router_name] = tables
+                    self.awaiting[version].add(router_name)
+
+    def send_update(self, router_name, update):
+        """
+        Queues a routes version for the control channel of a router. The
+        channel sends it on its own thread, so a router that reads slowly
+        does not hold the locks the routes are pushed under.
+
+        Parameters
+        ----------
+        router_name : str
+            The name of the router.
+        update : dict
+            The routes version.
+
+        Returns
+        -------
+        sent : bool
+            Whether the routes version was queued.
+        """
+        self.control_outboxes[router_name].put(update)
+        return True
+
+    def send_updates(self, router_name, router_socket, session, outbox):
+        """
+        Sends the routes versions queued for a router over its control
+        channel, in order, until the channel is closed or replaced.
+
+        Parameters
+        ----------
+        router_name : str
+            The name of the router.
+        router_socket : socket
+            The control channel.
+        session : int
+            The session of the control channel.
+        outbox : queue.Queue
+            The routes versions to send, None once the channel is closed.
+        """
+        while True:
+            update = outbox.get()
+            if update is None:
+                return
+            try:
+                payload = self.cipher.encrypt(
+                    json.dumps(update).encode(), session)
+                send_frame(router_socket,
+                           Header(KIND_CONTROL, flow_id=session), payload)
+            except OSError:
+                print(f"Could not push routes to {router_name}")
+                with self.channels_lock:
+                    if self.control_channels.get(router_name) is not \
+                            router_socket:
+                        continue
+                    # The router missed this version, it gets its whole
+                    # table with the next one and is not waited for
+                    self.pushed_tables.pop(router_name, None)
+                    for version, awaiting in self.awaiting.items():
+                        if version >= update["version"]:
+                            awaiting.discard(router_name)
+
+    def listen_to_router(self, router_name, reader, session):
+        """
+        Reads the acknowledgements a router sends over its control channel and
+        reports when a routes version has reached every live router. The
+        router also reports there the clients that register with it.
+
+        Parameters
+        ----------
+        router_name : str
+            The name of the router.
+        reader : file
+            The buffered reader of the control channel.
+        session : int
+            The session of the control channel.
+        """
+        try:
+            while True:
+                header, payload = read_frame(reader)
+                if header is None:
+                    break
+                answer = json.loads(
+                    self.cipher.decrypt(payload, session).decode())
+                if "register" in answer:
+                    self.register_client(answer["register"], answer["router"])
+                elif "utilization" in answer:
+                    self.link_utilization(router_name, answer["utilization"])
+                else:
+                    self.route_acknowledged(router_name, answer["ack"])
+        except (OSError, ValueError):
+            pass
+
+    def link_utilization(self, router_name, utilization):
+        """
+        Feeds the link utilization a router reported to the congestion
+        tracker, and moves routes away from the links that became congested
+        or back to those that cleared.
+
+        Parameters
+        ----------
+        router_name : str
+            The name of the router.
+        utilization : dict
+            The utilization of the link towards every neighbor.
+        """
+        if self.congestion is None:
+            return
+        changed = self.congestion.report(
+            router_name, utilization, self.clock())
+        if not changed:
+            return
+        with self.routes_lock:
+            for (first, second), multiplier in changed.items():
+                if not self.nsfnet.graph.has_edge(first, second):
+                    continue
+                self.nsfnet.set_link_bandwidth(
+                    first, second, self.link_costs[first, second] * multiplier)
+                state = "congested" if multiplier > 1 else "clear"
+                self.link_changes.inc(1, (state,))
+                print(f"Link {first}-{second} is {state}")
+            self.compute_all_shortest_paths(self.nsfnet)
+            self.push_routes()
+
+    def register_client(self, client_port, router_name):
+        """
+        Records the router a client registered with and tells the clients
+        that cached its previous router to forget it.
+
+        Parameters
+        ----------
+        client_port : str
+            The port the client listens on.
+        router_name : str
+            The router the client registered with.
+        """
+        watchers = self.directory.register(client_port, router_name)
+        print(f"Client {client_port} registered with {router_name}")
+        if watchers:
+            notify_thread = threading.Thread(
+                target=self.invalidate_client, args=(client_port, watchers))
+            notify_thread.start()
+
+    def invalidate_client(self, client_port, watchers):
+        """
+        Tells clients that the router of a client changed.
+
+        Parameters
+        ----------
+        client_port : str
+            The port of the client that moved.
+        watchers : list
+            The ports of the clients that cached its router.
+        """
+        message = json.dumps({"invalidate": client_port}).encode()
+        for watcher in watchers:
+            try:
+                with self.pool.connection("localhost", int(watcher),
+                                          self.probe_timeout) as connection:
+                    send_frame(connection,
+                               Header(KIND_CONTROL, flow_id=self.session),
+                               self.cipher.encrypt(message, self.session))
+            except OSError:
+                # A client that is gone has no cache left to fix
+                pass
+
+    def serve_client(self, client_socket, reader, header, request):
+        """
+        Answers the client directory lookups and topology requests of a
+        connection until the client closes it.
+
+        Parameters
+        ----------
+        client_socket : socket
+            The connection of the client.
+        reader : file
+            The buffered reader of the connection.
+        header : Header
+            The header of the first request.
+        request : str
+            The first request, already decrypted.
+        """
+        try:
+            while True:
+                request = json.loads(request)
+                if "snapshot" in request:
+                    answer = self.topology_answer(request["snapshot"])
+                else:
+                    answer = json.dumps({
+                        "router": self.directory.lookup(
+                            request["lookup"], request.get("watcher"))
+                    }).encode()
+                send_frame(client_socket,
+                           Header(KIND_CONTROL, flow_id=header.flow_id),
+                           self.cipher.encrypt(answer, header.flow_id))
+
+                header, payload = read_frame(reader)
+                if header is None:
+                    break
+                request = self.cipher.decrypt(payload, header.flow_id).decode()
+        except (OSError, ValueError, KeyError) as error:
+            print(f"Dropping client connection: {error}")
+        finally:
+            client_socket.close()
+
+    def topology_answer(self, etag):
+        """
+        Answers a topology request, sending the snapshot only when the
+        topology changed since the one the client has.
+
+        Parameters
+        ----------
+        etag : str
+            The tag of the snapshot the client has, or None.
+
+        Returns
+        -------
+        answer : bytes
+            The JSON answer with the current tag and, if it changed, the
+            snapshot.
+        """
+        with self.routes_lock:
+            version = self.nsfnet.version
+            if self.snapshot is None or self.snapshot[0] != version:
+                # The session tells apart versions of two controller runs
+                self.snapshot = (
+                    version, f"{self.session:016x}-{version}",
+                    json.dumps(self.nsfnet.to_snapshot(),
+                               separators=(",", ":")).encode())
+            _, current, topology = self.snapshot
+        if etag == current:
+            return json.dumps({"etag": current}).encode()
+        return (b'{"etag":"' + current.encode() + b'","topology":'
+                + topology + b'}')
+
+    def route_acknowledged(self, router_name, version):
+        """
+        Records that a router applied a routes version.
+
+        Parameters
+        ----------
+        router_name : str
+            The name of the router.
+        version : int
+            The routes version the router acknowledged.
+        """
+        with self.channels_lock:
+            if router_name not in self.control_channels:
+                return
+            self.acked_versions[router_name] = version
+            converged = None
+            # A version acknowledges the older ones too
+            for pushed in [v for v in self.awaiting if v <= version]:
+                self.awaiting[pushed].discard(router_name)
+                if not self.awaiting[pushed]:
+                    converged = pushed
+            if converged is None:
+                return
+            elapsed = self.clock() - self.version_started[converged]
+            self.convergence_times.append(elapsed)
+            self.convergence_seconds.observe(elapsed)
+            # Older versions are covered by this one
+            for old_version in [v for v in self.awaiting if v <= converged]:
+                del self.awaiting[old_version]
+                del self.version_started[old_version]
+            print(f"Routes version {converged} converged in "
+                  f"{elapsed * 1000:.1f} ms")
+
+    def send_to_server(self, server_host, server_port, message, timeout=None):
         """
         Sends a message to the server and returns the response.
 
@@ -149,6 +1085,9 @@ class Controller:
                 The port number of the server.
             message : str
                 The message to be sent to the server.
+            timeout : float, optional
+                Seconds to connect and to wait for the response, forever when
+                not given.
 
         Returns
         -------
@@ -156,23 +1095,71 @@ class Controller:
                 The response from the server.
         """
         try:
-            # Create a TCP client socket
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # Connect to the server
-            server_socket.connect((server_host, server_port))
-            # Send the message to the server
-            server_socket.sendall(self.fernet.encrypt(message.encode()))
-            # Receive a response from the server
-            server_response = self.fernet.decrypt(
-                server_socket.recv(1024)).decode()
-            server_socket.close()
-            return server_response
-        except ConnectionRefusedError:
-            server_socket.close()
+            with self.pool.connection(
+                    server_host, server_port, timeout) as server_socket:
+                server_socket.settimeout(timeout)
+                # Send the message to the server
+                send_frame(server_socket,
+                           Header(KIND_CONTROL, flow_id=self.session),
+                           self.cipher.encrypt(message.encode(), self.session))
+                # Receive a response from the server, unbuffered so nothing
+                # is lost when the connection goes back to the pool
+                header, server_response = read_frame(
+                    server_socket.makefile("rb", buffering=0))
+                if header is None:
+                    raise ConnectionResetError
+                server_socket.settimeout(None)
+            return self.cipher.decrypt(server_response, self.session).decode()
+        except (OSError, ProtocolError):
             return "no response"
-        finally:
-            # Close the client socket
-            server_socket.close()
+
+    def probe_router(self, port):
+        """
+        Checks whether a router answers within the probe timeout.
+
+        Parameters
+        ----------
+            port : int
+                The port number of the router.
+
+        Returns
+        -------
+            alive : bool
+                Whether the router answered in time.
+        """
+        started = time.perf_counter()
+        status = self.send_to_server(
+            "localhost", port, "ACK", timeout=self.probe_timeout)
+        if status == "no response":
+            self.probe_failures.inc(1, (self.port_names[port],))
+            return False
+        self.probe_seconds.observe(time.perf_counter() - started)
+        return True
+
+    def remove_routers(self, router_names):
+        """
+        Takes routers declared down out of the network and pushes the new
+        routes, every router of a round of checks in a single recompute.
+
+        Parameters
+        ----------
+        router_names : list
+            The names of the routers that are down.
+        """
+        self.failures_detected.inc(len(router_names))
+        for latency in self.health.detection_latencies[-len(router_names):]:
+            self.detection_seconds.observe(latency)
+        with self.routes_lock:
+            for router_name in router_names:
+                self.nsfnet.remove_node(self.network["Nodes"][router_name])
+                self.node_ports.remove(self.network["Ports"][router_name])
+                self.routers_quantity -= 1
+                if self.congestion is not None:
+                    self.congestion.forget(router_name)
+            self.update_shortest_paths(self.nsfnet, removed=router_names)
+            for router_name in router_names:
+                self.close_control_channel(router_name)
+            self.push_routes()
 
     def check_nodes_status(self):
         """
@@ -180,24 +1167,18 @@ class Controller:
         if a node is down.
         """
         while True:
-            time.sleep(10)
-            for port in self.node_ports:
-                status = self.send_to_server(
-                    "localhost", port, "ACK")
-                if status == "no response":
-                    node_id = self.node_ports.index(port) + 1
-                    self.nsfnet.remove_node(node_id)
-                    self.node_ports.remove(port)
-                    self.routers_quantity -= 1
-                    self.compute_all_shortest_paths(self.nsfnet)
-
-                    for good_port in self.node_ports:
-                        if good_port != port:
-                            path_thread = threading.Thread(
-                                target=self.paths_updated, args=(good_port, ))
-                            path_thread.start()
-
-            print("check completed")
+            started = time.monotonic()
+            failed_ports = self.health.check(list(self.node_ports))
+
+            if failed_ports:
+                removed = [self.port_names[port] for port in failed_ports]
+                self.remove_routers(removed)
+                latencies = self.health.detection_latencies[-len(removed):]
+                print(f"Detected {', '.join(removed)} down after "
+                      f"{max(latencies) * 1000:.0f} ms without answer")
+
+            time.sleep(max(0.0, self.health.interval -
+                           (time.monotonic() - started)))
 
     def read_json(self, filename):
         """
@@ -230,11 +1211,106 @@ class Controller:
                 the name of the file (default is "paths.json")
         """
 
-        with open(filename, 'w', encoding='utf-8-sig') as file:
+        # Write next to the target and swap it in, so readers never see a
+        # half written file
+        temp_filename = f"{filename}.tmp"
+        with open(temp_filename, 'w', encoding='utf-8-sig') as file:
             # Convert Python dictionary to JSON and write to file
             json.dump(data, file, indent=4)
+        os.replace(temp_filename, filename)
+
+
+def table_changes(previous, table):
+    """
+    Compares two tables of a router.
+
+    Parameters
+    ----------
+    previous : dict
+        The table the router has.
+    table : dict
+        The table it should have.
+
+    Returns
+    -------
+    changed : dict
+        The entries that are new or differ.
+    removed : list
+        The destinations that are gone.
+    """
+    changed = {
+        destination: entry for destination, entry in table.items()
+        if previous.get(destination) != entry
+    }
+    removed = [
+        destination for destination in previous if destination not in table]
+    return changed, removed
 
 
 if __name__ == "__main__":
-    controller = Controller(8888)
+    parser = argparse.ArgumentParser(description="Start the controller.")
+    parser.add_argument(
+        "--check-interval", type=float, default=0.25,
+        help="seconds between two rounds of status checks")
+    parser.add_argument(
+        "--probe-timeout", type=float, default=0.2,
+        help="seconds a router has to answer a status check")
+    parser.add_argument(
+        "--detector", choices=["phi", "missed"], default="phi",
+        help="phi accrual or consecutive missed checks failure detector")
+    parser.add_argument(
+        "--phi-threshold", type=float, default=8.0,
+        help="suspicion level that declares a router down")
+    parser.add_argument(
+        "--max-missed", type=int, default=3,
+        help="missed checks that declare a router down")
+    parser.add_argument(
+        "--paths-json", action="store_true",
+        help="also write every full path to paths.json")
+    parser.add_argument(
+        "--path-engine", choices=sorted(PATH_ENGINES),
+        help="shortest path engine, asked for when not given")
+    parser.add_argument(
+        "--cross-check", action="store_true",
+        help="compare the path costs of the engine with dijkstra")
+    parser.add_argument(
+        "--workers", type=int,
+        help="worker processes of the parallel path engine")
+    parser.add_argument(
+        "--max-paths", type=int, default=1,
+        help="next hops a router may spread flows over per destination")
+    parser.add_argument(
+        "--stretch", type=float, default=1.0,
+        help="cost of the other paths relative to the shortest, at most")
+    parser.add_argument(
+        "--congestion-aware", action="store_true",
+        help="raise the cost of the links routers report congested")
+    parser.add_argument(
+        "--congestion-high", type=float, default=0.8,
+        help="link utilization above which a link is congested")
+    parser.add_argument(
+        "--congestion-low", type=float, default=0.5,
+        help="link utilization below which a congested link is clear")
+    parser.add_argument(
+        "--backup-routes", action="store_true",
+        help="send routers a loop-free alternate next hop per destination")
+    parser.add_argument(
+        "--metrics-port", type=int,
+        help="serve the metrics over HTTP on this port")
+    args = parser.parse_args()
+
+    congestion = None
+    if args.congestion_aware:
+        congestion = CongestionTracker(
+            args.congestion_high, args.congestion_low)
+    controller = Controller(
+        8888, check_interval=args.check_interval,
+        probe_timeout=args.probe_timeout, detector=args.detector,
+        phi_threshold=args.phi_threshold, max_missed=args.max_missed,
+        algorithm=args.path_engine, paths_json=args.paths_json,
+        check_engine=args.cross_check, workers=args.workers,
+        max_paths=args.max_paths, stretch=args.stretch,
+        congestion=congestion, backup_routes=args.backup_routes)
+    if args.metrics_port is not None:
+        controller.metrics.serve(args.metrics_port)
     controller.start()
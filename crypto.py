@@ -0,0 +1,296 @@
+import os
+import base64
+import threading
+from collections import OrderedDict
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from protocol import ProtocolError
+
+# The key every node of the network is configured with
+MASTER_KEY = base64.urlsafe_b64decode(
+    b'HcEnve-04K7wN5sgrz1JgKufDMIYBbbTXr0Wueg3v7I=')
+NONCE_SIZE = 12
+TAG_SIZE = 16
+# Random bytes the sender of a session mixes into the derivation of its key
+SALT_SIZE = 16
+# Plaintext bytes per authenticated chunk of a stream
+STREAM_CHUNK_SIZE = 65536
+SEALED_CHUNK_SIZE = STREAM_CHUNK_SIZE + TAG_SIZE
+
+
+class CryptoError(ProtocolError):
+    """
+    Raised when a payload cannot be authenticated.
+    """
+
+
+def sealed_length(size):
+    """
+    Computes the length of a stream once encrypted.
+
+    Parameters
+    ----------
+        size : int
+            the number of plaintext bytes
+
+    Returns
+    -------
+        length : int
+            the number of bytes sent for them
+    """
+    chunks = max(1, -(-size // STREAM_CHUNK_SIZE))
+    return SALT_SIZE + size + chunks * TAG_SIZE
+
+
+def plain_length(length):
+    """
+    Computes the length of a stream once decrypted.
+
+    Parameters
+    ----------
+        length : int
+            the number of encrypted bytes
+
+    Returns
+    -------
+        size : int
+            the number of plaintext bytes they hold
+    """
+    sealed = length - SALT_SIZE
+    chunks = max(1, -(-sealed // SEALED_CHUNK_SIZE))
+    size = sealed - chunks * TAG_SIZE
+    if size < 0 or sealed_length(size) != length:
+        raise CryptoError(f"No stream is {length} bytes long once encrypted")
+    return size
+
+
+class StreamCipher:
+    """
+    Encrypts or decrypts a stream as a sequence of authenticated chunks, so
+    every chunk can be forwarded and checked as soon as it is complete.
+
+    The nonce of a chunk is its position in the stream plus a flag on the
+    last one, so chunks cannot be reordered, dropped or cut short without
+    the receiver noticing. The stream starts with the salt of its key, sent
+    in the clear before the first chunk.
+    """
+
+    def __init__(self, aead, salt):
+        """
+        Constructs all the necessary attributes for the stream object.
+
+        Parameters
+        ----------
+            aead : ChaCha20Poly1305
+                the cipher keyed for this stream only
+            salt : bytes
+                the salt the key was derived with
+        """
+        self.aead = aead
+        self.salt = salt
+        self.counter = 0
+        self.finished = False
+
+    def nonce(self, last):
+        """
+        Returns the nonce of the next chunk.
+        """
+        if self.finished:
+            raise CryptoError("Chunk after the end of the stream")
+        self.finished = last
+        nonce = self.counter.to_bytes(NONCE_SIZE - 1, "big") + bytes([last])
+        self.counter += 1
+        return nonce
+
+    def seal(self, chunk, last):
+        """
+        Encrypts the next chunk of the stream.
+
+        Parameters
+        ----------
+            chunk : bytes-like
+                at most STREAM_CHUNK_SIZE plaintext bytes
+            last : bool
+                whether the chunk ends the stream
+
+        Returns
+        -------
+            data : bytes
+                the encrypted chunk followed by its tag
+        """
+        return self.aead.encrypt(self.nonce(last), chunk, None)
+
+    def open(self, chunk, last):
+        """
+        Decrypts and authenticates the next chunk of the stream.
+
+        Parameters
+        ----------
+            chunk : bytes-like
+                an encrypted chunk followed by its tag
+            last : bool
+                whether the chunk ends the stream
+
+        Returns
+        -------
+            data : bytes
+                the plaintext of the chunk
+        """
+        try:
+            return self.aead.decrypt(self.nonce(last), chunk, None)
+        except InvalidTag as error:
+            raise CryptoError("Stream chunk failed authentication") from error
+
+
+class SessionCipher:
+    """
+    A class to encrypt payloads with keys derived from the master key.
+
+    Every session, identified by the flow id of its frames, gets its own
+    ChaCha20-Poly1305 key through HKDF, so no two connections or flows
+    share a key and nothing has to be exchanged to agree on it. The sender
+    of a session also draws a random salt for it, mixed into the key and
+    carried at the start of every payload, so a flow id seen again, after
+    a restart or a collision, never brings back a key already used.
+    Derived keys are cached, since a control channel or a flow reuses its
+    session for every frame.
+    """
+
+    def __init__(self, master_key=MASTER_KEY, cache_size=4096):
+        """
+        Constructs all the necessary attributes for the cipher object.
+
+        Parameters
+        ----------
+            master_key : bytes, optional
+                the key shared by every node of the network
+            cache_size : int, optional
+                the number of derived keys kept (default is 4096)
+        """
+        self.master_key = master_key
+        self.cache_size = cache_size
+        self.keys = OrderedDict()
+        # The salt of each session this node sends on
+        self.salts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def salt(self, session):
+        """
+        Returns the salt this node sends a session with, drawing it the
+        first time.
+        """
+        with self.lock:
+            salt = self.salts.get(session)
+            if salt is None:
+                salt = self.salts[session] = os.urandom(SALT_SIZE)
+                if len(self.salts) > self.cache_size:
+                    self.salts.popitem(last=False)
+            else:
+                self.salts.move_to_end(session)
+        return salt
+
+    def key(self, purpose, session, salt):
+        """
+        Returns the cipher of a session, deriving its key the first time.
+
+        Parameters
+        ----------
+            purpose : bytes
+                b"message" or b"stream", so the two never share a key
+            session : int
+                the flow id of the session
+            salt : bytes
+                the salt its sender drew for the session
+
+        Returns
+        -------
+            aead : ChaCha20Poly1305
+                the cipher keyed for the session
+        """
+        name = (purpose, session, salt)
+        with self.lock:
+            aead = self.keys.get(name)
+            if aead is not None:
+                self.keys.move_to_end(name)
+                return aead
+
+        info = b"TN " + purpose + b" " + session.to_bytes(8, "big") + salt
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                   info=info).derive(self.master_key)
+        aead = ChaCha20Poly1305(key)
+        with self.lock:
+            self.keys[name] = aead
+            if len(self.keys) > self.cache_size:
+                self.keys.popitem(last=False)
+        return aead
+
+    def encrypt(self, data, session=0):
+        """
+        Encrypts a whole message.
+
+        Parameters
+        ----------
+            data : bytes
+                the message
+            session : int, optional
+                the flow id of the frame carrying it
+
+        Returns
+        -------
+            payload : bytes
+                the salt of the session, a random nonce, the encrypted
+                message and its tag
+        """
+        salt = self.salt(session)
+        nonce = os.urandom(NONCE_SIZE)
+        return salt + nonce + self.key(b"message", session, salt).encrypt(
+            nonce, data, None)
+
+    def decrypt(self, payload, session=0):
+        """
+        Decrypts and authenticates a whole message.
+
+        Parameters
+        ----------
+            payload : bytes
+                what encrypt returned
+            session : int, optional
+                the flow id of the frame carrying it
+
+        Returns
+        -------
+            data : bytes
+                the message
+        """
+        if len(payload) < SALT_SIZE + NONCE_SIZE + TAG_SIZE:
+            raise CryptoError("Encrypted payload is too short")
+        salt = bytes(payload[:SALT_SIZE])
+        sealed = SALT_SIZE + NONCE_SIZE
+        try:
+            return self.key(b"message", session, salt).decrypt(
+                payload[SALT_SIZE:sealed], payload[sealed:], None)
+        except InvalidTag as error:
+            raise CryptoError("Payload failed authentication") from error
+
+    def stream(self, session, salt=None):
+        """
+        Starts encrypting or decrypting the stream of a flow.
+
+        Parameters
+        ----------
+            session : int
+                the flow id of the stream, used for no other stream
+            salt : bytes, optional
+                the salt read at the start of a stream being received, a
+                new one is drawn for a stream being sent when not given
+
+        Returns
+        -------
+            stream : StreamCipher
+                the cipher of the stream
+        """
+        if salt is None:
+            salt = os.urandom(SALT_SIZE)
+        return StreamCipher(self.key(b"stream", session, salt), salt)
@@ -0,0 +1,270 @@
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PhiAccrualDetector:
+    """
+    A failure detector that turns the time since the last heartbeat into a
+    suspicion level phi, based on the intervals seen so far. A node that
+    usually answers every second is suspected much sooner than a node that
+    is always slow, and a single late answer does not mark it as down.
+    """
+
+    def __init__(self, threshold=8.0, expected_interval=1.0, window=100,
+                 min_std_deviation=0.1, acceptable_pause=0.0):
+        """
+        Constructs all the necessary attributes for the detector object.
+
+        Parameters
+        ----------
+            threshold : float, optional
+                phi above which a node is considered down (default is 8)
+            expected_interval : float, optional
+                seconds between heartbeats assumed before any was measured
+                (default is 1)
+            window : int, optional
+                number of intervals kept per node (default is 100)
+            min_std_deviation : float, optional
+                lower bound of the standard deviation in seconds, so perfectly
+                regular heartbeats do not make phi explode (default is 0.1)
+            acceptable_pause : float, optional
+                extra seconds tolerated on top of the mean interval (default
+                is 0)
+        """
+        self.threshold = threshold
+        self.expected_interval = expected_interval
+        self.window = window
+        self.min_std_deviation = min_std_deviation
+        self.acceptable_pause = acceptable_pause
+        self.intervals = {}
+        self.last_heartbeats = {}
+
+    def report(self, node, alive, now):
+        """
+        Records the result of a probe.
+
+        Parameters
+        ----------
+            node : hashable
+                the probed node
+            alive : bool
+                whether the node answered
+            now : float
+                the monotonic time of the answer
+        """
+        if not alive:
+            return
+        last = self.last_heartbeats.get(node)
+        if last is not None:
+            self.intervals.setdefault(
+                node, deque(maxlen=self.window)).append(now - last)
+        self.last_heartbeats[node] = now
+
+    def phi(self, node, now):
+        """
+        Computes the suspicion level of a node.
+
+        Parameters
+        ----------
+            node : hashable
+                the node
+            now : float
+                the current monotonic time
+
+        Returns
+        -------
+            phi : float
+                -log10 of the probability that a heartbeat is still coming
+        """
+        last = self.last_heartbeats.get(node)
+        if last is None:
+            return 0.0
+        intervals = self.intervals.get(node)
+        if intervals:
+            mean = sum(intervals) / len(intervals)
+            variance = sum((i - mean) ** 2 for i in intervals) / len(intervals)
+        else:
+            mean = self.expected_interval
+            variance = (self.expected_interval / 4) ** 2
+        std_deviation = max(math.sqrt(variance), self.min_std_deviation)
+        mean += self.acceptable_pause
+
+        # Logistic approximation of the normal CDF
+        y = (now - last - mean) / std_deviation
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if now - last > mean:
+            return -math.log10(e / (1.0 + e))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+    def is_down(self, node, now):
+        """
+        Tells whether a node should be considered down.
+        """
+        return self.phi(node, now) > self.threshold
+
+    def last_heartbeat(self, node):
+        """
+        Returns the time of the last heartbeat of a node, or None.
+        """
+        return self.last_heartbeats.get(node)
+
+    def forget(self, node):
+        """
+        Drops the history of a node.
+        """
+        self.intervals.pop(node, None)
+        self.last_heartbeats.pop(node, None)
+
+
+class MissedHeartbeatsDetector:
+    """
+    A failure detector that considers a node down after a number of
+    consecutive probes without answer.
+    """
+
+    def __init__(self, max_missed=3):
+        """
+        Constructs all the necessary attributes for the detector object.
+
+        Parameters
+        ----------
+            max_missed : int, optional
+                consecutive missed heartbeats before a node is considered
+                down (default is 3)
+        """
+        self.max_missed = max_missed
+        self.missed = {}
+        self.last_heartbeats = {}
+
+    def report(self, node, alive, now):
+        """
+        Records the result of a probe.
+
+        Parameters
+        ----------
+            node : hashable
+                the probed node
+            alive : bool
+                whether the node answered
+            now : float
+                the monotonic time of the answer
+        """
+        if alive:
+            self.missed[node] = 0
+            self.last_heartbeats[node] = now
+        else:
+            self.missed[node] = self.missed.get(node, 0) + 1
+
+    def is_down(self, node, now):
+        """
+        Tells whether a node should be considered down.
+        """
+        return self.missed.get(node, 0) >= self.max_missed
+
+    def last_heartbeat(self, node):
+        """
+        Returns the time of the last heartbeat of a node, or None.
+        """
+        return self.last_heartbeats.get(node)
+
+    def forget(self, node):
+        """
+        Drops the history of a node.
+        """
+        self.missed.pop(node, None)
+        self.last_heartbeats.pop(node, None)
+
+
+class HealthChecker:
+    """
+    A class to probe many nodes at once, each probe bounded by its own
+    deadline, and decide which ones failed through a failure detector.
+    """
+
+    def __init__(self, probe, detector, interval=1.0, max_workers=64):
+        """
+        Constructs all the necessary attributes for the checker object.
+
+        Parameters
+        ----------
+            probe : callable
+                takes a node and returns whether it answered; it must give
+                up on its own once its deadline passes
+            detector : PhiAccrualDetector or MissedHeartbeatsDetector
+                decides when a node that stopped answering is down
+            interval : float, optional
+                seconds between two rounds of probes (default is 1)
+            max_workers : int, optional
+                maximum number of probes in flight (default is 64)
+        """
+        self.probe = probe
+        self.detector = detector
+        self.interval = interval
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.detection_latencies = []
+
+    def check(self, nodes):
+        """
+        Probes every node concurrently and returns those now considered down.
+
+        Parameters
+        ----------
+            nodes : list
+                the nodes to probe
+
+        Returns
+        -------
+            failed : list
+                the nodes the detector declared down in this round
+        """
+        started = time.monotonic()
+        results = list(self.executor.map(self.probe, nodes))
+        return self.record(nodes, results, started, time.monotonic())
+
+    def record(self, nodes, results, started, now):
+        """
+        Feeds the results of a round of probes to the detector and returns
+        the nodes now considered down. The times may come from any clock,
+        such as the virtual clock of a simulation.
+
+        Parameters
+        ----------
+            nodes : list
+                the probed nodes
+            results : list
+                whether each node answered
+            started : float
+                the time the round started
+            now : float
+                the time the round ended
+
+        Returns
+        -------
+            failed : list
+                the nodes the detector declared down in this round
+        """
+        for node in nodes:
+            # A node seen for the first time counts as just heard from
+            if self.detector.last_heartbeat(node) is None:
+                self.detector.report(node, True, started)
+
+        for node, alive in zip(nodes, results):
+            self.detector.report(node, alive, now)
+
+        failed = []
+        for node in nodes:
+            if self.detector.is_down(node, now):
+                # Time from the last answer until the failure was declared
+                self.detection_latencies.append(
+                    now - self.detector.last_heartbeat(node))
+                self.detector.forget(node)
+                failed.append(node)
+        return failed
+
+    def forget(self, node):
+        """
+        Stops tracking a node, for instance once it left the network.
+        """
+        self.detector.forget(node)
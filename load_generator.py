@@ -0,0 +1,561 @@
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from array import array
+import numpy as np
+from client import TCPClient
+from crypto import SALT_SIZE, SEALED_CHUNK_SIZE
+from protocol import (
+    KIND_AUDIO, KIND_CONTROL, KIND_TEXT, ProtocolError, read_exact, read_header)
+from topology_generator import CLIENT_PORTS, FIRST_CLIENT_PORT
+
+# Latency histogram buckets, in milliseconds
+HISTOGRAM_EDGES = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+                   1000, 2500, 5000]
+
+
+def parse_distribution(spec, rng):
+    """
+    Builds a random variable from its description.
+
+    Parameters
+    ----------
+        spec : str
+            'fixed:value', 'uniform:low:high', 'exponential:mean' or
+            'lognormal:median:sigma'
+        rng : random.Random
+            the random generator
+
+    Returns
+    -------
+        draw : callable
+            returns a new value every call
+    """
+    name, *values = spec.split(":")
+    try:
+        values = [float(value) for value in values]
+        if name == "fixed":
+            value, = values
+            return lambda: value
+        if name == "uniform":
+            low, high = values
+            return lambda: rng.uniform(low, high)
+        if name == "exponential":
+            mean, = values
+            return lambda: rng.expovariate(1 / mean)
+        if name == "lognormal":
+            median, sigma = values
+            return lambda: rng.lognormvariate(math.log(median), sigma)
+    except ValueError:
+        pass
+    raise ValueError(
+        f"Invalid distribution {spec!r}, use fixed:value, uniform:low:high, "
+        "exponential:mean or lognormal:median:sigma.")
+
+
+class PayloadReader:
+    """
+    A file-like object giving a number of filler bytes, to stream audios of
+    any size without files.
+    """
+
+    def __init__(self, size):
+        """
+        Constructs all the necessary attributes for the reader object.
+
+        Parameters
+        ----------
+            size : int
+                the number of bytes to give
+        """
+        self.remaining = size
+
+    def readinto(self, buffer):
+        read = min(len(buffer), self.remaining)
+        self.remaining -= read
+        return read
+
+
+class FlowStats:
+    """
+    The messages between two routers: how many were sent and received, and
+    the latency of each one received.
+    """
+
+    def __init__(self):
+        """
+        Constructs all the necessary attributes for the stats object.
+        """
+        self.sent = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.latencies = array("d")
+
+    def summary(self, duration):
+        """
+        Sums up the flow.
+
+        Parameters
+        ----------
+            duration : float
+                the seconds the traffic lasted
+
+        Returns
+        -------
+            summary : dict
+                the counts, the loss, the throughput and the latency
+                percentiles in milliseconds
+        """
+        summary = {
+            "sent": self.sent,
+            "received": self.received,
+            "loss": 1 - self.received / self.sent if self.sent else 0.0,
+            "throughput_mbps": 8 * self.received_bytes / duration / 1e6,
+        }
+        if self.latencies:
+            latencies = np.frombuffer(self.latencies, dtype=np.float64) * 1000
+            for name, percentile in (("p50", 50), ("p99", 99),
+                                     ("p999", 99.9)):
+                summary[f"{name}_ms"] = float(
+                    np.percentile(latencies, percentile))
+        return summary
+
+
+class VirtualClient(TCPClient):
+    """
+    A client without prompts or visualization. It records the messages it
+    receives instead of printing them.
+    """
+
+    def __init__(self, generator, router_name, client_port):
+        """
+        Constructs all the necessary attributes for the client object.
+
+        Parameters
+        ----------
+            generator : LoadGenerator
+                the generator it reports its messages to
+            router_name : str
+                the router it connects to
+            client_port : int
+                the port it listens on
+        """
+        super().__init__(router_name, f"load{client_port}", client_port)
+        self.generator = generator
+
+    def handle_reception(self, new_socket):
+        reader = new_socket.makefile("rb")
+        buffer = bytearray(SEALED_CHUNK_SIZE)
+        try:
+            while True:
+                header = read_header(reader)
+                if header is None:
+                    break
+                if header.kind == KIND_CONTROL:
+                    payload = read_exact(reader, header.payload_length)
+                    notice = json.loads(
+                        self.cipher.decrypt(payload, header.flow_id).decode())
+                    self.directory.invalidate(notice["invalidate"])
+                    continue
+                if header.kind == KIND_AUDIO:
+                    size = self.discard_audio(reader, header, buffer)
+                else:
+                    payload = read_exact(reader, header.payload_length)
+                    size = len(self.cipher.decrypt(payload, header.flow_id))
+                self.generator.received(header.flow_id, size)
+        except (OSError, ProtocolError):
+            pass
+        new_socket.close()
+
+    def discard_audio(self, reader, header, buffer):
+        """
+        Reads and authenticates an audio chunk by chunk without keeping it.
+
+        Returns
+        -------
+            size : int
+                the bytes of audio received
+        """
+        view = memoryview(buffer)
+        stream = self.cipher.stream(
+            header.flow_id, read_exact(reader, SALT_SIZE))
+        remaining = header.payload_length - SALT_SIZE
+        size = 0
+        while remaining:
+            chunk = view[:min(remaining, SEALED_CHUNK_SIZE)]
+            filled = 0
+            while filled < len(chunk):
+                received = reader.readinto(chunk[filled:])
+                if not received:
+                    raise ProtocolError(
+                        "Connection closed in the middle of a frame")
+                filled += received
+            remaining -= filled
+            size += len(stream.open(chunk, last=not remaining))
+        return size
+
+
+class LoadGenerator:
+    """
+    A class to load the network with traffic from many virtual clients at
+    once, generated or replayed from a trace, and measure the latency,
+    throughput and loss between every pair of routers.
+
+    The latency of a message counts from the time it was due rather than
+    the time it went out, so a sender held up by a slow network does not
+    hide the delay.
+    """
+
+    def __init__(self, routers, clients_per_router=1,
+                 first_port=FIRST_CLIENT_PORT):
+        """
+        Constructs all the necessary attributes for the generator object.
+
+        Parameters
+        ----------
+            routers : list
+                the routers to attach virtual clients to
+            clients_per_router : int, optional
+                the virtual clients of each router (default is 1)
+            first_port : int, optional
+                the port of the first virtual client, the others follow
+                (default is 20000, the clients then have to fit in the
+                ports generated topologies leave to them)
+        """
+        count = clients_per_router * len(routers)
+        if first_port == FIRST_CLIENT_PORT and count > CLIENT_PORTS:
+            raise ValueError(
+                f"{count} virtual clients do not fit in the {CLIENT_PORTS} "
+                f"ports from {FIRST_CLIENT_PORT}.")
+        self.clients = [
+            VirtualClient(self, router_name,
+                          first_port + index * len(routers) + position)
+            for index in range(clients_per_router)
+            for position, router_name in enumerate(routers)]
+        self.by_router = {}
+        for client in self.clients:
+            self.by_router.setdefault(client.router_name, []).append(client)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.flows = {}
+        self.trace = []
+        self.errors = 0
+        self.started = None
+        self.finished = None
+
+    def register(self, settle=1.0):
+        """
+        Registers every virtual client with its router and leaves time for
+        the routers to report them to the controller.
+        """
+        for client in self.clients:
+            client.register()
+        time.sleep(settle)
+
+    def send(self, client, destination, kind, size, scheduled):
+        """
+        Sends a message and tracks it until it is received.
+
+        Parameters
+        ----------
+            client : VirtualClient
+                the sender
+            destination : VirtualClient
+                the receiver
+            kind : str
+                'text' or 'audio'
+            size : int
+                the bytes of the message
+            scheduled : float
+                the perf_counter time the message was due
+        """
+        destiny = str(destination.client_port)
+        key = (client.router_name, destination.router_name)
+        try:
+            header = client.message_header(
+                destiny, KIND_AUDIO if kind == "audio" else KIND_TEXT)
+            with self.lock:
+                self.in_flight[header.flow_id] = (key, scheduled)
+                self.flows.setdefault(key, FlowStats()).sent += 1
+                self.trace.append({
+                    "time": scheduled - self.started,
+                    "src_router": key[0], "dst_router": key[1],
+                    "kind": kind, "size": size})
+            if kind == "audio":
+                client.stream_audio("localhost", client.router_port, header,
+                                    PayloadReader(size), size)
+            else:
+                client.send_to_server(
+                    "localhost", client.router_port, header,
+                    client.cipher.encrypt(b"x" * size, header.flow_id))
+        except (OSError, ProtocolError):
+            with self.lock:
+                self.errors += 1
+
+    def received(self, flow_id, size):
+        """
+        Records a message reaching its virtual client.
+        """
+        now = time.perf_counter()
+        with self.lock:
+            sent = self.in_flight.pop(flow_id, None)
+            if sent is None:
+                return
+            key, scheduled = sent
+            flow = self.flows[key]
+            flow.received += 1
+            flow.received_bytes += size
+            flow.latencies.append(now - scheduled)
+
+    def run_schedule(self, schedule, drain=5.0):
+        """
+        Sends every message of a schedule, one thread per virtual client,
+        then waits for the messages still in flight.
+
+        Parameters
+        ----------
+            schedule : dict
+                for every sending client, its messages as (seconds from the
+                start, destination client, kind, size), in time order
+            drain : float, optional
+                seconds to wait for the last messages (default is 5)
+        """
+        self.started = time.perf_counter()
+
+        def sender(client, messages):
+            for offset, destination, kind, size in messages:
+                scheduled = self.started + offset
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                self.send(client, destination, kind, size, scheduled)
+
+        threads = [
+            threading.Thread(target=sender, args=(client, messages))
+            for client, messages in schedule.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.finished = time.perf_counter()
+        deadline = self.finished + drain
+        while self.in_flight and time.perf_counter() < deadline:
+            time.sleep(0.05)
+
+    def generate(self, duration, interarrival, text_size, audio_size,
+                 audio_fraction=0.0, seed=0):
+        """
+        Draws the messages of every virtual client for a duration: each
+        client sends to random other clients, spaced by the inter-arrival
+        distribution, audio with the given probability and text otherwise.
+
+        Parameters
+        ----------
+            duration : float
+                seconds of traffic
+            interarrival : str
+                the distribution of the seconds between two messages of a
+                client
+            text_size : str
+                the distribution of the bytes of a text message
+            audio_size : str
+                the distribution of the bytes of an audio
+            audio_fraction : float, optional
+                the share of audio flows (default is 0)
+            seed : int, optional
+                the seed of the random generator (default is 0)
+
+        Returns
+        -------
+            schedule : dict
+                the messages of every client, as run_schedule takes them
+        """
+        rng = random.Random(seed)
+        gap = parse_distribution(interarrival, rng)
+        sizes = {"text": parse_distribution(text_size, rng),
+                 "audio": parse_distribution(audio_size, rng)}
+        schedule = {}
+        for client in self.clients:
+            others = [other for other in self.clients if other is not client]
+            messages = schedule[client] = []
+            offset = gap()
+            while offset < duration:
+                kind = "audio" if rng.random() < audio_fraction else "text"
+                messages.append((offset, rng.choice(others), kind,
+                                 max(1, round(sizes[kind]()))))
+                offset += gap()
+        return schedule
+
+    def replay(self, filename, speed=1.0):
+        """
+        Reads a trace of messages between routers, one JSON object per line
+        with time, src_router, dst_router, kind and size. Each message goes
+        between virtual clients of its routers, taken in turn.
+
+        Parameters
+        ----------
+            filename : str
+                the trace
+            speed : float, optional
+                how much faster than recorded to replay (default is 1)
+
+        Returns
+        -------
+            schedule : dict
+                the messages of every client, as run_schedule takes them
+        """
+        turns = {}
+        schedule = {}
+        with open(filename, encoding="utf-8") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                ends = []
+                for router_name in (entry["src_router"], entry["dst_router"]):
+                    clients = self.by_router[router_name]
+                    turn = turns.get(router_name, 0)
+                    turns[router_name] = turn + 1
+                    ends.append(clients[turn % len(clients)])
+                source, destination = ends
+                schedule.setdefault(source, []).append(
+                    (entry["time"] / speed, destination, entry["kind"],
+                     int(entry["size"])))
+        for messages in schedule.values():
+            messages.sort(key=lambda message: message[0])
+        return schedule
+
+    def save_trace(self, filename):
+        """
+        Writes the messages sent as a trace replay can read.
+        """
+        with open(filename, "w", encoding="utf-8") as file:
+            for entry in sorted(self.trace, key=lambda entry: entry["time"]):
+                file.write(json.dumps(entry) + "\n")
+
+    def report(self):
+        """
+        Sums up the run, overall and for every pair of routers.
+
+        Returns
+        -------
+            report : dict
+                the duration, the failed sends, the latency histogram and
+                the summary of the whole traffic and of every pair
+        """
+        duration = self.finished - self.started
+        with self.lock:
+            total = FlowStats()
+            for flow in self.flows.values():
+                total.sent += flow.sent
+                total.received += flow.received
+                total.received_bytes += flow.received_bytes
+                total.latencies.extend(flow.latencies)
+            pairs = {
+                f"{source}->{destination}": flow.summary(duration)
+                for (source, destination), flow in sorted(self.flows.items())}
+        latencies = np.frombuffer(total.latencies, dtype=np.float64) * 1000
+        counts = np.histogram(
+            latencies, [0] + HISTOGRAM_EDGES + [math.inf])[0]
+        histogram = {
+            f"<{edge}" if edge != math.inf else f">={HISTOGRAM_EDGES[-1]}":
+                int(count)
+            for edge, count in zip(HISTOGRAM_EDGES + [math.inf], counts)}
+        return {
+            "duration_s": duration,
+            "send_errors": self.errors,
+            "messages_per_s": total.received / duration,
+            "total": total.summary(duration),
+            "histogram_ms": histogram,
+            "pairs": pairs,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load the running network with virtual clients.")
+    parser.add_argument(
+        "--routers", nargs="*",
+        help="routers to attach clients to (default is every router)")
+    parser.add_argument(
+        "--clients-per-router", type=int, default=1,
+        help="virtual clients attached to each router")
+    parser.add_argument(
+        "--first-port", type=int, default=FIRST_CLIENT_PORT,
+        help="port of the first virtual client")
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="seconds of traffic")
+    parser.add_argument(
+        "--interarrival", default="exponential:0.1",
+        help="seconds between two messages of a client")
+    parser.add_argument(
+        "--text-size", default="lognormal:200:1", help="bytes of a text")
+    parser.add_argument(
+        "--audio-size", default="uniform:100000:1000000",
+        help="bytes of an audio")
+    parser.add_argument(
+        "--audio-fraction", type=float, default=0.0,
+        help="share of audio flows")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", help="trace to replay instead")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="speed of the replay")
+    parser.add_argument(
+        "--save-trace", help="write the messages sent as a trace")
+    parser.add_argument(
+        "--drain", type=float, default=5.0,
+        help="seconds to wait for the last messages")
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args()
+
+    with open("Json/network.json", encoding="utf-8-sig") as file:
+        routers = args.routers or list(json.load(file)["Ports"])
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    entry = json.loads(line)
+                    for router_name in (entry["src_router"],
+                                        entry["dst_router"]):
+                        if router_name not in routers:
+                            routers.append(router_name)
+
+    generator = LoadGenerator(
+        routers, args.clients_per_router, args.first_port)
+    generator.register()
+    if args.replay:
+        schedule = generator.replay(args.replay, args.speed)
+    else:
+        schedule = generator.generate(
+            args.duration, args.interarrival, args.text_size,
+            args.audio_size, args.audio_fraction, args.seed)
+    generator.run_schedule(schedule, args.drain)
+    report = generator.report()
+    if args.save_trace:
+        generator.save_trace(args.save_trace)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4)
+
+    total = report["total"]
+    print(f"{total['sent']} messages sent, {total['received']} received, "
+          f"{report['send_errors']} send errors, "
+          f"{report['messages_per_s']:.0f} messages/s, "
+          f"{total['throughput_mbps']:.1f} Mbit/s")
+    print("latency ms: " + ", ".join(
+        f"{name} {total[f'{name}_ms']:.2f}" for name in ("p50", "p99", "p999")
+        if f"{name}_ms" in total))
+    print("histogram ms: " + ", ".join(
+        f"{bucket} {count}" for bucket, count in
+        report["histogram_ms"].items() if count))
+    print(f"{'pair':>12} {'sent':>6} {'loss':>6} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'p999 ms':>8} {'Mbit/s':>8}")
+    for pair, flow in report["pairs"].items():
+        print(f"{pair:>12} {flow['sent']:>6} {flow['loss']:>6.1%} "
+              f"{flow.get('p50_ms', math.nan):>8.2f} "
+              f"{flow.get('p99_ms', math.nan):>8.2f} "
+              f"{flow.get('p999_ms', math.nan):>8.2f} "
+              f"{flow['throughput_mbps']:>8.3f}")
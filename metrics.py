@@ -0,0 +1,442 @@
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histograms, from tens of
+# microseconds for a forwarded text to seconds for a recompute
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value):
+    """
+    Escapes a label value for the Prometheus text format.
+    """
+    return str(value).replace("\\", r"\\").replace("\n", r"\n") \
+        .replace('"', r'\"')
+
+
+def format_labels(names, values, extra=""):
+    """
+    Formats the labels of a sample, such as {next_hop="CO"}.
+    """
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    """
+    Formats the value of a sample.
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class PerThreadMetric:
+    """
+    The base of the counters and histograms. Every thread updates its own
+    values without any lock, and reading adds the values of every thread up.
+    The values of the threads that ended are folded into a single total when
+    read, and when new threads outnumber the live ones, so their number does
+    not grow with the connections served.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        Constructs all the necessary attributes for the metric object.
+
+        Parameters
+        ----------
+            name : str
+                the name of the metric
+            documentation : str
+                what the metric measures
+            labels : tuple, optional
+                the names of the labels every sample is given (default is
+                none)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.local = threading.local()
+        # (thread, values) of every thread that updated the metric
+        self.threads = []
+        # Threads known alive when the ended ones were last folded
+        self.alive_count = 0
+        self.retired = {}
+        self.lock = threading.Lock()
+
+    def thread_values(self):
+        """
+        Returns the values of the calling thread, creating them on its first
+        update. Only this path takes the lock.
+        """
+        values = {}
+        self.local.values = values
+        with self.lock:
+            # Amortized, the list is at most twice the live threads
+            if len(self.threads) >= 2 * self.alive_count + 8:
+                self.retire()
+            self.threads.append((threading.current_thread(), values))
+        return values
+
+    def retire(self):
+        """
+        Folds the values of the threads that ended into the retired total.
+        Must be called with the lock held.
+        """
+        alive = []
+        for thread, values in self.threads:
+            if thread.is_alive():
+                alive.append((thread, values))
+            else:
+                self.merge(self.retired, values)
+        self.threads = alive
+        self.alive_count = len(alive)
+
+    def collect(self):
+        """
+        Adds up the values of every thread.
+
+        Returns
+        -------
+            values : dict
+                the value of every combination of labels
+        """
+        with self.lock:
+            self.retire()
+            total = {labels: self.copy(value)
+                     for labels, value in self.retired.items()}
+            for _, values in self.threads:
+                # Copying a dict is atomic, the thread may keep updating it
+                self.merge(total, values.copy())
+        return total
+
+    def copy(self, value):
+        return value
+
+    def merge(self, total, values):
+        for labels, value in values.items():
+            total[labels] = total.get(labels, 0) + value
+
+    def samples(self):
+        """
+        Returns the lines of the metric, its help and type first.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        values = self.collect()
+        if not self.labels:
+            values.setdefault((), 0)
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} "
+                         f"{format_value(value)}")
+        return lines
+
+
+class Counter(PerThreadMetric):
+    """
+    A value that only goes up, such as the messages forwarded.
+    """
+
+    kind = "counter"
+
+    def inc(self, amount=1, labels=()):
+        """
+        Adds to the counter.
+
+        Parameters
+        ----------
+            amount : int or float, optional
+                what to add (default is 1)
+            labels : tuple, optional
+                the values of the labels, in the order they were declared
+        """
+        try:
+            values = self.local.values
+        except AttributeError:
+            values = self.thread_values()
+        values[labels] = values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        """
+        Returns the current value of the counter.
+        """
+        return self.collect().get(labels, 0)
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down, such as the open connections. Every
+    thread keeps the changes it made, so a connection may be opened by one
+    thread and closed by another.
+    """
+
+    kind = "gauge"
+
+    def dec(self, amount=1, labels=()):
+        """
+        Subtracts from the gauge.
+        """
+        self.inc(-amount, labels)
+
+
+class CallbackGauge:
+    """
+    A gauge read from a function when the metrics are collected, such as the
+    routes version.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function, labels=()):
+        """
+        Constructs all the necessary attributes for the gauge object.
+
+        Parameters
+        ----------
+            name : str
+                the name of the metric
+            documentation : str
+                what the metric measures
+            function : callable
+                returns the value, or a dict of the value of every
+                combination of labels when the gauge has labels
+            labels : tuple, optional
+                the names of the labels (default is none)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labels = tuple(labels)
+
+    def collect(self):
+        value = self.function()
+        return value if self.labels else {(): value}
+
+    samples = PerThreadMetric.samples
+
+
+class Histogram(PerThreadMetric):
+    """
+    Counts observations, such as latencies, in buckets of increasing upper
+    bounds.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        """
+        Constructs all the necessary attributes for the histogram object.
+
+        Parameters
+        ----------
+            name : str
+                the name of the metric
+            documentation : str
+                what the metric measures
+            labels : tuple, optional
+                the names of the labels (default is none)
+            buckets : tuple, optional
+                the upper bounds of the buckets, in increasing order
+                (default is LATENCY_BUCKETS)
+        """
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        """
+        Records an observation.
+
+        Parameters
+        ----------
+            value : float
+                the observation
+            labels : tuple, optional
+                the values of the labels, in the order they were declared
+        """
+        try:
+            values = self.local.values
+        except AttributeError:
+            values = self.thread_values()
+        counts = values.get(labels)
+        if counts is None:
+            # The count of every bucket, then of +Inf, then the sum
+            counts = values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, labels=()):
+        """
+        Returns a context manager that observes the seconds its block took.
+        """
+        return Timer(self, labels)
+
+    def copy(self, value):
+        return list(value)
+
+    def merge(self, total, values):
+        for labels, counts in values.items():
+            merged = total.get(labels)
+            if merged is None:
+                total[labels] = list(counts)
+            else:
+                for index, count in enumerate(counts):
+                    merged[index] += count
+
+    def samples(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for labels, counts in sorted(self.collect().items()):
+            cumulated = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulated += count
+                bucket = format_labels(
+                    self.labels, labels, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulated}")
+            label_text = format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{label_text} "
+                         f"{format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{label_text} {cumulated}")
+        return lines
+
+
+class Timer:
+    """
+    Observes the seconds a block of code took in a histogram.
+    """
+
+    def __init__(self, histogram, labels=()):
+        self.histogram = histogram
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(
+            time.perf_counter() - self.started, self.labels)
+        return False
+
+
+class MetricsRegistry:
+    """
+    A class to hold the metrics of a component and expose them in the
+    Prometheus text format, on demand or over HTTP.
+    """
+
+    def __init__(self):
+        """
+        Constructs all the necessary attributes for the registry object.
+        """
+        self.metrics = {}
+        self.server = None
+
+    def register(self, metric):
+        """
+        Adds a metric, whose name must not be taken yet.
+        """
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} already registered.")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        """
+        Creates and registers a Counter.
+        """
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), function=None):
+        """
+        Creates and registers a Gauge, or a CallbackGauge when a function
+        gives its value.
+        """
+        if function is not None:
+            return self.register(
+                CallbackGauge(name, documentation, function, labels))
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=LATENCY_BUCKETS):
+        """
+        Creates and registers a Histogram.
+        """
+        return self.register(
+            Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        """
+        Collects every metric.
+
+        Returns
+        -------
+            text : str
+                the metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="localhost"):
+        """
+        Exposes the metrics at http://host:port/metrics, from a thread of
+        its own.
+
+        Parameters
+        ----------
+            port : int
+                the port to listen on
+            host : str, optional
+                the address to listen on (default is localhost)
+
+        Returns
+        -------
+            server : ThreadingHTTPServer
+                the server, already serving
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(
+            target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def close(self):
+        """
+        Stops serving the metrics.
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
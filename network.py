@@ -16,6 +16,8 @@ class Network:
         self.nodes = {}
         self.links = []
         self.graph = nx.Graph()
+        # Changes with every change of the topology
+        self.version = 0
 
     def add_node(self, node_id, name, node_type='router'):
         """
@@ -34,6 +36,7 @@ class Network:
         if node_id not in self.nodes:
             self.nodes[node_id] = Node(node_id, name, node_type)
             self.graph.add_node(name, node_type=node_type)
+            self.version += 1
 
     def add_link(self, source_id, destination_id, bandwidth):
         """
@@ -53,9 +56,34 @@ class Network:
                 Link(self.nodes[source_id], self.nodes[destination_id], bandwidth))
             self.graph.add_edge(
                 self.nodes[source_id].name, self.nodes[destination_id].name, weight=bandwidth)
+            self.version += 1
         else:
             print("Error: One or both nodes not found in the network.")
 
+    def set_link_bandwidth(self, source, destination, bandwidth):
+        """
+        Changes the bandwidth, used as the weight, of the link between two
+        nodes.
+
+        Parameters
+        ----------
+        source : str
+            The name of one end of the link.
+        destination : str
+            The name of the other end of the link.
+        bandwidth : float
+            The new bandwidth of the link.
+        """
+        if not self.graph.has_edge(source, destination):
+            print("Error: Link not found in the network.")
+            return
+        self.graph[source][destination]["weight"] = bandwidth
+        for link in self.links:
+            if {link.source.name, link.destination.name} == \
+                    {source, destination}:
+                link.bandwidth = bandwidth
+        self.version += 1
+
     def remove_node(self, node_id):
         """
         Removes a node and its associated links from the network.
@@ -73,11 +101,62 @@ class Network:
             # Remove any links associated with this node
             self.links = [link for link in self.links if
                           link.source.node_id != node_id and link.destination.node_id != node_id]
+            self.version += 1
             print(
                 f"Node {node_name} and its associated links have been removed from the network.")
         else:
             print(f"Node ID {node_id} not found in the network.")
 
+    def to_snapshot(self):
+        """
+        Describes the topology with plain arrays, links referring to nodes
+        by their position, so it can be sent as compact JSON.
+
+        Returns
+        -------
+        snapshot : dict
+            The version, the nodes and the links of the network.
+        """
+        ids = list(self.nodes)
+        index = {node_id: position for position, node_id in enumerate(ids)}
+        return {
+            "version": self.version,
+            "ids": ids,
+            "names": [self.nodes[node_id].name for node_id in ids],
+            "types": [self.nodes[node_id].node_type for node_id in ids],
+            "sources": [index[link.source.node_id] for link in self.links],
+            "destinations": [
+                index[link.destination.node_id] for link in self.links],
+            "bandwidths": [link.bandwidth for link in self.links],
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """
+        Rebuilds a network from a snapshot.
+
+        Parameters
+        ----------
+        snapshot : dict
+            What to_snapshot returned.
+
+        Returns
+        -------
+        network : Network
+            The network the snapshot describes.
+        """
+        network = cls()
+        ids = snapshot["ids"]
+        for node_id, name, node_type in zip(
+                ids, snapshot["names"], snapshot["types"]):
+            network.add_node(node_id, name, node_type)
+        for source, destination, bandwidth in zip(
+                snapshot["sources"], snapshot["destinations"],
+                snapshot["bandwidths"]):
+            network.add_link(ids[source], ids[destination], bandwidth)
+        network.version = snapshot["version"]
+        return network
+
     def display_network(self):
         """
         Prints the nodes and links in the network.
@@ -0,0 +1,584 @@
+import os
+import math
+from collections import UserDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+import numpy as np
+import networkx as nx
+
+PATH_ENGINES = {}
+
+
+def register_path_engine(name):
+    """
+    Adds a path engine class to the registry under a name.
+
+    Parameters
+    ----------
+        name : str
+            the name the engine is selected with
+
+    Returns
+    -------
+        decorator : callable
+            registers the class it decorates and returns it unchanged
+    """
+    def decorator(engine_class):
+        engine_class.name = name
+        PATH_ENGINES[name] = engine_class
+        return engine_class
+    return decorator
+
+
+def get_path_engine(name, **options):
+    """
+    Builds the path engine registered under a name.
+
+    Parameters
+    ----------
+        name : str
+            the name of the engine
+        **options
+            passed to the constructor of the engine
+
+    Returns
+    -------
+        engine : object
+            the path engine
+    """
+    if name not in PATH_ENGINES:
+        raise ValueError(
+            f"Unknown path engine {name!r}, use one of "
+            f"{', '.join(sorted(PATH_ENGINES))}.")
+    return PATH_ENGINES[name](**options)
+
+
+class PathEngine:
+    """
+    The base of the path engines. An engine computes shortest path trees:
+    for a source, the cost and the path towards every reachable router.
+    """
+
+    name = None
+
+    def tree(self, graph, source):
+        """
+        Computes the shortest path tree of a single source.
+
+        Parameters
+        ----------
+            graph : NetworkX graph
+                the network graph, weighted by 'weight'
+            source : str
+                the name of the source router
+
+        Returns
+        -------
+            distances : dict
+                the cost from the source to every reachable router
+            paths : dict
+                the shortest path from the source to every reachable router
+        """
+        raise NotImplementedError
+
+    def trees(self, graph, sources=None):
+        """
+        Computes the shortest path trees of several routers.
+
+        Parameters
+        ----------
+            graph : NetworkX graph
+                the network graph, weighted by 'weight'
+            sources : list, optional
+                the names of the sources (default is every router)
+
+        Returns
+        -------
+            trees : dict
+                the distances and paths of every source, as tree returns them
+        """
+        sources = graph.nodes if sources is None else sources
+        return {source: self.tree(graph, source) for source in sources}
+
+    def close(self):
+        """
+        Releases what the engine holds, such as worker processes.
+        """
+
+
+@register_path_engine("dijkstra")
+class DijkstraEngine(PathEngine):
+    """
+    The networkx Dijkstra algorithm, the reference engine.
+    """
+
+    def tree(self, graph, source):
+        return nx.single_source_dijkstra(graph, source)
+
+
+@register_path_engine("bellman_ford")
+class BellmanFordEngine(PathEngine):
+    """
+    The networkx Bellman-Ford algorithm.
+    """
+
+    def tree(self, graph, source):
+        return nx.single_source_bellman_ford(graph, source)
+
+
+def link_arrays(graph):
+    """
+    Lays the links of a graph out as arrays grouped by the router they
+    lead to, both directions of every link. Each router also gets a link
+    to itself of infinite weight, so no group is empty.
+
+    Parameters
+    ----------
+        graph : NetworkX graph
+            the network graph, weighted by 'weight'
+
+    Returns
+    -------
+        names : list
+            the routers, in the order of their rows
+        tails : numpy.ndarray
+            the row every link comes from
+        weights : numpy.ndarray
+            the weight of every link
+        offsets : numpy.ndarray
+            where the links leading to each router start
+    """
+    names = list(graph.nodes)
+    rows = {name: row for row, name in enumerate(names)}
+    tails, weights, offsets = [], [], []
+    for row, name in enumerate(names):
+        offsets.append(len(tails))
+        tails.append(row)
+        weights.append(np.inf)
+        for neighbor, link in graph[name].items():
+            tails.append(rows[neighbor])
+            weights.append(link.get("weight", 1))
+    return (names, np.array(tails, dtype=np.intp), np.array(weights),
+            np.array(offsets, dtype=np.intp))
+
+
+def min_plus_paths(tails, weights, offsets, sources, block_size=256):
+    """
+    Computes the shortest paths of many sources at once. Every round is a
+    min-plus product of the current distances with the links, taking for
+    each router the best of its neighbors' distances plus the link; rounds
+    go on until nothing improves, that is as many rounds as the longest
+    shortest path has hops. Sources are processed by blocks to bound the
+    memory of a round.
+
+    Parameters
+    ----------
+        tails : numpy.ndarray
+            the tails of the links, as link_arrays returns them
+        weights : numpy.ndarray
+            the weights of the links, as link_arrays returns them
+        offsets : numpy.ndarray
+            the groups of the links, as link_arrays returns them
+        sources : list
+            the rows of the sources
+        block_size : int, optional
+            the number of sources relaxed together (default is 256)
+
+    Returns
+    -------
+        distances : numpy.ndarray
+            the cost from every source to every router, infinity when
+            unreachable
+        predecessors : numpy.ndarray
+            the router before each one on its path from every source, -1
+            when unreachable
+    """
+    count = len(offsets)
+    heads = np.repeat(np.arange(count), np.diff(np.append(offsets, len(tails))))
+    sources = np.asarray(sources, dtype=np.intp)
+    distances = np.full((len(sources), count), np.inf)
+    predecessors = np.full((len(sources), count), -1)
+    for start in range(0, len(sources), block_size):
+        block = sources[start:start + block_size]
+        rows = np.arange(len(block))
+        block_distances = distances[start:start + len(block)]
+        block_distances[rows, block] = 0.0
+        for _ in range(count):
+            through = block_distances[:, tails] + weights
+            relaxed = np.minimum(
+                block_distances, np.minimum.reduceat(through, offsets, axis=1))
+            if np.array_equal(relaxed, block_distances):
+                break
+            block_distances[:] = relaxed
+
+        # At the fixed point the best link into a router adds up exactly
+        through = block_distances[:, tails] + weights
+        matches = np.where(through == block_distances[:, heads],
+                           np.arange(len(tails)), len(tails))
+        first = np.minimum.reduceat(matches, offsets, axis=1)
+        reached = (first < len(tails)) & np.isfinite(block_distances)
+        block_predecessors = predecessors[start:start + len(block)]
+        block_predecessors[reached] = tails[first[reached]]
+        block_predecessors[rows, block] = block
+    return distances, predecessors
+
+
+def next_hops_from_predecessors(predecessors, sources):
+    """
+    Derives the next hop matrix from the predecessor matrix.
+
+    Parameters
+    ----------
+        predecessors : numpy.ndarray
+            the predecessors of every source, as min_plus_paths returns
+            them
+        sources : list
+            the rows of the sources
+
+    Returns
+    -------
+        next_hops : numpy.ndarray
+            the router after the source on its path to every router, the
+            source itself for its own column and -1 when unreachable
+    """
+    sources = np.asarray(sources, dtype=np.intp)
+    rows = np.arange(len(sources))[:, None]
+    routers = np.broadcast_to(np.arange(predecessors.shape[1]),
+                              predecessors.shape)
+    next_hops = np.where(predecessors == sources[:, None], routers, -1)
+    next_hops[rows[:, 0], sources] = sources
+    # Each round settles the routers one more hop away from the source
+    while True:
+        pending = (next_hops == -1) & (predecessors != -1)
+        if not pending.any():
+            return next_hops
+        inherited = np.take_along_axis(
+            next_hops, np.maximum(predecessors, 0), axis=1)
+        np.copyto(next_hops, inherited, where=pending)
+
+
+class LazyRow(UserDict):
+    """
+    A dictionary built from rows of the result matrices the first time it
+    is used, so computing every tree does not build N dictionaries of N
+    entries the caller may never read.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self.built = None
+
+    @property
+    def data(self):
+        if self.built is None:
+            self.built = self.build()
+        return self.built
+
+
+class PredecessorPaths(LazyRow):
+    """
+    The shortest paths of a source, built from its predecessor row when
+    first read. Its next hops and transit routers are read straight from
+    the rows.
+    """
+
+    def __init__(self, names, source, distances, predecessors, next_hops):
+        """
+        Constructs all the necessary attributes for the paths object.
+
+        Parameters
+        ----------
+            names : list
+                the routers, in the order of the columns
+            source : int
+                the column of the source
+            distances : numpy.ndarray
+                the cost towards every router
+            predecessors : numpy.ndarray
+                the router before each one on its path
+            next_hops : numpy.ndarray
+                the router after the source on its path to each one, -1
+                when unreachable
+        """
+        super().__init__(self.build_paths)
+        self.names = names
+        self.source = source
+        self.distances = distances
+        self.predecessors = predecessors
+        self.next_hops = next_hops
+
+    def build_paths(self):
+        reachable = np.flatnonzero(np.isfinite(self.distances))
+        # Weights are positive, so a router always comes after its
+        # predecessor
+        reachable = reachable[
+            np.argsort(self.distances[reachable], kind="stable")]
+        names = self.names
+        before = self.predecessors.tolist()
+        routes = {self.source: [names[self.source]]}
+        for router in reachable.tolist():
+            if router != self.source:
+                routes[router] = routes[before[router]] + [names[router]]
+        return {names[router]: path for router, path in routes.items()}
+
+    def transit_nodes(self):
+        """
+        Returns the routers the paths go through, the next to last router
+        of every path longer than a link.
+        """
+        predecessors = self.predecessors
+        transit = np.unique(predecessors[
+            (predecessors >= 0) & (predecessors != self.source)])
+        return {self.names[router] for router in transit.tolist()}
+
+
+def tree_from_predecessors(names, source, distances, predecessors,
+                           next_hops):
+    """
+    Turns rows of the result matrices into the dictionaries the networkx
+    engines return, built only when first read.
+
+    Parameters
+    ----------
+        names : list
+            the routers, in the order of the columns
+        source : int
+            the column of the source
+        distances : numpy.ndarray
+            the cost towards every router
+        predecessors : numpy.ndarray
+            the router before each one on its path
+        next_hops : numpy.ndarray
+            the router after the source on its path to each one
+
+    Returns
+    -------
+        distances : LazyRow
+            the cost from the source to every reachable router
+        paths : PredecessorPaths
+            the shortest path from the source to every reachable router
+    """
+    def build_distances():
+        # Nearest first, the order the networkx engines settle routers in
+        reachable = np.flatnonzero(np.isfinite(distances))
+        reachable = reachable[np.argsort(distances[reachable], kind="stable")]
+        return dict(zip([names[router] for router in reachable.tolist()],
+                        distances[reachable].tolist()))
+
+    return (LazyRow(build_distances),
+            PredecessorPaths(names, source, distances, predecessors,
+                             next_hops))
+
+
+@register_path_engine("numpy")
+class NumpyEngine(PathEngine):
+    """
+    Vectorized engine relaxing the links of blocks of sources at once with
+    min-plus products over the link arrays.
+    """
+
+    def tree(self, graph, source):
+        return self.trees(graph, [source])[source]
+
+    def trees(self, graph, sources=None):
+        names, tails, weights, offsets = link_arrays(graph)
+        rows = {name: row for row, name in enumerate(names)}
+        sources = list(graph.nodes) if sources is None else sources
+        source_rows = [rows[source] for source in sources]
+        distances, predecessors = min_plus_paths(
+            tails, weights, offsets, source_rows)
+        next_hops = next_hops_from_predecessors(predecessors, source_rows)
+        return {
+            source: tree_from_predecessors(
+                names, row, distances[index], predecessors[index],
+                next_hops[index])
+            for index, (source, row) in enumerate(zip(sources, source_rows))
+        }
+
+
+def create_shared(shape, dtype):
+    """
+    Allocates an array in a new block of shared memory.
+
+    Parameters
+    ----------
+        shape : tuple
+            the shape of the array
+        dtype : numpy.dtype
+            the type of its entries
+
+    Returns
+    -------
+        block : SharedMemory
+            the block, to be closed and unlinked by the caller once the
+            array is dropped
+        array : numpy.ndarray
+            the array over the block
+        spec : tuple
+            the name, shape and type other processes attach it with
+    """
+    dtype = np.dtype(dtype)
+    size = max(math.prod(shape) * dtype.itemsize, 1)
+    block = shared_memory.SharedMemory(create=True, size=size)
+    array = np.ndarray(shape, dtype, buffer=block.buf)
+    return block, array, (block.name, shape, dtype.str)
+
+
+def relax_shard(links, results, shard, start):
+    """
+    Computes the shortest paths of a shard of sources in a worker process,
+    reading the links from shared memory and writing the distances,
+    predecessors and next hops into the shared result matrices.
+
+    Parameters
+    ----------
+        links : tuple
+            the specs of the shared tails, weights and offsets
+        results : tuple
+            the specs of the shared distances, predecessors and next hops
+        shard : list
+            the rows of the sources of the shard
+        start : int
+            the row of the results the shard starts at
+    """
+    blocks = [shared_memory.SharedMemory(name=name)
+              for name, _, _ in links + results]
+    try:
+        tails, weights, offsets, distances, predecessors, next_hops = [
+            np.ndarray(shape, dtype, buffer=block.buf)
+            for block, (_, shape, dtype) in zip(blocks, links + results)]
+        shard_distances, shard_predecessors = min_plus_paths(
+            tails, weights, offsets, shard)
+        distances[start:start + len(shard)] = shard_distances
+        predecessors[start:start + len(shard)] = shard_predecessors
+        next_hops[start:start + len(shard)] = next_hops_from_predecessors(
+            shard_predecessors, shard)
+        # The views must go before the blocks can be closed
+        del tails, weights, offsets, distances, predecessors, next_hops
+    finally:
+        for block in blocks:
+            block.close()
+
+
+@register_path_engine("parallel")
+class ParallelEngine(NumpyEngine):
+    """
+    The numpy engine with the sources sharded across worker processes.
+
+    The link arrays and the result matrices live in shared memory, so a
+    task only carries the rows of its sources. Workers are spawned rather
+    than forked, as the controller runs many threads, and are kept between
+    computations.
+    """
+
+    def __init__(self, workers=None):
+        """
+        Constructs all the necessary attributes for the engine object.
+
+        Parameters
+        ----------
+            workers : int, optional
+                the number of worker processes (default is the number of
+                CPUs)
+        """
+        self.workers = workers or os.cpu_count()
+        self.pool = None
+
+    def tree(self, graph, source):
+        return super().trees(graph, [source])[source]
+
+    def trees(self, graph, sources=None):
+        names, tails, weights, offsets = link_arrays(graph)
+        rows = {name: row for row, name in enumerate(names)}
+        sources = list(graph.nodes) if sources is None else list(sources)
+        source_rows = [rows[source] for source in sources]
+        if not sources:
+            return {}
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                self.workers, mp_context=get_context("spawn"))
+
+        shape = (len(sources), len(names))
+        blocks, arrays, specs = [], [], []
+        try:
+            for array_shape, dtype in ((tails.shape, tails.dtype),
+                                       (weights.shape, weights.dtype),
+                                       (offsets.shape, offsets.dtype),
+                                       (shape, np.float64), (shape, np.int32),
+                                       (shape, np.int32)):
+                block, array, spec = create_shared(array_shape, dtype)
+                blocks.append(block)
+                arrays.append(array)
+                specs.append(spec)
+            for array, values in zip(arrays, (tails, weights, offsets)):
+                array[...] = values
+            arrays[3].fill(np.inf)
+            arrays[4].fill(-1)
+            arrays[5].fill(-1)
+
+            shard_size = -(-len(sources) // self.workers)
+            tasks = [
+                self.pool.submit(relax_shard, tuple(specs[:3]),
+                                 tuple(specs[3:]),
+                                 source_rows[start:start + shard_size], start)
+                for start in range(0, len(sources), shard_size)]
+            for task in tasks:
+                task.result()
+            # Copied out of the blocks, which go once the trees are built
+            distances, predecessors, next_hops = [
+                shared.copy() for shared in arrays[3:]]
+        finally:
+            # The arrays must go before the blocks can be closed
+            arrays.clear()
+            for block in blocks:
+                block.close()
+                block.unlink()
+        return {
+            source: tree_from_predecessors(
+                names, row, distances[index], predecessors[index],
+                next_hops[index])
+            for index, (source, row) in enumerate(zip(sources, source_rows))
+        }
+
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def cross_check(graph, engines, tolerance=1e-9):
+    """
+    Compares the path costs of several engines on the same graph.
+
+    Parameters
+    ----------
+        graph : NetworkX graph
+            the network graph, weighted by 'weight'
+        engines : list
+            the engines, the first one is the reference
+        tolerance : float, optional
+            the relative difference allowed between two costs (default is
+            1e-9)
+
+    Returns
+    -------
+        mismatches : list
+            (engine, source, destination, reference cost, cost) for every
+            pair whose cost differs or that only one engine reaches
+    """
+    results = {engine.name: engine.trees(graph) for engine in engines}
+    reference = results[engines[0].name]
+    mismatches = []
+    for name in list(results)[1:]:
+        for source, (distances, _) in reference.items():
+            other = results[name][source][0]
+            for destination in set(distances) | set(other):
+                expected = distances.get(destination, math.inf)
+                cost = other.get(destination, math.inf)
+                if not math.isclose(expected, cost, rel_tol=tolerance):
+                    mismatches.append(
+                        (name, source, destination, expected, cost))
+    return mismatches
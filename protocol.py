@@ -0,0 +1,534 @@
+import random
+import struct
+import asyncio
+from collections import namedtuple
+
+MAGIC = b"TN"
+VERSION = 1
+
+KIND_CONTROL = 1
+KIND_TEXT = 2
+KIND_AUDIO = 3
+# A frame carried whole in the payload of another, between two routers
+KIND_TUNNEL = 4
+KINDS = (KIND_CONTROL, KIND_TEXT, KIND_AUDIO, KIND_TUNNEL)
+KIND_NAMES = {KIND_CONTROL: "control", KIND_TEXT: "text", KIND_AUDIO: "audio",
+              KIND_TUNNEL: "tunnel"}
+
+# magic, version, kind, flow id, payload length, length of the text fields
+FIXED_HEADER = struct.Struct("!2sBBQQH")
+FIELD_LENGTH = struct.Struct("!H")
+FIELDS = ("src", "src_router", "dst", "dst_router")
+# A trace is the number of hops, then the name, receive and forward wall
+# clock times of every hop
+TRACE_HOPS = struct.Struct("!H")
+TRACE_TIMES = struct.Struct("!dd")
+MAX_PAYLOAD_LENGTH = 1 << 48
+# Reads are bounded so a corrupted length cannot allocate a huge buffer
+READ_CHUNK = 1 << 20
+
+
+TraceHop = namedtuple("TraceHop", ["node", "received", "forwarded"])
+
+
+class ProtocolError(ValueError):
+    """
+    Raised when the bytes received are not a valid frame.
+    """
+
+
+class Header:
+    """
+    A class to represent the header of a frame.
+
+    Every message exchanged in the network is a frame: the fixed header,
+    the text fields and then payload_length bytes of payload. The payload
+    length is known up front, so any number of frames can travel one after
+    the other on the same connection.
+    """
+
+    def __init__(self, kind, src="", src_router="", dst="", dst_router="",
+                 payload_length=0, flow_id=0, trace=None):
+        """
+        Constructs all the necessary attributes for the header object.
+
+        Parameters
+        ----------
+            kind : int
+                KIND_CONTROL, KIND_TEXT, KIND_AUDIO or KIND_TUNNEL
+            src : str, optional
+                the name or port of the sender
+            src_router : str, optional
+                the router the sender is connected to
+            dst : str, optional
+                the port of the receiving client
+            dst_router : str, optional
+                the router the receiver is connected to
+            payload_length : int, optional
+                the number of payload bytes that follow the header
+            flow_id : int, optional
+                the identifier shared by every frame of a flow
+            trace : list, optional
+                the TraceHop of the sender and of every router crossed so
+                far, None when the message is not traced
+        """
+        self.kind = kind
+        self.src = src
+        self.src_router = src_router
+        self.dst = dst
+        self.dst_router = dst_router
+        self.payload_length = payload_length
+        self.flow_id = flow_id
+        self.trace = trace
+
+    def __repr__(self):
+        return (f"Header(kind={self.kind}, {self.src}@{self.src_router} -> "
+                f"{self.dst}@{self.dst_router}, flow={self.flow_id}, "
+                f"payload={self.payload_length})")
+
+    def __eq__(self, other):
+        return isinstance(other, Header) and vars(self) == vars(other)
+
+    def encode(self):
+        """
+        Encodes the header into bytes.
+
+        Returns
+        -------
+            data : bytes
+                the encoded header
+        """
+        if self.kind not in KINDS:
+            raise ProtocolError(f"Unknown frame kind {self.kind}")
+        if not 0 <= self.flow_id <= 0xFFFFFFFFFFFFFFFF:
+            raise ProtocolError(f"Flow id {self.flow_id} is out of range")
+        if not 0 <= self.payload_length <= MAX_PAYLOAD_LENGTH:
+            raise ProtocolError(
+                f"Payload of {self.payload_length} bytes is out of range")
+        fields = b""
+        for name in FIELDS:
+            value = str(getattr(self, name)).encode()
+            if len(value) > 0xFFFF:
+                raise ProtocolError(f"Header field {name} is too long")
+            fields += FIELD_LENGTH.pack(len(value)) + value
+        if self.trace is not None:
+            fields += encode_trace(self.trace)
+        if len(fields) > 0xFFFF:
+            raise ProtocolError("Header fields are too long")
+        return FIXED_HEADER.pack(
+            MAGIC, VERSION, self.kind, self.flow_id, self.payload_length,
+            len(fields)) + fields
+
+
+def encode_trace(trace):
+    """
+    Encodes the hops of a trace.
+
+    Parameters
+    ----------
+        trace : list
+            the TraceHop of every hop
+
+    Returns
+    -------
+        data : bytes
+            the encoded trace
+    """
+    if len(trace) > 0xFFFF:
+        raise ProtocolError("Trace has too many hops")
+    data = TRACE_HOPS.pack(len(trace))
+    for node, received, forwarded in trace:
+        name = str(node).encode()
+        if len(name) > 0xFFFF:
+            raise ProtocolError("Trace hop name is too long")
+        try:
+            times = TRACE_TIMES.pack(received, forwarded)
+        except struct.error as error:
+            raise ProtocolError("Trace hop times are not numbers") from error
+        data += FIELD_LENGTH.pack(len(name)) + name + times
+    return data
+
+
+def decode_trace(data, position):
+    """
+    Decodes the hops of a trace.
+
+    Parameters
+    ----------
+        data : bytes
+            the encoded fields
+        position : int
+            where the trace starts
+
+    Returns
+    -------
+        trace : list
+            the TraceHop of every hop
+    """
+    if position + TRACE_HOPS.size > len(data):
+        raise ProtocolError("Truncated trace")
+    (count, ) = TRACE_HOPS.unpack_from(data, position)
+    position += TRACE_HOPS.size
+    trace = []
+    for _ in range(count):
+        if position + FIELD_LENGTH.size > len(data):
+            raise ProtocolError("Truncated trace")
+        (length, ) = FIELD_LENGTH.unpack_from(data, position)
+        position += FIELD_LENGTH.size
+        end = position + length
+        if end + TRACE_TIMES.size > len(data):
+            raise ProtocolError("Truncated trace")
+        try:
+            node = data[position:end].decode()
+        except UnicodeDecodeError as error:
+            raise ProtocolError("Trace hop is not UTF-8") from error
+        trace.append(TraceHop(node, *TRACE_TIMES.unpack_from(data, end)))
+        position = end + TRACE_TIMES.size
+    if position != len(data):
+        raise ProtocolError("Unexpected bytes after the trace")
+    return trace
+
+
+def tunnel_header(header, src_router, dst_router):
+    """
+    Builds the header of a tunnel frame, whose payload is the header of the
+    frame it carries followed by the payload of that frame.
+
+    Parameters
+    ----------
+        header : Header
+            the header of the frame carried
+        src_router : str
+            the router the tunnel starts at
+        dst_router : str
+            the router the tunnel ends at, which forwards the frame carried
+
+    Returns
+    -------
+        tunnel : Header
+            the header of the tunnel frame
+    """
+    return Header(KIND_TUNNEL, src=src_router, src_router=src_router,
+                  dst_router=dst_router,
+                  payload_length=len(header.encode()) + header.payload_length,
+                  flow_id=header.flow_id)
+
+
+def new_flow_id():
+    """
+    Picks a random flow identifier.
+
+    Returns
+    -------
+        flow_id : int
+            a non zero 64 bit identifier
+    """
+    return random.getrandbits(64) or 1
+
+
+def encode_frame(header, payload=b""):
+    """
+    Encodes a whole frame, setting the payload length of the header.
+
+    Parameters
+    ----------
+        header : Header
+            the header of the frame
+        payload : bytes, optional
+            the payload of the frame
+
+    Returns
+    -------
+        data : bytes
+            the encoded frame
+    """
+    header.payload_length = len(payload)
+    return header.encode() + payload
+
+
+def send_frame(connection, header, payload=b""):
+    """
+    Sends a whole frame through a socket.
+
+    Parameters
+    ----------
+        connection : socket
+            the connection to send through
+        header : Header
+            the header of the frame
+        payload : bytes, optional
+            the payload of the frame
+    """
+    connection.sendall(encode_frame(header, payload))
+
+
+def read_exact(stream, size):
+    """
+    Reads exactly size bytes from a stream.
+
+    Parameters
+    ----------
+        stream : file
+            a binary stream, usually from socket.makefile("rb")
+        size : int
+            the number of bytes to read
+
+    Returns
+    -------
+        data : bytes
+            the bytes read
+    """
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = stream.read(min(remaining, READ_CHUNK))
+        if not chunk:
+            raise ProtocolError("Connection closed in the middle of a frame")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def decode_fields(data):
+    """
+    Decodes the text fields of a header.
+
+    Parameters
+    ----------
+        data : bytes
+            the encoded fields
+
+    Returns
+    -------
+        fields : dict
+            the value of every field, and the trace when there is one
+    """
+    fields = {}
+    position = 0
+    for name in FIELDS:
+        if position + FIELD_LENGTH.size > len(data):
+            raise ProtocolError("Truncated header field")
+        (length, ) = FIELD_LENGTH.unpack_from(data, position)
+        position += FIELD_LENGTH.size
+        if position + length > len(data):
+            raise ProtocolError("Truncated header field")
+        try:
+            fields[name] = data[position:position + length].decode()
+        except UnicodeDecodeError as error:
+            raise ProtocolError("Header field is not UTF-8") from error
+        position += length
+    if position != len(data):
+        # A traced message carries its trace after the text fields
+        fields["trace"] = decode_trace(data, position)
+    return fields
+
+
+def decode_fixed_header(fixed):
+    """
+    Decodes and checks the fixed part of a header.
+
+    Parameters
+    ----------
+        fixed : bytes
+            the FIXED_HEADER.size first bytes of a frame
+
+    Returns
+    -------
+        kind : int
+            the kind of the frame
+        flow_id : int
+            the flow identifier
+        payload_length : int
+            the number of payload bytes
+        fields_length : int
+            the number of bytes of the text fields
+    """
+    magic, version, kind, flow_id, payload_length, fields_length = \
+        FIXED_HEADER.unpack(fixed)
+    if magic != MAGIC or version != VERSION:
+        raise ProtocolError("Not a frame of this protocol")
+    if kind not in KINDS:
+        raise ProtocolError(f"Unknown frame kind {kind}")
+    if payload_length > MAX_PAYLOAD_LENGTH:
+        raise ProtocolError(f"Payload of {payload_length} bytes is too large")
+    return kind, flow_id, payload_length, fields_length
+
+
+def read_header(stream):
+    """
+    Reads the header of the next frame of a stream.
+
+    Parameters
+    ----------
+        stream : file
+            a binary stream, usually from socket.makefile("rb")
+
+    Returns
+    -------
+        header : Header
+            the header read, or None if the stream ended between frames
+    """
+    first = stream.read(1)
+    if not first:
+        return None
+    fixed = first + read_exact(stream, FIXED_HEADER.size - 1)
+    kind, flow_id, payload_length, fields_length = decode_fixed_header(fixed)
+    fields = decode_fields(read_exact(stream, fields_length))
+    return Header(kind, payload_length=payload_length, flow_id=flow_id,
+                  **fields)
+
+
+def read_inner_header(stream):
+    """
+    Reads the header of the frame a tunnel frame carries.
+
+    Parameters
+    ----------
+        stream : file
+            a binary stream positioned at the payload of the tunnel frame
+
+    Returns
+    -------
+        header : Header
+            the header of the frame carried
+    """
+    header = read_header(stream)
+    if header is None:
+        raise ProtocolError("Connection closed in the middle of a frame")
+    return header
+
+
+async def read_header_async(reader):
+    """
+    Reads the header of the next frame of an asyncio stream.
+
+    Parameters
+    ----------
+        reader : asyncio.StreamReader
+            the stream to read from
+
+    Returns
+    -------
+        header : Header
+            the header read, or None if the stream ended between frames
+    """
+    try:
+        fixed = await reader.readexactly(FIXED_HEADER.size)
+    except asyncio.IncompleteReadError as error:
+        if not error.partial:
+            return None
+        raise ProtocolError(
+            "Connection closed in the middle of a frame") from error
+    kind, flow_id, payload_length, fields_length = decode_fixed_header(fixed)
+    try:
+        fields = decode_fields(await reader.readexactly(fields_length))
+    except asyncio.IncompleteReadError as error:
+        raise ProtocolError(
+            "Connection closed in the middle of a frame") from error
+    return Header(kind, payload_length=payload_length, flow_id=flow_id,
+                  **fields)
+
+
+def read_frame(stream):
+    """
+    Reads the next whole frame of a stream.
+
+    Parameters
+    ----------
+        stream : file
+            a binary stream, usually from socket.makefile("rb")
+
+    Returns
+    -------
+        header : Header
+            the header read, or None if the stream ended between frames
+        payload : bytes
+            the payload of the frame
+    """
+    header = read_header(stream)
+    if header is None:
+        return None, b""
+    return header, read_exact(stream, header.payload_length)
+
+
+def relay_payload(stream, connection, size, buffer, bucket=None,
+                  ticket=None):
+    """
+    Copies size payload bytes from a stream to a socket through a reusable
+    buffer, sending each chunk as soon as it is received.
+
+    Parameters
+    ----------
+        stream : file
+            a binary stream, usually from socket.makefile("rb")
+        connection : socket
+            the connection to send through
+        size : int
+            the number of bytes to relay
+        buffer : bytearray
+            the buffer to receive into
+        bucket : TokenBucket, optional
+            holds the chunks to the rate of the link when given
+        ticket : Ticket, optional
+            sends each chunk only in its turn of the scheduler when given
+    """
+    view = memoryview(buffer)
+    remaining = size
+    while remaining:
+        received = stream.readinto(view[:min(remaining, len(view))])
+        if not received:
+            raise ProtocolError("Connection closed in the middle of a frame")
+        if bucket is not None:
+            bucket.consume(received)
+        if ticket is None:
+            connection.sendall(view[:received])
+        else:
+            ticket.acquire(received)
+            try:
+                connection.sendall(view[:received])
+            finally:
+                ticket.release()
+        remaining -= received
+
+
+def discard_payload(stream, size, buffer):
+    """
+    Reads size payload bytes from a stream and throws them away, so the
+    next frame of the connection can be read.
+
+    Parameters
+    ----------
+        stream : file
+            a binary stream, usually from socket.makefile("rb")
+        size : int
+            the number of bytes to skip
+        buffer : bytearray
+            the buffer to receive into
+    """
+    view = memoryview(buffer)
+    remaining = size
+    while remaining:
+        received = stream.readinto(view[:min(remaining, len(view))])
+        if not received:
+            raise ProtocolError("Connection closed in the middle of a frame")
+        remaining -= received
+
+
+async def discard_payload_async(reader, size):
+    """
+    Reads size payload bytes from an asyncio stream and throws them away,
+    the coroutine counterpart of discard_payload.
+
+    Parameters
+    ----------
+        reader : asyncio.StreamReader
+            the stream to read from
+        size : int
+            the number of bytes to skip
+    """
+    remaining = size
+    while remaining:
+        chunk = await reader.read(min(remaining, 65536))
+        if not chunk:
+            raise ProtocolError("Connection closed in the middle of a frame")
+        remaining -= len(chunk)
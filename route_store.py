@@ -0,0 +1,290 @@
+import os
+import json
+import mmap
+import struct
+import numpy as np
+
+MAGIC = b"TNRS"
+VERSION = 1
+# magic, version, bytes per entry, number of routers, length of the names
+STORE_HEADER = struct.Struct("<4sBBxxII")
+# The matrix starts on a boundary so it can be mapped as an array
+ALIGNMENT = 64
+
+
+class RouteStoreError(ValueError):
+    """
+    Raised when a file is not a valid route store.
+    """
+
+
+def entry_type(count):
+    """
+    Picks the narrowest entry type able to hold count routers plus the
+    marker of a missing route.
+
+    Parameters
+    ----------
+        count : int
+            the number of routers
+
+    Returns
+    -------
+        dtype : numpy.dtype
+            little endian uint16 or uint32
+    """
+    return np.dtype("<u2") if count < 0xFFFF else np.dtype("<u4")
+
+
+def matrix_offset(names_length):
+    """
+    Computes where the matrix starts in the file.
+    """
+    end = STORE_HEADER.size + names_length
+    return -(-end // ALIGNMENT) * ALIGNMENT
+
+
+class NextHopMatrix:
+    """
+    A class to keep the next hop of every router towards every other router
+    in a square matrix of router indices, written to disk as a route store.
+
+    Row i, column j holds the index of the router i sends to for j. A
+    router's own column holds its own index and missing routes hold the
+    largest value of the entry type.
+    """
+
+    def __init__(self, names):
+        """
+        Constructs all the necessary attributes for the matrix object.
+
+        Parameters
+        ----------
+            names : list
+                the names of every router that may take part, in the order
+                of their indices
+        """
+        self.names = list(names)
+        self.index = {name: position for position, name in enumerate(self.names)}
+        self.dtype = entry_type(len(self.names))
+        self.no_route = np.iinfo(self.dtype).max
+        self.entries = np.full(
+            (len(self.names), len(self.names)), self.no_route, self.dtype)
+        # The indices of the routers of the last engine column order seen
+        self.column_names = None
+        self.columns = None
+
+    def set_tree(self, source, paths):
+        """
+        Fills the row of a router from its shortest path tree.
+
+        Parameters
+        ----------
+            source : str
+                the name of the router
+            paths : dict
+                the shortest path towards every reachable router
+        """
+        row = self.entries[self.index[source]]
+        row[:] = self.no_route
+        for destination, path in paths.items():
+            next_router = path[1] if len(path) > 1 else source
+            row[self.index[destination]] = self.index[next_router]
+
+    def set_next_hops(self, source, names, next_hops):
+        """
+        Fills the row of a router from a row of next hops, as path engines
+        working on arrays compute them.
+
+        Parameters
+        ----------
+            source : str
+                the name of the router
+            names : list
+                the routers, in the order of the columns of next_hops
+            next_hops : numpy.ndarray
+                the column of the next router towards every router, -1 when
+                unreachable
+        """
+        if names is not self.column_names:
+            self.column_names = names
+            self.columns = np.array([self.index[name] for name in names])
+        row = self.entries[self.index[source]]
+        row[:] = self.no_route
+        reached = next_hops >= 0
+        row[self.columns[reached]] = self.columns[next_hops[reached]]
+
+    def next_hops(self, source):
+        """
+        Returns the forwarding table of a router.
+
+        Parameters
+        ----------
+            source : str
+                the name of the router
+
+        Returns
+        -------
+            next_hops : dict
+                the next router for every reachable destination
+        """
+        own = self.index[source]
+        return {
+            self.names[destination]: self.names[next_router]
+            for destination, next_router in enumerate(
+                self.entries[own].tolist())
+            if next_router != self.no_route and destination != own
+        }
+
+    def set_route(self, source, destination, next_router):
+        """
+        Sets a single next hop.
+        """
+        self.entries[self.index[source], self.index[destination]] = \
+            self.index[next_router]
+
+    def clear(self, name):
+        """
+        Removes every route from and towards a router.
+        """
+        position = self.index[name]
+        self.entries[position, :] = self.no_route
+        self.entries[:, position] = self.no_route
+
+    def save(self, filename):
+        """
+        Writes the route store, replacing the previous one at once so
+        readers never see half of it.
+
+        Parameters
+        ----------
+            filename : str
+                the name of the file
+        """
+        names = json.dumps(self.names, separators=(",", ":")).encode()
+        offset = matrix_offset(len(names))
+        header = STORE_HEADER.pack(
+            MAGIC, VERSION, self.dtype.itemsize, len(self.names), len(names))
+        temporary = f"{filename}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(header + names)
+            file.write(bytes(offset - len(header) - len(names)))
+            file.write(memoryview(np.ascontiguousarray(self.entries)))
+        os.replace(temporary, filename)
+
+
+class RouteStore:
+    """
+    A class to read a route store through a memory map. Only the pages of
+    the rows that are read are loaded, so a router can get its own table
+    out of the store of a large network without parsing the rest.
+    """
+
+    def __init__(self, filename):
+        """
+        Opens a route store.
+
+        Parameters
+        ----------
+            filename : str
+                the name of the file
+        """
+        with open(filename, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < STORE_HEADER.size:
+            raise RouteStoreError(f"{filename} is too short")
+        magic, version, itemsize, count, names_length = \
+            STORE_HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise RouteStoreError(f"{filename} is not a route store")
+        self.names = json.loads(
+            self.map[STORE_HEADER.size:STORE_HEADER.size + names_length])
+        self.index = {name: position for position, name in enumerate(self.names)}
+        self.dtype = entry_type(count)
+        if itemsize != self.dtype.itemsize or len(self.names) != count:
+            raise RouteStoreError(f"{filename} has an inconsistent header")
+        offset = matrix_offset(names_length)
+        if len(self.map) != offset + count * count * itemsize:
+            raise RouteStoreError(f"{filename} is truncated")
+        self.no_route = np.iinfo(self.dtype).max
+        self.entries = np.frombuffer(
+            self.map, self.dtype, count * count, offset).reshape(count, count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """
+        Releases the memory map.
+        """
+        del self.entries
+        self.map.close()
+
+    def row(self, source):
+        """
+        Returns the row of a router as an array of router indices.
+        """
+        return self.entries[self.index[source]]
+
+    def next_hops(self, source):
+        """
+        Returns the forwarding table of a router.
+
+        Parameters
+        ----------
+            source : str
+                the name of the router
+
+        Returns
+        -------
+            next_hops : dict
+                the next router for every reachable destination
+        """
+        row = self.row(source)
+        own = self.index[source]
+        return {
+            self.names[destination]: self.names[next_router]
+            for destination, next_router in enumerate(row.tolist())
+            if next_router != self.no_route and destination != own
+        }
+
+    def next_hop(self, source, destination):
+        """
+        Returns the next router from source towards destination, or None.
+        """
+        next_router = self.entries[
+            self.index[source], self.index[destination]]
+        if next_router == self.no_route:
+            return None
+        return self.names[next_router]
+
+    def path(self, source, destination):
+        """
+        Rebuilds the path between two routers by following next hops.
+
+        Parameters
+        ----------
+            source : str
+                the name of the first router
+            destination : str
+                the name of the last router
+
+        Returns
+        -------
+            path : list
+                the names of the routers on the path, empty if there is no
+                route
+        """
+        current = self.index[source]
+        target = self.index[destination]
+        path = [current]
+        while current != target:
+            current = int(self.entries[current, target])
+            # A route that loops would come back within count hops
+            if current == self.no_route or len(path) > len(self.names):
+                return []
+            path.append(current)
+        return [self.names[position] for position in path]
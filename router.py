@@ -1,7 +1,31 @@
 import json
+import time
+import zlib
+import bisect
 import socket
+import argparse
+import itertools
 import threading
-from cryptography.fernet import Fernet
+from contextlib import nullcontext
+from crypto import SessionCipher
+from connection_pool import ConnectionPool, PoolExhausted
+from metrics import MetricsRegistry
+from shaping import DEFAULT_BANDWIDTH_GBPS, LinkShaper
+from scheduler import CLASSES, Scheduler
+from spool import POLICIES, Spool
+from protocol import (
+    KIND_CONTROL, KIND_TUNNEL, Header, ProtocolError, TraceHop,
+    discard_payload, encode_frame, new_flow_id, read_exact, read_frame,
+    read_header, read_inner_header, relay_payload, send_frame,
+    tunnel_header)
+
+# Size of the buffer each connection relays payloads through
+RELAY_BUFFER_SIZE = 65536
+# Multiplier of the flow hash, 2**64 divided by the golden ratio
+FLOW_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+FLOW_HASH_MASK = (1 << 64) - 1
+# Seconds between two tries of the spooled messages when routes are stable
+SPOOL_RETRY_INTERVAL = 1.0
 
 
 class Router:
@@ -9,18 +33,153 @@ class Router:
     A class used to represent a Router
     """
 
-    def __init__(self):
+    def __init__(self, router_name=None, pool=None, cut_through=True,
+                 shape_scale=None, report_interval=1.0, spool=None,
+                 scheduler=None, network_file="Json/network.json",
+                 network=None):
         """
         Constructs all the necessary attributes for the router object.
+
+        Parameters
+        ----------
+            router_name : str, optional
+                the name of the router, asked for when not given
+            pool : ConnectionPool, optional
+                the pool of connections towards other routers and clients
+            cut_through : bool, optional
+                relay payloads to the next hop while they arrive instead of
+                receiving them whole first (default is True)
+            shape_scale : float, optional
+                hold every link to its bandwidth in network.json times this
+                factor and report its utilization to the controller, links
+                are not shaped when not given
+            report_interval : float, optional
+                seconds between two utilization reports (default is 1)
+            spool : Spool, optional
+                holds the messages whose next hop is unreachable until the
+                routes change, they are dropped when not given
+            scheduler : Scheduler, optional
+                decides which messages go first, control ones before text
+                and text before audio, and holds messages back when its
+                classes are full; messages go as they come when not given
+            network_file : str, optional
+                the topology the router belongs to (default is
+                "Json/network.json")
+            network : dict, optional
+                the topology itself, network_file is not read when given
         """
-        self.router_name = input("Write the node name: ")
+        self.router_name = router_name or input("Write the node name: ")
         self.running = True
-        self.json_routes = []
+        self.next_hops = {}
+        # The next hops and their cumulated weights of the destinations
+        # reached over several paths
+        self.multipaths = {}
+        # The backup of the next router of each destination, a neighbor or
+        # a router to tunnel to
+        self.backups = {}
+        # Next routers that refused a connection since the last routes
+        self.unreachable = set()
+        self.flow_salt = flow_salt(self.router_name)
+        self.routes_version = 0
+        self.controller_socket = None
+        self.controller_lock = threading.Lock()
         self.server_socket = None
-        self.network = self.read_json("Json/network.json")
+        self.network = network or self.read_json(network_file)
         self.clients = []
-        key = b'HcEnve-04K7wN5sgrz1JgKufDMIYBbbTXr0Wueg3v7I='
-        self.fernet = Fernet(key)
+        self.cipher = SessionCipher()
+        self.session = new_flow_id()
+        self.pool = pool or ConnectionPool()
+        self.cut_through = cut_through
+        self.port_names = {
+            port: name for name, port in self.network["Ports"].items()}
+        self.neighbors = set(self.link_rates())
+        self.shaper = None
+        if shape_scale is not None:
+            self.shaper = LinkShaper(self.link_rates(shape_scale))
+        self.report_interval = report_interval
+        self.spool = spool
+        self.routes_changed = threading.Event()
+        self.scheduler = scheduler
+        self.create_metrics()
+
+    def link_rates(self, scale=1.0):
+        """
+        Reads the rate of the links of the router from the topology.
+
+        Parameters
+        ----------
+            scale : float, optional
+                the factor of every bandwidth (default is 1)
+
+        Returns
+        -------
+            rates : dict
+                the bytes per second of the link towards every neighbor
+        """
+
+        names = {
+            node_id: name for name, node_id in self.network["Nodes"].items()}
+        own = self.network["Nodes"][self.router_name]
+        rates = {}
+        for link in self.network["Links"]:
+            if own not in (link["from"], link["to"]):
+                continue
+            other = link["to"] if link["from"] == own else link["from"]
+            gbps = link.get("bandwidth", DEFAULT_BANDWIDTH_GBPS)
+            rates[names[other]] = gbps * 1e9 / 8 * scale
+        return rates
+
+    def link_bucket(self, port):
+        """
+        Returns the token bucket of the link towards a port, or None when
+        the port is a client's or links are not shaped.
+        """
+
+        if self.shaper is None:
+            return None
+        return self.shaper.bucket(self.port_names.get(port))
+
+    def create_metrics(self):
+        """
+        Creates the metrics of the router, exposed once metrics.serve is
+        called.
+        """
+
+        self.metrics = MetricsRegistry()
+        self.forwarded_messages = self.metrics.counter(
+            "router_forwarded_messages_total",
+            "Messages forwarded, by next hop or 'client' when delivered",
+            ("next_hop",))
+        self.forwarded_bytes = self.metrics.counter(
+            "router_forwarded_bytes_total",
+            "Payload bytes forwarded, by next hop or 'client' when delivered",
+            ("next_hop",))
+        self.forwarding_seconds = self.metrics.histogram(
+            "router_forwarding_seconds",
+            "Seconds from the header arriving to the payload sent on",
+            ("next_hop",))
+        self.failovers = self.metrics.counter(
+            "router_failovers_total",
+            "Messages sent to a backup next hop, by unreachable next hop",
+            ("next_hop",))
+        self.dropped_messages = self.metrics.counter(
+            "router_dropped_messages_total",
+            "Messages dropped, by reason", ("reason",))
+        self.active_connections = self.metrics.gauge(
+            "router_active_connections", "Connections being served")
+        self.metrics.gauge(
+            "router_threads", "Threads of the router process",
+            function=threading.active_count)
+        self.metrics.gauge(
+            "router_routes_version", "Routes version of the forwarding table",
+            function=lambda: self.routes_version)
+        self.metrics.gauge(
+            "router_routes", "Destinations in the forwarding table",
+            function=lambda: len(self.next_hops))
+        if self.spool is not None:
+            self.spool.create_metrics(self.metrics, "router_spool")
+        if self.scheduler is not None:
+            self.scheduler.create_metrics(self.metrics, "router_scheduler")
 
     def start(self):
         """
@@ -28,13 +187,22 @@ class Router:
         """
 
         self.connect_to_controller("localhost", 8888)
+        self.listen()
+
+    def listen(self):
+        """
+        Accepts the connections of clients, routers and the controller.
+        """
+
         # Create a TCP server socket
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Restarting must not wait for old connections in TIME_WAIT
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # Bind the socket to the address and port
         port = self.network["Ports"][self.router_name]
         self.server_socket.bind(("localhost", port))
         # Listen for incoming connections
-        self.server_socket.listen(5)
+        self.server_socket.listen(128)
 
         while self.running:
             # Accept a new connection
@@ -56,84 +224,446 @@ class Router:
                 the client's socket
         """
 
-        # Receive data from the client
-        data = self.fernet.decrypt(client_socket.recv(1024)).decode()
-        if not data or data == "Shutdown":
-            self.running = False
+        # Connections are reused, so keep reading frames until the
+        # other side closes it
+        reader = client_socket.makefile("rb")
+        buffer = bytearray(RELAY_BUFFER_SIZE)
+        # Relayed chunks wait while a control frame is handled
+        control = nullcontext() if self.scheduler is None else \
+            self.scheduler.control()
+        self.active_connections.inc()
+        try:
+            while True:
+                header = read_header(reader)
+                if header is None:
+                    break
 
-        elif data == "ACK":
-            ack_answer = "I am ok"
-            client_socket.sendall(self.fernet.encrypt(ack_answer.encode()))
+                if header.kind != KIND_CONTROL:
+                    self.handle_client(header, reader, buffer)
+                    continue
 
-        elif data == "New Path":
-            self.json_routes = self.read_json("Json/paths.json")
+                payload = read_exact(reader, header.payload_length)
+                with control:
+                    data = self.cipher.decrypt(
+                        payload, header.flow_id).decode()
+                    if not data or data == "Shutdown":
+                        self.running = False
+                        break
 
-        elif data.startswith("New Client"):
-            _, new_client = data.split("-")
-            self.clients.append(new_client)
-            clients_json = self.read_json("Json/clients_directory.json")
-            clients_json[self.router_name] = self.clients
-            self.write_json(clients_json, "Json/clients_directory.json")
+                    elif data == "ACK":
+                        client_socket.sendall(
+                            self.ack_answer(header.flow_id))
 
-        else:
-            self.handle_client(data, client_socket)
+                    elif data == "New Client":
+                        self.register_client(header.src)
+        except (ProtocolError, OSError) as error:
+            print(f"Dropping connection: {error}")
+        finally:
+            self.active_connections.dec()
+            client_socket.close()
 
-    def handle_client(self, data, client_socket):
+    def handle_client(self, header, reader, buffer):
         """
-        Handles a client connection.
+        Forwards a message towards its destination.
 
         Parameters
         ----------
-            data : str
-                data sent by the client
-            client_socket : socket
-                the client's socket
+            header : Header
+                the header of the message
+            reader : file
+                the buffered reader the payload is read from
+            buffer : bytearray
+                the buffer of the connection to relay the payload through
         """
-        _, _, destiny, destiny_router, message = data.split("-")
-        if destiny_router == self.router_name:
-            print(message)
-            if message == "audio(°_°)":
-                client_socket.sendall(self.fernet.encrypt("send it".encode()))
-                new_data = client_socket.recv(32768)
-                audio_data = new_data
-                while True:
-                    new_data = client_socket.recv(32768)
-                    if not new_data:
-                        break
-                    audio_data += new_data
+        if header.kind == KIND_TUNNEL and \
+                header.dst_router == self.router_name:
+            self.handle_client(read_inner_header(reader), reader, buffer)
+            return
+        started = time.perf_counter()
+        port = self.destination_port(header)
+        if port is None:
+            discard_payload(reader, header.payload_length, buffer)
+            return
+        if self.scheduler is None:
+            self.forward_message(header, reader, buffer, port, started)
+            return
+        ticket = self.scheduler.admit(header)
+        if ticket is None:
+            self.dropped_messages.inc(1, ("admission",))
+            discard_payload(reader, header.payload_length, buffer)
+            return
+        try:
+            self.forward_message(header, reader, buffer, port, started,
+                                 ticket)
+        finally:
+            ticket.close()
 
-                self.send_to_server("localhost", int(
-                    destiny), data, audio=audio_data)
-            else:
-                self.send_to_server("localhost", int(
-                    destiny), data)
+    def forward_message(self, header, reader, buffer, port, started,
+                        ticket=None):
+        """
+        Sends a message on to its next hop, or to the spool when the next
+        hop cannot be reached.
 
-        else:
-            next_router = self.next_router(destiny_router)
-            next_port = self.network["Ports"][next_router]
-            print(f"data forwarded to {next_router}")
-            if message == "audio(°_°)":
-                client_socket.sendall(self.fernet.encrypt("send it".encode()))
-                new_data = client_socket.recv(32768)
-                audio_data = new_data
-                while True:
-                    new_data = client_socket.recv(32768)
-                    if not new_data:
-                        break
-                    audio_data += new_data
-                self.send_to_server(
-                    "localhost", next_port, data, audio=audio_data)
+        Parameters
+        ----------
+            header : Header
+                the header of the message
+            reader : file
+                the buffered reader the payload is read from
+            buffer : bytearray
+                the buffer of the connection to relay the payload through
+            port : int
+                the port of the next router or the receiving client
+            started : float
+                the perf_counter time the header arrived
+            ticket : Ticket, optional
+                the turns of the message in the scheduler
+        """
+        received = time.time() if header.trace is not None else None
+        next_hop = self.port_names.get(port)
+        port, server_socket, endpoint = self.connect_next_hop(header, port)
+        if port is None:
+            self.hold_message(header, reader, buffer, next_hop)
+            return
+        if received is not None:
+            header.trace.append(
+                TraceHop(self.router_name, received, time.time()))
+        try:
+            if endpoint is not None:
+                server_socket.sendall(tunnel_header(
+                    header, self.router_name, endpoint).encode())
+            if self.cut_through:
+                self.relay_to_server(server_socket, port, header, reader,
+                                     buffer, ticket)
             else:
-                self.send_to_server("localhost", next_port, data)
+                payload = read_exact(reader, header.payload_length)
+                self.send_to_server(server_socket, port, header, payload,
+                                    ticket)
+        except BaseException:
+            self.pool.release("localhost", port, server_socket, reuse=False)
+            raise
+        self.pool.release("localhost", port, server_socket)
+        self.count_forwarded(header, port, started)
+
+    def connect_next_hop(self, header, port):
+        """
+        Takes a connection towards where a message goes next. A next router
+        that refuses the connection is marked unreachable until the next
+        routes version, and messages go to its backup at once instead of
+        waiting for the controller to notice. A next router whose pooled
+        connections all stay in use is busy, not down, and is not marked.
+
+        Parameters
+        ----------
+            header : Header
+                the header of the message
+            port : int
+                the port of the next router or the receiving client
+
+        Returns
+        -------
+            port : int
+                the port connected to, None when nothing could be reached
+            server_socket : socket
+                the connection, to give back to the pool
+            endpoint : str
+                the router to tunnel the message to, None to send it as is
+        """
+
+        failed = self.port_names.get(port)
+        if failed not in self.unreachable:
+            try:
+                return port, self.pool.acquire("localhost", port), None
+            except PoolExhausted:
+                # Busy, not down: failing over would only move the load
+                print(f"No free connection to {failed or port}")
+                return None, None, None
+            except OSError:
+                if failed is None:
+                    return None, None, None
+                self.unreachable.add(failed)
+        next_router, endpoint = self.failover_hop(header, failed)
+        if next_router is None:
+            return None, None, None
+        port = self.network["Ports"][next_router]
+        try:
+            return port, self.pool.acquire("localhost", port), endpoint
+        except PoolExhausted:
+            print(f"No free connection to {next_router}")
+            return None, None, None
+        except OSError:
+            self.unreachable.add(next_router)
+            return None, None, None
+
+    def failover_hop(self, header, failed):
+        """
+        Determines where a message goes when its next router is unreachable.
+
+        Parameters
+        ----------
+            header : Header
+                the header of the message
+            failed : str
+                the unreachable next router
+
+        Returns
+        -------
+            next_router : str
+                the neighbor to send the message to, None when there is
+                none
+            endpoint : str
+                the backup to tunnel the message to when it is not a
+                neighbor, None otherwise
+        """
+
+        alternate, endpoint = self.failover_route(header.dst_router, failed)
+        if alternate is None:
+            return None, None
+        print(f"{failed} unreachable, failing over to {endpoint or alternate}")
+        self.failovers.inc(1, (failed,))
+        return alternate, endpoint
+
+    def failover_route(self, destination, failed):
+        """
+        Picks where messages for a destination go when their next router is
+        unreachable. Unlike failover_hop, it neither logs nor counts.
+
+        Parameters
+        ----------
+            destination : str
+                the destination router
+            failed : str
+                the unreachable next router
+
+        Returns
+        -------
+            next_router : str
+                the neighbor to send the messages to, None when there is
+                none
+            endpoint : str
+                the backup to tunnel the messages to when it is not a
+                neighbor, None otherwise
+        """
+
+        alternate = self.alternate_router(destination, failed)
+        endpoint = None
+        if alternate is not None and alternate not in self.neighbors:
+            endpoint, alternate = alternate, self.next_hops.get(alternate)
+        if alternate is None or alternate in self.unreachable:
+            return None, None
+        return alternate, endpoint
+
+    def hold_message(self, header, reader, buffer, next_hop):
+        """
+        Keeps a message whose next hop could not be reached in the spool
+        until the routes change. The message is dropped when there is no
+        spool, the next hop is a client or the spool refuses it.
+
+        Parameters
+        ----------
+            header : Header
+                the header of the message
+            reader : file
+                the buffered reader the payload is read from
+            buffer : bytearray
+                the buffer of the connection to discard the payload through
+            next_hop : str
+                the next router, None for a client
+        """
+
+        unreachable = next_hop or f"Client {header.dst}"
+        if self.spool is not None and next_hop is not None and \
+                self.spool.hold(next_hop, header, reader):
+            print(f"{unreachable} unreachable, message to {header.dst} "
+                  f"spooled")
+            return
+        print(f"{unreachable} unreachable, message to {header.dst} dropped")
+        self.dropped_messages.inc(1, ("unreachable",))
+        discard_payload(reader, header.payload_length, buffer)
+
+    def retry_spooled(self):
+        """
+        Sends the spooled messages again once the routes change, and at
+        least every retry interval so the next hops that come back before
+        the controller notices get theirs too.
+        """
+
+        while self.running:
+            self.routes_changed.wait(SPOOL_RETRY_INTERVAL)
+            self.routes_changed.clear()
+            for next_hop in self.spool.next_hops():
+                self.send_spooled(next_hop)
+
+    def send_spooled(self, next_hop):
+        """
+        Sends the messages spooled for a next hop over the current routes,
+        oldest first, until one cannot be sent.
+
+        Parameters
+        ----------
+            next_hop : str
+                the next hop the messages could not reach
+        """
+
+        while True:
+            message = self.spool.pop(next_hop)
+            if message is None:
+                return
+            started = time.perf_counter()
+            header = message.header
+            next_router = self.next_router(header.dst_router, header.flow_id)
+            port = None
+            if next_router is not None:
+                port, server_socket, endpoint = self.connect_next_hop(
+                    header, self.network["Ports"][next_router])
+            if port is None:
+                self.spool.restore(message)
+                return
+            try:
+                if endpoint is not None:
+                    server_socket.sendall(tunnel_header(
+                        header, self.router_name, endpoint).encode())
+                bucket = self.link_bucket(port)
+                if bucket is not None:
+                    bucket.consume(message.size)
+                server_socket.sendall(self.spool.frame(message))
+            except OSError as error:
+                print(f"Could not send a spooled message: {error}")
+                self.pool.release(
+                    "localhost", port, server_socket, reuse=False)
+                self.spool.restore(message)
+                return
+            self.pool.release("localhost", port, server_socket)
+            self.spool.release(message)
+            self.count_forwarded(header, port, started)
+
+    def count_forwarded(self, header, port, started):
+        """
+        Records a message sent on in the metrics.
+
+        Parameters
+        ----------
+            header : Header
+                the header of the message
+            port : int
+                the port the message was sent to
+            started : float
+                the perf_counter time the header arrived
+        """
+
+        labels = (self.port_names.get(port, "client"),)
+        self.forwarded_messages.inc(1, labels)
+        self.forwarded_bytes.inc(header.payload_length, labels)
+        self.forwarding_seconds.observe(
+            time.perf_counter() - started, labels)
+
+    def ack_answer(self, session):
+        """
+        Builds the answer to a status check of the controller.
+
+        Parameters
+        ----------
+            session : int
+                the session of the status check
+
+        Returns
+        -------
+            frame : bytes
+                the encoded answer
+        """
+
+        ack_answer = "I am ok"
+        return encode_frame(
+            Header(KIND_CONTROL, src=self.router_name, flow_id=session),
+            self.cipher.encrypt(ack_answer.encode(), session))
+
+    def register_client(self, client_port):
+        """
+        Reports a client connected to this router to the client directory of
+        the controller, over the control channel.
 
-    def next_router(self, destination):
+        Parameters
+        ----------
+            client_port : str
+                the port the client listens on
         """
-        Determines the next router for a given destination.
+
+        self.clients.append(client_port)
+        if self.controller_socket is None:
+            print(f"Client {client_port} not registered, no controller")
+            return
+        # The acknowledgements of routes share the channel
+        with self.controller_lock:
+            self.controller_socket.sendall(
+                self.registration_frame(client_port))
+
+    def registration_frame(self, client_port):
+        """
+        Builds the registration of a client for the controller.
+
+        Parameters
+        ----------
+            client_port : str
+                the port the client listens on
+
+        Returns
+        -------
+            frame : bytes
+                the encoded registration
+        """
+
+        registration = json.dumps(
+            {"register": client_port, "router": self.router_name})
+        return encode_frame(
+            Header(KIND_CONTROL, src=self.router_name, flow_id=self.session),
+            self.cipher.encrypt(registration.encode(), self.session))
+
+    def destination_port(self, header):
+        """
+        Determines where a message goes next: the receiving client when it is
+        connected to this router, the next router otherwise. Raises
+        ProtocolError when the receiving client is not a port.
+
+        Parameters
+        ----------
+            header : Header
+                the header of the message
+
+        Returns
+        -------
+            port : int
+                the port to send the message to, None when there is no
+                route to its destination
+        """
+
+        if header.dst_router == self.router_name:
+            if not (header.dst.isascii() and header.dst.isdigit()
+                    and 0 < int(header.dst) < 65536):
+                raise ProtocolError(
+                    f"Destination {header.dst!r} is not a port")
+            print(f"Message from {header.src} delivered to {header.dst}")
+            return int(header.dst)
+
+        next_router = self.next_router(header.dst_router, header.flow_id)
+        if next_router is None:
+            print(f"No route to {header.dst_router}, message dropped")
+            self.dropped_messages.inc(1, ("no route",))
+            return None
+        print(f"Next router {next_router}")
+        print(f"data forwarded to {next_router}")
+        return self.network["Ports"][next_router]
+
+    def next_router(self, destination, flow_id=None):
+        """
+        Determines the next router for a given destination, without any
+        side effect so the simulation can call it on every hop.
 
         Parameters
         ----------
             destination : str
                 the destination router
+            flow_id : int, optional
+                the flow of the message, to pick one of several paths
 
         Returns
         -------
@@ -141,16 +671,63 @@ class Router:
                 the next router on the path to the destination
         """
 
-        source = self.router_name
+        paths = self.multipaths.get(destination)
+        if paths is None or flow_id is None:
+            return self.next_hops.get(destination)
+        return self.spread(paths, flow_id)
+
+    def alternate_router(self, destination, failed):
+        """
+        Finds another next router for a destination when one is unreachable:
+        the backup the controller computed, a neighbor or a router to tunnel
+        to, or another of its paths.
+
+        Parameters
+        ----------
+            destination : str
+                the destination router
+            failed : str
+                the unreachable next router
+
+        Returns
+        -------
+            alternate : str
+                a router not known unreachable, None when there is none
+        """
 
-        for dictionary in self.json_routes:
-            if dictionary["source"] == source and dictionary["destination"] == destination:
-                path = dictionary["path"]
-                next_router = path[path.index(source) + 1]
-                print(f"Next router {next_router}")
-                return next_router
+        hops, _ = self.multipaths.get(destination, ((), ()))
+        for alternate in (self.backups.get(destination),) + hops:
+            if alternate is not None and alternate != failed and \
+                    alternate not in self.unreachable:
+                return alternate
         return None
 
+    def spread(self, paths, flow_id):
+        """
+        Picks one of several next hops for a flow, in proportion to their
+        weights. Every message of a flow takes the same path, and each
+        router salts the hash with its name so routers along a path do not
+        all make the same choice.
+
+        Parameters
+        ----------
+            paths : tuple
+                the next hops and their cumulated weights
+            flow_id : int
+                the flow of the message
+
+        Returns
+        -------
+            next_router : str
+                the next router of the flow
+        """
+
+        hops, cumulated = paths
+        mixed = ((flow_id ^ self.flow_salt) * FLOW_HASH_MULTIPLIER) \
+            & FLOW_HASH_MASK
+        point = mixed / (FLOW_HASH_MASK + 1) * cumulated[-1]
+        return hops[min(bisect.bisect_right(cumulated, point), len(hops) - 1)]
+
     def write_json(self, data, filename="Json/paths.json"):
         """
         Writes data to a JSON file.
@@ -188,7 +765,8 @@ class Router:
 
     def connect_to_controller(self, server_host, server_port):
         """
-        Connects to the controller.
+        Connects to the controller and keeps the connection open as the
+        control channel the routes are pushed through.
 
         Parameters
         ----------
@@ -199,48 +777,263 @@ class Router:
         """
 
         # Create a TCP client socket
-        controller_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.controller_socket = socket.socket(
+            socket.AF_INET, socket.SOCK_STREAM)
         # Connect to the server
-        controller_socket.connect((server_host, server_port))
-        controller_socket.sendall(
-            self.fernet.encrypt(self.router_name.encode())
-        )
+        self.controller_socket.connect((server_host, server_port))
+        # The whole control channel is one session
+        send_frame(self.controller_socket,
+                   Header(KIND_CONTROL, src=self.router_name,
+                          flow_id=self.session),
+                   self.cipher.encrypt(self.router_name.encode(), self.session))
         print(f"{self.router_name} Waiting for the paths")
-        controller_socket.close()
+        control_thread = threading.Thread(target=self.listen_to_controller)
+        control_thread.start()
+        if self.shaper is not None:
+            report_thread = threading.Thread(
+                target=self.report_utilization, daemon=True)
+            report_thread.start()
+        if self.spool is not None:
+            retry_thread = threading.Thread(
+                target=self.retry_spooled, daemon=True)
+            retry_thread.start()
+
+    def utilization_frame(self):
+        """
+        Builds the report of the utilization of the links for the controller.
 
-    def send_to_server(self, server_host, server_port, message, audio=None):
+        Returns
+        -------
+            frame : bytes
+                the encoded report
+        """
+
+        report = json.dumps({"utilization": self.shaper.utilization()})
+        return encode_frame(
+            Header(KIND_CONTROL, src=self.router_name, flow_id=self.session),
+            self.cipher.encrypt(report.encode(), self.session))
+
+    def report_utilization(self):
+        """
+        Reports the utilization of the links to the controller every report
+        interval, over the control channel.
+        """
+
+        while self.running:
+            time.sleep(self.report_interval)
+            try:
+                with self.controller_lock:
+                    self.controller_socket.sendall(self.utilization_frame())
+            except OSError:
+                break
+
+    def listen_to_controller(self):
+        """
+        Applies the route updates pushed by the controller and acknowledges
+        each routes version.
+        """
+
+        reader = self.controller_socket.makefile("rb")
+        while True:
+            header, payload = read_frame(reader)
+            if header is None:
+                break
+            update = json.loads(
+                self.cipher.decrypt(payload, self.session).decode())
+            self.apply_routes(update)
+            self.routes_changed.set()
+            ack = json.dumps({"ack": update["version"]})
+            with self.controller_lock:
+                send_frame(self.controller_socket,
+                           Header(KIND_CONTROL, src=self.router_name,
+                                  flow_id=self.session),
+                           self.cipher.encrypt(ack.encode(), self.session))
+        print(f"{self.router_name} lost the connection with the controller")
+
+    def apply_routes(self, update):
+        """
+        Applies a routes version to the forwarding table.
+
+        Parameters
+        ----------
+            update : dict
+                the routes version, either a full table or the changes from
+                the previous version
+        """
+
+        if update["full"]:
+            next_hops = {}
+            multipaths = {}
+            backups = {}
+        else:
+            next_hops = dict(self.next_hops)
+            multipaths = dict(self.multipaths)
+            backups = dict(self.backups)
+            for destination in update["removed"]:
+                next_hops.pop(destination, None)
+                multipaths.pop(destination, None)
+            for destination in update.get("removed_backups", ()):
+                backups.pop(destination, None)
+        backups.update(update.get("backups", {}))
+        for destination, route in update["routes"].items():
+            if isinstance(route, str):
+                next_hops[destination] = route
+                multipaths.pop(destination, None)
+                continue
+            # Several [next router, weight], the shortest path first
+            next_hops[destination] = route[0][0]
+            weights = itertools.accumulate(weight for _, weight in route)
+            multipaths[destination] = (
+                tuple(hop for hop, _ in route), tuple(weights))
+        # Swap the whole tables at once so concurrent lookups never see
+        # a half-built forwarding table
+        self.next_hops = next_hops
+        self.multipaths = multipaths
+        self.backups = backups
+        # The controller routes around the routers it found down, try the
+        # others again
+        self.unreachable = set()
+        self.routes_version = update["version"]
+
+    def send_to_server(self, server_socket, server_port, header, payload,
+                       ticket=None):
         """
         Sends a message to the server.
 
         Parameters
         ----------
-            server_host : str
-                the host address of the server
+            server_socket : socket
+                the connection to the server
             server_port : int
                 the port number of the server
-            message : str
-                the message to be sent
-            audio : Any
-                the audio to be sent
+            header : Header
+                the header of the message
+            payload : bytes
+                the payload of the message
+            ticket : Ticket, optional
+                the turns of the message in the scheduler
         """
 
+        bucket = self.link_bucket(server_port)
+        if bucket is not None:
+            bucket.consume(len(payload))
+        if ticket is None:
+            send_frame(server_socket, header, payload)
+            return
+        ticket.acquire(len(payload))
         try:
-            # Create a TCP client socket
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # Connect to the server
-            server_socket.connect((server_host, server_port))
-            # Send the message to the server
-            server_socket.sendall(self.fernet.encrypt(message.encode()))
-
-            if audio is not None:
-                server_socket.recv(1024)
-                server_socket.sendall(audio)
+            send_frame(server_socket, header, payload)
         finally:
-            # Close the client socket
-            server_socket.close()
+            ticket.release()
+
+    def relay_to_server(self, server_socket, server_port, header, reader,
+                        buffer, ticket=None):
+        """
+        Sends a message to the server while its payload is still arriving.
+        The header goes out first and the payload follows chunk by chunk, so
+        memory stays bounded by the buffer whatever the size of the message.
+
+        Parameters
+        ----------
+            server_socket : socket
+                the connection to the server
+            server_port : int
+                the port number of the server
+            header : Header
+                the header of the message
+            reader : file
+                the buffered reader the payload is read from
+            buffer : bytearray
+                the buffer to relay the payload through
+            ticket : Ticket, optional
+                the turns of the message in the scheduler
+        """
+
+        server_socket.sendall(header.encode())
+        relay_payload(reader, server_socket, header.payload_length, buffer,
+                      self.link_bucket(server_port), ticket)
+
+
+def flow_salt(router_name):
+    """
+    Derives the salt of the flow hash of a router from its name, the same
+    in every run.
+    """
+    return zlib.crc32(router_name.encode()) * FLOW_HASH_MULTIPLIER \
+        & FLOW_HASH_MASK
 
 
 # Example usage
 if __name__ == "__main__":
-    router = Router()
+    parser = argparse.ArgumentParser(description="Start a router.")
+    parser.add_argument(
+        "--engine", choices=["threads", "asyncio"], default="threads",
+        help="serve connections with a thread each or on an asyncio loop")
+    parser.add_argument(
+        "--shape-scale", type=float,
+        help="hold links to their bandwidth times this factor and report "
+             "their utilization")
+    parser.add_argument(
+        "--report-interval", type=float, default=1.0,
+        help="seconds between two link utilization reports")
+    parser.add_argument(
+        "--spool", action="store_true",
+        help="hold the messages of unreachable next hops until the routes "
+             "change")
+    parser.add_argument(
+        "--spool-messages", type=int, default=1024,
+        help="messages held per next hop")
+    parser.add_argument(
+        "--spool-bytes", type=int, default=64 * 2**20,
+        help="bytes held per next hop")
+    parser.add_argument(
+        "--spool-ttl", type=float, default=30.0,
+        help="seconds a message may be held")
+    parser.add_argument(
+        "--spool-policy", choices=POLICIES, default="drop-newest",
+        help="refuse new messages or drop the oldest when full")
+    parser.add_argument(
+        "--spool-dir",
+        help="hold messages in segment files of this directory")
+    parser.add_argument(
+        "--scheduler", action="store_true",
+        help="send control messages first, then texts, then audios")
+    parser.add_argument(
+        "--scheduler-workers", type=int, default=2,
+        help="chunks sent at once")
+    parser.add_argument(
+        "--scheduler-texts", type=int, default=1024,
+        help="texts forwarded at once, more wait for room")
+    parser.add_argument(
+        "--scheduler-audios", type=int, default=64,
+        help="audios forwarded at once, more wait for room")
+    parser.add_argument(
+        "--scheduler-waiting", type=int, default=4096,
+        help="messages of each kind waiting for room, more are dropped")
+    parser.add_argument(
+        "--metrics-port", type=int,
+        help="serve the metrics over HTTP on this port")
+    args = parser.parse_args()
+
+    spool = None
+    if args.spool:
+        spool = Spool(args.spool_messages, args.spool_bytes, args.spool_ttl,
+                      args.spool_policy, args.spool_dir)
+    scheduler = None
+    if args.scheduler:
+        scheduler = Scheduler(
+            args.scheduler_workers,
+            {"text": args.scheduler_texts, "bulk": args.scheduler_audios},
+            dict.fromkeys(CLASSES, args.scheduler_waiting))
+    if args.engine == "asyncio":
+        from async_router import AsyncRouter
+        router = AsyncRouter(shape_scale=args.shape_scale,
+                             report_interval=args.report_interval,
+                             spool=spool, scheduler=scheduler)
+    else:
+        router = Router(shape_scale=args.shape_scale,
+                        report_interval=args.report_interval, spool=spool,
+                        scheduler=scheduler)
+    if args.metrics_port is not None:
+        router.metrics.serve(args.metrics_port)
     router.start()
@@ -0,0 +1,446 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from metrics import MetricsRegistry
+from protocol import KIND_AUDIO, KIND_CONTROL, KIND_TEXT, KIND_TUNNEL
+
+# Classes in the order they are served
+CLASSES = ("control", "text", "bulk")
+KIND_CLASSES = {
+    KIND_CONTROL: "control",
+    KIND_TEXT: "text",
+    # A tunnel may carry either, it only exists while a router fails over
+    KIND_TUNNEL: "text",
+    KIND_AUDIO: "bulk",
+}
+
+
+class Turn:
+    """
+    A chunk waiting for its turn to be sent, woken by grant.
+    """
+
+    __slots__ = ("size", "granted", "wakeup")
+
+    def __init__(self, size, lock):
+        self.size = size
+        self.granted = False
+        self.wakeup = threading.Condition(lock)
+
+    def grant(self):
+        self.granted = True
+        self.wakeup.notify()
+        return True
+
+
+class AsyncTurn:
+    """
+    A chunk of a coroutine waiting for its turn to be sent.
+    """
+
+    __slots__ = ("size", "future")
+
+    def __init__(self, size, future):
+        self.size = size
+        self.future = future
+
+    def grant(self):
+        # The coroutine may have been cancelled while it waited
+        if self.future.cancelled():
+            return False
+        self.future.set_result(None)
+        return True
+
+
+class FlowQueue:
+    """
+    The chunks of a flow waiting in a class and the bytes the flow may
+    still send in the current round.
+    """
+
+    __slots__ = ("turns", "deficit")
+
+    def __init__(self):
+        self.turns = deque()
+        self.deficit = 0
+
+
+class Scheduler:
+    """
+    A class to decide in which order the messages a router forwards use it.
+
+    Messages fall into three classes by kind, served in order: control,
+    interactive text and bulk audio. Payloads go out chunk by chunk, each
+    chunk waiting for its turn, and at most a few chunks are sent at once,
+    so a new control or text message waits for a handful of chunks instead
+    of every bulk transfer in progress. Within a class, flows share the
+    turns with deficit round robin, the same bytes per round each whatever
+    the size of their chunks. Every class admits a bounded number of
+    messages at once, the next ones wait for room without being read, so
+    bulk transfers queue up at their senders instead of in the router, and
+    only when too many wait are messages refused.
+    """
+
+    def __init__(self, workers=2, max_messages=None, max_waiting=None,
+                 quantum=65536):
+        """
+        Constructs all the necessary attributes for the scheduler object.
+
+        Parameters
+        ----------
+            workers : int, optional
+                the chunks sent at once (default is 2)
+            max_messages : dict, optional
+                the messages each class admits at once (default is 1024
+                control and text messages and 64 bulk ones)
+            max_waiting : dict, optional
+                the messages each class keeps waiting for room, the next
+                ones are refused (default is 4096 for every class)
+            quantum : int, optional
+                the bytes a flow may send per round (default is 64 KB)
+        """
+        self.workers = workers
+        self.max_messages = {"control": 1024, "text": 1024, "bulk": 64}
+        self.max_messages.update(max_messages or {})
+        self.max_waiting = {name: 4096 for name in CLASSES}
+        self.max_waiting.update(max_waiting or {})
+        self.quantum = quantum
+        self.lock = threading.Lock()
+        self.active = 0
+        # Control frames being handled, no chunk starts meanwhile
+        self.controlling = 0
+        self.waiting = {name: OrderedDict() for name in CLASSES}
+        self.queued = {name: 0 for name in CLASSES}
+        self.admitted = {name: 0 for name in CLASSES}
+        # Messages waiting for room, handed it in order as others close
+        self.admitting = {name: deque() for name in CLASSES}
+        self.create_metrics(MetricsRegistry())
+
+    def create_metrics(self, registry, prefix="scheduler"):
+        """
+        Creates the metrics of the scheduler in a registry.
+
+        Parameters
+        ----------
+            registry : MetricsRegistry
+                the registry of the component the scheduler belongs to
+            prefix : str, optional
+                the start of the name of every metric (default is
+                'scheduler')
+        """
+        registry.gauge(
+            f"{prefix}_admitted_messages", "Messages admitted, by class",
+            ("class",), function=lambda: {
+                (name,): count for name, count in self.admitted.items()})
+        registry.gauge(
+            f"{prefix}_waiting_messages",
+            "Messages waiting for room, by class", ("class",),
+            function=lambda: {
+                (name,): len(waiting)
+                for name, waiting in self.admitting.items()})
+        registry.gauge(
+            f"{prefix}_queued_chunks", "Chunks waiting for a turn, by class",
+            ("class",), function=lambda: {
+                (name,): count for name, count in self.queued.items()})
+        self.rejected = registry.counter(
+            f"{prefix}_rejected_total",
+            "Messages refused by admission control, by class", ("class",))
+        self.wait_seconds = registry.histogram(
+            f"{prefix}_wait_seconds",
+            "Seconds a chunk waited for its turn, by class", ("class",))
+
+    def admit(self, header):
+        """
+        Admits a message, waiting for room in its class when it is full.
+
+        Parameters
+        ----------
+            header : Header
+                the header of the message
+
+        Returns
+        -------
+            ticket : Ticket
+                the turns of the message, to close once it was sent, None
+                when the message is refused
+        """
+        name = KIND_CLASSES.get(header.kind, "bulk")
+        with self.lock:
+            admitted = self.room(name)
+            if admitted is None:
+                turn = Turn(0, self.lock)
+                self.admitting[name].append(turn)
+                while not turn.granted:
+                    turn.wakeup.wait()
+                admitted = True
+        return self.ticket(admitted, name, header.flow_id)
+
+    async def admit_async(self, header):
+        """
+        Admits a message from a coroutine, waiting for room in its class
+        when it is full.
+
+        Parameters
+        ----------
+            header : Header
+                the header of the message
+
+        Returns
+        -------
+            ticket : Ticket
+                the turns of the message, to close once it was sent, None
+                when the message is refused
+        """
+        name = KIND_CLASSES.get(header.kind, "bulk")
+        with self.lock:
+            admitted = self.room(name)
+            if admitted is None:
+                turn = AsyncTurn(
+                    0, asyncio.get_running_loop().create_future())
+                self.admitting[name].append(turn)
+        if admitted is None:
+            try:
+                await turn.future
+            except asyncio.CancelledError:
+                with self.lock:
+                    if turn.future.cancelled():
+                        self.admitting[name].remove(turn)
+                    else:
+                        # Admitted just before the cancel, pass the room on
+                        self.leave(name)
+                raise
+            admitted = True
+        return self.ticket(admitted, name, header.flow_id)
+
+    def room(self, name):
+        """
+        Takes room for a message in its class. Must be called with the lock
+        held.
+
+        Returns
+        -------
+            admitted : bool
+                True when the message was admitted, False when it is
+                refused and None when it must wait
+        """
+        if self.admitted[name] < self.max_messages[name]:
+            self.admitted[name] += 1
+            return True
+        if len(self.admitting[name]) >= self.max_waiting[name]:
+            return False
+        return None
+
+    def ticket(self, admitted, name, flow_id):
+        """
+        Returns the ticket of an admitted message, None after counting a
+        refused one.
+        """
+        if not admitted:
+            self.rejected.inc(1, (name,))
+            return None
+        return Ticket(self, name, flow_id)
+
+    def leave(self, name):
+        """
+        Hands the room of a message that was sent to the first one waiting
+        in its class. Must be called with the lock held.
+        """
+        waiting = self.admitting[name]
+        while waiting:
+            if waiting.popleft().grant():
+                return
+        self.admitted[name] -= 1
+
+    def control(self):
+        """
+        Returns a context in which control frames are handled before any
+        other chunk starts.
+        """
+        return ControlTurn(self)
+
+    def free_turn(self):
+        """
+        Takes a turn at once when one is free and nothing waits for it.
+        Must be called with the lock held.
+        """
+        if self.active < self.workers and not self.controlling and \
+                not any(self.queued.values()):
+            self.active += 1
+            return True
+        return False
+
+    def enqueue(self, name, flow_id, turn):
+        """
+        Puts a chunk in the queue of its flow and hands out the free turns.
+        Must be called with the lock held.
+        """
+        flow = self.waiting[name].get(flow_id)
+        if flow is None:
+            flow = self.waiting[name][flow_id] = FlowQueue()
+        flow.turns.append(turn)
+        self.queued[name] += 1
+        self.dispatch()
+
+    def release(self):
+        """
+        Gives a turn back once its chunk was sent.
+        """
+        with self.lock:
+            self.active -= 1
+            self.dispatch()
+
+    def dispatch(self):
+        """
+        Grants the free turns to the waiting chunks, the first class with
+        chunks waiting first. Must be called with the lock held.
+        """
+        while self.active < self.workers and not self.controlling:
+            for name in CLASSES:
+                if self.queued[name]:
+                    break
+            else:
+                return
+            turn = self.next_turn(self.waiting[name])
+            self.queued[name] -= 1
+            if turn.grant():
+                self.active += 1
+
+    def withdraw(self, name, flow_id, turn):
+        """
+        Takes a chunk out of the queue of its flow, if still there. Must be
+        called with the lock held.
+        """
+        flow = self.waiting[name].get(flow_id)
+        if flow is None or turn not in flow.turns:
+            return
+        flow.turns.remove(turn)
+        self.queued[name] -= 1
+        if not flow.turns:
+            del self.waiting[name][flow_id]
+
+    def next_turn(self, flows):
+        """
+        Picks the next chunk of a class with deficit round robin: the flow
+        at the head sends while its deficit covers its next chunk, then
+        gets a quantum more and goes to the back.
+        """
+        while True:
+            flow_id, flow = next(iter(flows.items()))
+            if flow.deficit >= flow.turns[0].size:
+                break
+            flow.deficit += self.quantum
+            flows.move_to_end(flow_id)
+        turn = flow.turns.popleft()
+        flow.deficit -= turn.size
+        if not flow.turns:
+            # An idle flow does not keep its deficit for later
+            del flows[flow_id]
+        return turn
+
+
+class Ticket:
+    """
+    The turns of an admitted message.
+    """
+
+    def __init__(self, scheduler, name, flow_id):
+        """
+        Constructs all the necessary attributes for the ticket object.
+
+        Parameters
+        ----------
+            scheduler : Scheduler
+                the scheduler that admitted the message
+            name : str
+                the class of the message
+            flow_id : int
+                the flow of the message
+        """
+        self.scheduler = scheduler
+        self.name = name
+        self.flow_id = flow_id
+        self.labels = (name,)
+
+    def acquire(self, size):
+        """
+        Waits for the turn of a chunk of the message.
+
+        Parameters
+        ----------
+            size : int
+                the bytes of the chunk
+        """
+        scheduler = self.scheduler
+        with scheduler.lock:
+            if scheduler.free_turn():
+                return
+            started = time.perf_counter()
+            turn = Turn(size, scheduler.lock)
+            scheduler.enqueue(self.name, self.flow_id, turn)
+            while not turn.granted:
+                turn.wakeup.wait()
+        scheduler.wait_seconds.observe(
+            time.perf_counter() - started, self.labels)
+
+    async def acquire_async(self, size):
+        """
+        Waits for the turn of a chunk of the message from a coroutine.
+
+        Parameters
+        ----------
+            size : int
+                the bytes of the chunk
+        """
+        scheduler = self.scheduler
+        with scheduler.lock:
+            if scheduler.free_turn():
+                return
+            started = time.perf_counter()
+            turn = AsyncTurn(
+                size, asyncio.get_running_loop().create_future())
+            scheduler.enqueue(self.name, self.flow_id, turn)
+        try:
+            await turn.future
+        except asyncio.CancelledError:
+            with scheduler.lock:
+                if turn.future.cancelled():
+                    scheduler.withdraw(self.name, self.flow_id, turn)
+                else:
+                    # Granted just before the cancel, give the turn back
+                    scheduler.active -= 1
+                    scheduler.dispatch()
+            raise
+        scheduler.wait_seconds.observe(
+            time.perf_counter() - started, self.labels)
+
+    def release(self):
+        """
+        Gives the turn of a chunk back once it was sent.
+        """
+        self.scheduler.release()
+
+    def close(self):
+        """
+        Frees the room of the message in its class once it was sent.
+        """
+        with self.scheduler.lock:
+            self.scheduler.leave(self.name)
+
+
+class ControlTurn:
+    """
+    Holds the chunks back while a control frame is handled.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def __enter__(self):
+        with self.scheduler.lock:
+            self.scheduler.controlling += 1
+
+    def __exit__(self, *exc_info):
+        with self.scheduler.lock:
+            self.scheduler.controlling -= 1
+            self.scheduler.dispatch()
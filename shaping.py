@@ -0,0 +1,221 @@
+import time
+import threading
+
+# Bandwidth of the links that give none in network.json
+DEFAULT_BANDWIDTH_GBPS = 10
+
+
+class TokenBucket:
+    """
+    A class to hold the bytes sent over a link to its rate.
+
+    Tokens build up at the rate of the link, up to the burst. Sending takes
+    tokens and may leave the bucket in debt, and the sender then waits
+    until the debt is paid back. Concurrent senders queue up behind the
+    debt, so the link never goes faster than its rate on average.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Constructs all the necessary attributes for the bucket object.
+
+        Parameters
+        ----------
+            rate : float
+                bytes per second
+            burst : float, optional
+                bytes that may be sent at once after the link was idle
+                (default is a hundredth of a second of traffic, at least
+                128 KB)
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate / 100, 131072)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Takes the tokens of bytes about to be sent.
+
+        Parameters
+        ----------
+            amount : int
+                the bytes
+
+        Returns
+        -------
+            wait : float
+                seconds to wait before sending them
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            self.sent += amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def consume(self, amount):
+        """
+        Waits until bytes may be sent.
+        """
+        wait = self.reserve(amount)
+        if wait:
+            time.sleep(wait)
+
+
+class LinkShaper:
+    """
+    A class to shape the links of a router, a token bucket each, and measure
+    how much of their rate they use.
+    """
+
+    def __init__(self, rates):
+        """
+        Constructs all the necessary attributes for the shaper object.
+
+        Parameters
+        ----------
+            rates : dict
+                the bytes per second of the link towards every neighbor
+        """
+        self.buckets = {
+            neighbor: TokenBucket(rate) for neighbor, rate in rates.items()}
+        now = time.monotonic()
+        self.measured = {neighbor: (0, now) for neighbor in self.buckets}
+
+    def bucket(self, neighbor):
+        """
+        Returns the bucket of the link towards a neighbor, or None.
+        """
+        return self.buckets.get(neighbor)
+
+    def utilization(self):
+        """
+        Measures the share of its rate every link used since the last call.
+
+        Returns
+        -------
+            utilization : dict
+                the utilization of the link towards every neighbor, from 0
+        """
+        utilization = {}
+        now = time.monotonic()
+        for neighbor, bucket in self.buckets.items():
+            sent, since = self.measured[neighbor]
+            total = bucket.sent
+            elapsed = now - since
+            if elapsed > 0:
+                utilization[neighbor] = (total - sent) / elapsed / bucket.rate
+            self.measured[neighbor] = (total, now)
+        return utilization
+
+
+class CongestionTracker:
+    """
+    A class to turn the link utilizations routers report into link costs.
+
+    Reports are smoothed with an exponentially weighted moving average, so
+    a short burst does not move routes. A link becomes congested once its
+    smoothed utilization goes above the high mark and clear again only once
+    it falls below the low mark, and it keeps a state for at least the hold
+    down time. The gap between the marks and the hold down keep routes from
+    flapping when traffic moving away from a link empties it.
+    """
+
+    def __init__(self, high=0.8, low=0.5, smoothing=0.3, penalty=4.0,
+                 hold_down=5.0):
+        """
+        Constructs all the necessary attributes for the tracker object.
+
+        Parameters
+        ----------
+            high : float, optional
+                smoothed utilization above which a link is congested
+                (default is 0.8)
+            low : float, optional
+                smoothed utilization below which a congested link is clear
+                again (default is 0.5)
+            smoothing : float, optional
+                weight of a new report in the average (default is 0.3)
+            penalty : float, optional
+                factor of the cost of a congested link (default is 4)
+            hold_down : float, optional
+                seconds a link keeps its state at least (default is 5)
+        """
+        if not 0 <= low <= high:
+            raise ValueError("The low mark must be between 0 and the high.")
+        self.high = high
+        self.low = low
+        self.smoothing = smoothing
+        self.penalty = penalty
+        self.hold_down = hold_down
+        # Smoothed utilization of each direction of a link
+        self.smoothed = {}
+        self.congested = set()
+        self.changed_at = {}
+        self.lock = threading.Lock()
+
+    def report(self, router, utilization, now):
+        """
+        Records the utilization of the links of a router.
+
+        Parameters
+        ----------
+            router : str
+                the router reporting
+            utilization : dict
+                the utilization of the link towards every neighbor
+            now : float
+                the time of the report
+
+        Returns
+        -------
+            changed : dict
+                the cost factor of every link, as a sorted pair of routers,
+                that became congested or clear
+        """
+        changed = {}
+        with self.lock:
+            for neighbor, value in utilization.items():
+                direction = (router, neighbor)
+                previous = self.smoothed.get(direction, value)
+                self.smoothed[direction] = previous + self.smoothing * (
+                    value - previous)
+                link = tuple(sorted(direction))
+                level = max(self.smoothed.get((router, neighbor), 0.0),
+                            self.smoothed.get((neighbor, router), 0.0))
+                if now - self.changed_at.get(link, -self.hold_down) < \
+                        self.hold_down:
+                    continue
+                if link in self.congested and level < self.low:
+                    self.congested.discard(link)
+                elif link not in self.congested and level > self.high:
+                    self.congested.add(link)
+                else:
+                    continue
+                self.changed_at[link] = now
+                changed[link] = self.multiplier(*link)
+        return changed
+
+    def multiplier(self, first, second):
+        """
+        Returns the cost factor of the link between two routers.
+        """
+        if tuple(sorted((first, second))) in self.congested:
+            return self.penalty
+        return 1.0
+
+    def forget(self, router):
+        """
+        Drops the links of a router that left the network.
+        """
+        with self.lock:
+            for direction in [d for d in self.smoothed if router in d]:
+                del self.smoothed[direction]
+            for link in [link for link in self.congested if router in link]:
+                self.congested.discard(link)
+                self.changed_at.pop(link, None)
@@ -0,0 +1,584 @@
+import os
+import time
+import heapq
+import random
+import argparse
+import tempfile
+import itertools
+from array import array
+import numpy as np
+from controller import Controller
+from router import Router
+from shaping import DEFAULT_BANDWIDTH_GBPS, CongestionTracker
+from topology_generator import TOPOLOGIES, generate_network, write_network
+
+# Light travels through fiber at about two thirds of its speed in vacuum
+FIBER_KM_PER_SECOND = 200000
+
+
+class Simulation:
+    """
+    A discrete-event simulation of the whole network in a single process.
+
+    The controller, the routers and their links keep their logic, path
+    computation, route versions, next hop forwarding, failure detection and
+    failover, but talk through events on a virtual clock instead of
+    sockets. Every message hop is an event, so the simulation runs as fast
+    as the events can be processed, and the same seed always gives the same
+    run.
+    """
+
+    def __init__(self, network_file="Json/network.json", algorithm="dijkstra",
+                 seed=0, processing_delay=10e-6, control_delay=0.005,
+                 buffer_bytes=2**20, report_interval=0.5,
+                 **controller_options):
+        """
+        Constructs all the necessary attributes for the simulation object.
+
+        Parameters
+        ----------
+            network_file : str, optional
+                the topology to simulate (default is "Json/network.json")
+            algorithm : str, optional
+                the path engine of the controller (default is 'dijkstra')
+            seed : int, optional
+                the seed of the traffic (default is 0)
+            processing_delay : float, optional
+                seconds a router takes to forward a message (default is
+                10 microseconds)
+            control_delay : float, optional
+                seconds between the controller and any router, one way
+                (default is 5 ms)
+            buffer_bytes : int, optional
+                bytes a link can hold waiting to be sent before it drops
+                messages (default is 1 MB)
+            report_interval : float, optional
+                seconds between two link utilization reports of every
+                router, when the controller is given a congestion tracker
+                (default is 0.5)
+            **controller_options
+                passed to the controller, such as the detector settings
+        """
+        self.now = 0.0
+        self.events = []
+        self.sequence = itertools.count()
+        self.rng = random.Random(seed)
+        self.processing_delay = processing_delay
+        self.control_delay = control_delay
+        self.buffer_bytes = buffer_bytes
+        self.report_interval = report_interval
+        self.controller = SimulatedController(
+            self, network_file, algorithm, **controller_options)
+        self.routers = {
+            name: SimulatedRouter(name, self.controller.network)
+            for name in self.controller.network["Nodes"]}
+        for link in self.controller.network["Links"]:
+            first, second = [
+                self.controller.network_names[node_id]
+                for node_id in (link["from"], link["to"])]
+            bandwidth = link.get("bandwidth", DEFAULT_BANDWIDTH_GBPS) * 1e9
+            delay = link["distance"] / FIBER_KM_PER_SECOND
+            self.routers[first].links[second] = SimulatedLink(delay, bandwidth)
+            self.routers[second].links[first] = SimulatedLink(delay, bandwidth)
+        self.stats = SimulationStats()
+        self.processed = 0
+
+    def schedule(self, delay, callback, *args):
+        """
+        Runs a callback after a delay of virtual time.
+        """
+        heapq.heappush(self.events, (
+            self.now + delay, next(self.sequence), callback, args))
+
+    def run(self, until=None):
+        """
+        Processes the events in time order.
+
+        Parameters
+        ----------
+            until : float, optional
+                the virtual time to stop at (default is when no event is
+                left)
+        """
+        events = self.events
+        pop = heapq.heappop
+        processed = 0
+        while events and (until is None or events[0][0] <= until):
+            self.now, _, callback, args = pop(events)
+            callback(*args)
+            processed += 1
+        self.processed += processed
+        if until is not None:
+            self.now = max(self.now, until)
+
+    def start(self):
+        """
+        Registers every router with the controller, which then computes and
+        pushes the routes and starts checking the routers.
+        """
+        self.controller.bootstrap()
+        self.schedule(self.controller.health.interval,
+                      self.controller.check_routers)
+        if self.controller.congestion is not None:
+            self.schedule(self.report_interval, self.report_utilization)
+
+    def report_utilization(self):
+        """
+        Has every router that is up report the utilization of its links
+        since the last report to the controller.
+        """
+        for name, router in self.routers.items():
+            if not router.up:
+                continue
+            utilization = {}
+            for neighbor, link in router.links.items():
+                utilization[neighbor] = \
+                    link.sent * 8 / link.bandwidth / self.report_interval
+                link.sent = 0
+            self.schedule(self.control_delay,
+                          self.controller.link_utilization, name, utilization)
+        self.schedule(self.report_interval, self.report_utilization)
+
+    def fail_router(self, name, at):
+        """
+        Stops a router at a virtual time, with every message it holds.
+        """
+        self.schedule(at - self.now, self.set_router_up, name, False)
+
+    def recover_router(self, name, at):
+        """
+        Restarts a router at a virtual time, empty, and registers it again.
+        """
+        self.schedule(at - self.now, self.set_router_up, name, True)
+
+    def set_router_up(self, name, up):
+        """
+        Stops or restarts a router; a restarted router registers again.
+        """
+        router = self.routers[name]
+        router.up = up
+        if up:
+            # A restarted router has lost its forwarding table
+            router.apply_routes({"version": 0, "full": True, "routes": {}})
+            self.schedule(self.control_delay,
+                          self.controller.rejoin, name)
+
+    def send(self, source, destination, size, at=None):
+        """
+        Has the client of a router send a message to the client of another.
+
+        Parameters
+        ----------
+            source : str
+                the router the message enters at
+            destination : str
+                the router the message leaves at
+            size : int
+                the size of the message in bytes
+            at : float, optional
+                the virtual time it is sent (default is now)
+        """
+        delay = 0.0 if at is None else at - self.now
+        self.schedule(delay, self.arrive, source,
+                      (destination, size, self.now + delay, 0,
+                       self.rng.getrandbits(64)))
+
+    def add_traffic(self, rate, size, start=0.0, stop=None, routers=None,
+                    destinations=None):
+        """
+        Sends messages between random pairs of routers, spaced as a Poisson
+        process. Arrivals are drawn one at a time, so millions of messages
+        never sit in the event queue together.
+
+        Parameters
+        ----------
+            rate : float
+                messages per second over the whole network
+            size : int
+                the size of every message in bytes
+            start : float, optional
+                the virtual time of the first message (default is 0)
+            stop : float, optional
+                the virtual time to stop at (default is never)
+            routers : list, optional
+                the routers sending and receiving (default is every router)
+            destinations : list, optional
+                the routers receiving, the others of routers only sending
+                (default is the routers)
+        """
+        routers = list(routers or self.routers)
+        pick = self.rng.randrange
+        flow = self.rng.getrandbits
+
+        if destinations is None:
+            def pair():
+                source = pick(len(routers))
+                # Any router but the source
+                destination = pick(len(routers) - 1)
+                destination += destination >= source
+                return routers[source], routers[destination]
+        else:
+            destinations = list(destinations)
+
+            def pair():
+                source = routers[pick(len(routers))]
+                destination = destinations[pick(len(destinations))]
+                while destination == source:
+                    destination = destinations[pick(len(destinations))]
+                return source, destination
+
+        def arrival():
+            if stop is not None and self.now >= stop:
+                return
+            source, destination = pair()
+            self.arrive(source, (destination, size, self.now, 0, flow(64)))
+            self.schedule(self.rng.expovariate(rate), arrival)
+
+        self.schedule(start - self.now + self.rng.expovariate(rate), arrival)
+
+    def arrive(self, name, message):
+        """
+        Handles a message reaching a router: delivers it if the router is
+        its destination, forwards it to the next hop otherwise.
+
+        Parameters
+        ----------
+            name : str
+                the router
+            message : tuple
+                the destination, the size in bytes, the time it was sent,
+                the hops it made and its flow id
+        """
+        router = self.routers[name]
+        if not router.up:
+            self.stats.drop("router down", self.now)
+            return
+        destination, size, sent, hops, flow_id = message
+        # A tunnel towards a backup is the endpoint and the destination of
+        # the message it carries
+        tunneled = type(destination) is tuple
+        outer = destination[0] if tunneled else destination
+        if outer == name:
+            if tunneled:
+                self.arrive(name, (destination[1], size, sent, hops, flow_id))
+            else:
+                self.stats.deliver(self.now - sent, hops, size)
+            return
+        next_router = router.next_router(outer, flow_id)
+        if next_router is None:
+            self.stats.drop("no route", self.now)
+            return
+        ready = self.now + self.processing_delay
+        if next_router in router.unreachable or \
+                not self.routers[next_router].up:
+            # The connection is refused after a round trip, then the router
+            # sends to the backup right away
+            if next_router not in router.unreachable:
+                router.unreachable.add(next_router)
+                ready += 2 * router.links[next_router].delay
+            next_router, endpoint = router.failover_route(outer, next_router)
+            if next_router is not None and not self.routers[next_router].up:
+                router.unreachable.add(next_router)
+                next_router = None
+            if next_router is None:
+                self.stats.drop("next hop down", self.now)
+                return
+            if endpoint is not None:
+                destination = (endpoint, destination)
+            self.stats.failovers += 1
+        link = router.links[next_router]
+        start = max(ready, link.busy_until)
+        if (start - self.now) * link.bandwidth / 8 > self.buffer_bytes:
+            self.stats.drop("queue full", self.now)
+            return
+        link.busy_until = start + size * 8 / link.bandwidth
+        link.sent += size
+        # The hot path, scheduled without going through schedule
+        heapq.heappush(self.events, (
+            link.busy_until + link.delay, next(self.sequence), self.arrive,
+            (next_router, (destination, size, sent, hops + 1, flow_id))))
+
+    def deliver_routes(self, name, update):
+        """
+        Applies a routes version on a router and acknowledges it.
+        """
+        router = self.routers[name]
+        if not router.up:
+            return
+        router.apply_routes(update)
+        self.schedule(self.control_delay, self.controller.route_acknowledged,
+                      name, update["version"])
+
+
+class SimulatedLink:
+    """
+    One direction of a link: its propagation delay, its bandwidth, the
+    time it is done sending what it was given and the bytes it was given
+    since the last utilization report.
+    """
+
+    __slots__ = ("delay", "bandwidth", "busy_until", "sent")
+
+    def __init__(self, delay, bandwidth):
+        """
+        Constructs all the necessary attributes for the link object.
+
+        Parameters
+        ----------
+            delay : float
+                seconds a bit takes from one end to the other
+            bandwidth : float
+                bits per second
+        """
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.busy_until = 0.0
+        self.sent = 0
+
+
+class SimulatedRouter(Router):
+    """
+    A router without sockets. It applies route versions, picks next hops
+    and backups as a router does, and never opens a connection.
+    """
+
+    def __init__(self, router_name, network):
+        """
+        Constructs all the necessary attributes for the router object.
+
+        Parameters
+        ----------
+            router_name : str
+                the name of the router
+            network : dict
+                the simulated topology
+        """
+        super().__init__(router_name, network=network)
+        self.links = {}
+        self.up = True
+
+
+class SimulatedController(Controller):
+    """
+    The controller, pushing routes and probing routers through simulation
+    events. Routes are kept in memory only.
+    """
+
+    def __init__(self, simulation, network_file, algorithm, **options):
+        """
+        Constructs all the necessary attributes for the controller object.
+
+        Parameters
+        ----------
+            simulation : Simulation
+                the simulation it runs in
+            network_file : str
+                the topology
+            algorithm : str
+                the path engine
+            **options
+                passed to the controller
+        """
+        super().__init__(0, algorithm=algorithm, network_file=network_file,
+                         **options)
+        self.simulation = simulation
+        self.clock = lambda: simulation.now
+        self.network_names = {
+            node_id: name for name, node_id in self.network["Nodes"].items()}
+
+    def write_routes(self, network):
+        pass
+
+    def register(self, router_name):
+        """
+        Opens the control channel of a router, without a socket.
+        """
+        with self.channels_lock:
+            self.control_channels[router_name] = None
+            self.pushed_tables.pop(router_name, None)
+            self.acked_versions.pop(router_name, None)
+
+    def bootstrap(self):
+        """
+        Registers every router and computes the first routes, as the
+        controller does once the last router connected.
+        """
+        for router_name, node_id in self.network["Nodes"].items():
+            self.register(router_name)
+            self.nsfnet.add_node(node_id, router_name)
+            self.routers_quantity += 1
+        for link in self.network["Links"]:
+            self.nsfnet.add_link(link["from"], link["to"], 1/link["distance"])
+        self.compute_all_shortest_paths(self.nsfnet)
+        self.push_routes()
+        self.converged = True
+
+    def rejoin(self, router_name):
+        """
+        Handles a router registering again after a restart.
+        """
+        self.register(router_name)
+        self.rejoin_router(router_name)
+
+    def send_update(self, router_name, update):
+        self.simulation.schedule(
+            self.simulation.control_delay,
+            self.simulation.deliver_routes, router_name, update)
+        return True
+
+    def check_routers(self):
+        """
+        Probes every router known alive. A router answers if it is up; the
+        round ends when the last answer came back, or at the probe timeout
+        if one is missing.
+        """
+        nodes = list(self.control_channels)
+        results = [self.simulation.routers[name].up for name in nodes]
+        duration = 2 * self.simulation.control_delay if all(results) \
+            else self.probe_timeout
+        self.simulation.schedule(
+            duration, self.end_check, nodes, results, self.clock())
+
+    def end_check(self, nodes, results, started):
+        failed = self.health.record(nodes, results, started, self.clock())
+        if failed:
+            self.remove_routers(failed)
+        self.simulation.schedule(
+            max(0.0, self.health.interval - (self.clock() - started)),
+            self.check_routers)
+
+
+class SimulationStats:
+    """
+    Counts what happened to the messages of a simulation.
+    """
+
+    def __init__(self):
+        """
+        Constructs all the necessary attributes for the stats object.
+        """
+        self.delivered = 0
+        self.delivered_bytes = 0
+        self.hops = 0
+        self.dropped = {}
+        self.drop_times = array("d")
+        self.failovers = 0
+        self.latencies = array("d")
+
+    def deliver(self, latency, hops, size=0):
+        self.delivered += 1
+        self.delivered_bytes += size
+        self.hops += hops
+        self.latencies.append(latency)
+
+    def drop(self, reason, at):
+        self.dropped[reason] = self.dropped.get(reason, 0) + 1
+        self.drop_times.append(at)
+
+    def summary(self):
+        """
+        Sums up the messages.
+
+        Returns
+        -------
+            summary : dict
+                the delivered and dropped messages, the mean hops and the
+                latency percentiles in milliseconds
+        """
+        summary = {
+            "delivered": self.delivered,
+            "delivered_bytes": self.delivered_bytes,
+            "dropped": dict(self.dropped),
+            "failovers": self.failovers,
+            "mean_hops": self.hops / self.delivered if self.delivered else 0,
+        }
+        if self.latencies:
+            latencies = np.frombuffer(self.latencies, dtype=np.float64) * 1000
+            for percentile in (50, 99, 99.9):
+                summary[f"p{percentile}_ms"] = float(
+                    np.percentile(latencies, percentile))
+        return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Simulate the network in a single process.")
+    parser.add_argument(
+        "--network", default="Json/network.json",
+        help="topology to simulate")
+    parser.add_argument(
+        "--topology", choices=sorted(TOPOLOGIES),
+        help="simulate a generated topology instead")
+    parser.add_argument(
+        "--routers", type=int, default=1000,
+        help="routers of the generated topology")
+    parser.add_argument(
+        "--path-engine", default="dijkstra", help="shortest path engine")
+    parser.add_argument(
+        "--duration", type=float, default=10.0,
+        help="virtual seconds of traffic")
+    parser.add_argument(
+        "--rate", type=float, default=10000.0,
+        help="messages per virtual second")
+    parser.add_argument(
+        "--size", type=int, default=1000, help="bytes per message")
+    parser.add_argument(
+        "--fail", nargs="*", default=[], metavar="ROUTER@SECONDS",
+        help="routers to stop and when")
+    parser.add_argument(
+        "--recover", nargs="*", default=[], metavar="ROUTER@SECONDS",
+        help="routers to restart and when")
+    parser.add_argument(
+        "--max-paths", type=int, default=1,
+        help="next hops a router may spread flows over per destination")
+    parser.add_argument(
+        "--stretch", type=float, default=1.0,
+        help="cost of the other paths relative to the shortest, at most")
+    parser.add_argument(
+        "--congestion-aware", action="store_true",
+        help="raise the cost of the links routers report congested")
+    parser.add_argument(
+        "--backup-routes", action="store_true",
+        help="send routers a loop-free alternate next hop per destination")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    network_file = args.network
+    if args.topology:
+        network_file = os.path.join(tempfile.mkdtemp(), "network.json")
+        write_network(generate_network(
+            args.topology, args.routers, args.seed), network_file)
+
+    started = time.perf_counter()
+    simulation = Simulation(
+        network_file, args.path_engine, seed=args.seed,
+        max_paths=args.max_paths, stretch=args.stretch,
+        congestion=CongestionTracker() if args.congestion_aware else None,
+        backup_routes=args.backup_routes)
+    simulation.start()
+    setup = time.perf_counter() - started
+    for event, action in ((args.fail, simulation.fail_router),
+                          (args.recover, simulation.recover_router)):
+        for entry in event:
+            name, at = entry.split("@")
+            action(name, float(at))
+    simulation.add_traffic(args.rate, args.size, stop=args.duration)
+
+    started = time.perf_counter()
+    simulation.run(until=args.duration + 1.0)
+    elapsed = time.perf_counter() - started
+    print(f"Routes computed in {setup:.2f} s")
+    print(f"Simulated {simulation.now:.1f} s in {elapsed:.2f} s, "
+          f"{simulation.processed / elapsed:.0f} events/s, "
+          f"{simulation.now / elapsed:.1f}x real time")
+    for key, value in simulation.stats.summary().items():
+        print(f"{key}: {value}")
+    print("Detection latencies: " + ", ".join(
+        f"{seconds * 1000:.1f} ms"
+        for seconds in simulation.controller.health.detection_latencies))
+    print("Convergence times: " + ", ".join(
+        f"{seconds * 1000:.1f} ms"
+        for seconds in simulation.controller.convergence_times))
+    if args.topology:
+        os.remove(network_file)
+        os.rmdir(os.path.dirname(network_file))
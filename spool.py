@@ -0,0 +1,407 @@
+import os
+import glob
+import mmap
+import time
+import threading
+from collections import deque
+from metrics import MetricsRegistry
+from protocol import ProtocolError
+
+POLICIES = ("drop-newest", "drop-oldest")
+
+
+class SpooledMessage:
+    """
+    A message waiting in the spool: its header, the next hop it could not
+    reach, when it expires and where its encoded frame is kept, in memory
+    or in a segment file.
+    """
+
+    __slots__ = ("header", "next_hop", "expires", "size", "segment",
+                 "offset", "data")
+
+    def __init__(self, header, next_hop, expires, size):
+        self.header = header
+        self.next_hop = next_hop
+        self.expires = expires
+        self.size = size
+        self.segment = None
+        self.offset = 0
+        self.data = None
+
+
+class Segment:
+    """
+    An append-only file mapped in memory that frames are written into one
+    after the other. The current segment starts over once every frame in it
+    was taken out, the others are deleted then.
+    """
+
+    def __init__(self, path, size):
+        """
+        Constructs all the necessary attributes for the segment object.
+
+        Parameters
+        ----------
+            path : str
+                the file of the segment
+            size : int
+                the bytes of the file
+        """
+        self.path = path
+        self.size = size
+        self.used = 0
+        self.live = 0
+        with open(path, "w+b") as file:
+            file.truncate(size)
+            self.map = mmap.mmap(file.fileno(), size)
+
+    def close(self):
+        """
+        Unmaps and deletes the file.
+        """
+        self.map.close()
+        os.remove(self.path)
+
+
+class Spool:
+    """
+    A class to hold the messages whose next hop is unreachable until the
+    routes change, so a short outage delays them instead of losing them.
+
+    Every next hop has its own queue, bounded in messages and bytes, and a
+    full queue either refuses new messages or drops its oldest ones.
+    Messages older than the time to live are dropped instead of sent. The
+    frames are kept in memory, or in segment files of a directory so large
+    audios do not take up the memory of the router; the segments are
+    scratch space and do not outlive the spool.
+    """
+
+    def __init__(self, max_messages=1024, max_bytes=64 * 2**20, ttl=30.0,
+                 policy="drop-newest", directory=None,
+                 segment_size=64 * 2**20):
+        """
+        Constructs all the necessary attributes for the spool object.
+
+        Parameters
+        ----------
+            max_messages : int, optional
+                the messages a next hop may have waiting (default is 1024)
+            max_bytes : int, optional
+                the frame bytes a next hop may have waiting (default is
+                64 MB)
+            ttl : float, optional
+                seconds a message may wait (default is 30)
+            policy : str, optional
+                what a full queue does with a new message, 'drop-newest'
+                refuses it and 'drop-oldest' drops the oldest messages to
+                make room (default is 'drop-newest')
+            directory : str, optional
+                keep the frames in segment files of this directory instead
+                of in memory
+            segment_size : int, optional
+                the bytes of a segment file, larger for a bigger frame
+                (default is 64 MB)
+        """
+        if policy not in POLICIES:
+            raise ValueError(
+                "Invalid policy specified. Use 'drop-newest' or "
+                "'drop-oldest'.")
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.policy = policy
+        self.directory = directory
+        self.segment_size = segment_size
+        self.queues = {}
+        self.queued_bytes = {}
+        self.segment = None
+        self.segment_index = 0
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            for path in glob.glob(os.path.join(directory, "*.segment")):
+                os.remove(path)
+        self.create_metrics(MetricsRegistry())
+
+    def create_metrics(self, registry, prefix="spool"):
+        """
+        Creates the metrics of the spool in a registry.
+
+        Parameters
+        ----------
+            registry : MetricsRegistry
+                the registry of the component the spool belongs to
+            prefix : str, optional
+                the start of the name of every metric (default is 'spool')
+        """
+        registry.gauge(
+            f"{prefix}_messages", "Messages waiting, by next hop",
+            ("next_hop",), function=lambda: self.depths()[0])
+        registry.gauge(
+            f"{prefix}_bytes", "Frame bytes waiting, by next hop",
+            ("next_hop",), function=lambda: self.depths()[1])
+        self.held = registry.counter(
+            f"{prefix}_held_total", "Messages put in the spool, by next hop",
+            ("next_hop",))
+        self.dropped = registry.counter(
+            f"{prefix}_dropped_total",
+            "Messages dropped from or refused by the spool, by reason",
+            ("reason",))
+
+    def depths(self):
+        """
+        Returns the messages and the bytes waiting for every next hop.
+        """
+        with self.lock:
+            return ({(hop,): len(queue) for hop, queue in self.queues.items()},
+                    {(hop,): size for hop, size in self.queued_bytes.items()})
+
+    def next_hops(self):
+        """
+        Returns the next hops that have messages waiting.
+        """
+        with self.lock:
+            return [hop for hop, queue in self.queues.items() if queue]
+
+    def hold(self, next_hop, header, stream):
+        """
+        Puts a message in the queue of its next hop, reading its payload
+        from a stream. Nothing is read when the message is refused.
+
+        Parameters
+        ----------
+            next_hop : str
+                the next hop that could not be reached
+            header : Header
+                the header of the message
+            stream : file
+                a binary stream with readinto the payload is read from
+
+        Returns
+        -------
+            held : bool
+                whether the message was put in the spool
+        """
+        reserved = self.reserve(next_hop, header)
+        if reserved is None:
+            return False
+        message, view = reserved
+        try:
+            with view:
+                read_into(stream, view)
+        except BaseException:
+            self.cancel(message)
+            raise
+        self.commit(message)
+        return True
+
+    def reserve(self, next_hop, header):
+        """
+        Makes room for a message in the queue of its next hop and writes
+        its header, so the caller can write the payload from wherever it
+        comes from, release the view and then give the message to commit,
+        or to cancel if the payload could not be read.
+
+        Parameters
+        ----------
+            next_hop : str
+                the next hop that could not be reached
+            header : Header
+                the header of the message
+
+        Returns
+        -------
+            reserved : tuple
+                the message and the memoryview to write its payload into,
+                None when the message is refused
+        """
+        encoded = header.encode()
+        size = len(encoded) + header.payload_length
+        message = SpooledMessage(
+            header, next_hop, time.monotonic() + self.ttl, size)
+        with self.lock:
+            if not self.admit(next_hop, size):
+                self.dropped.inc(1, ("full",))
+                return None
+            # Counted right away so concurrent messages see the room taken,
+            # queued only once written so nothing evicts it meanwhile
+            self.queued_bytes[next_hop] = \
+                self.queued_bytes.get(next_hop, 0) + size
+            view = self.allocate(message)
+        with view:
+            view[:len(encoded)] = encoded
+            return message, view[len(encoded):]
+
+    def commit(self, message):
+        """
+        Queues a reserved message once its payload was written.
+        """
+        with self.lock:
+            self.queues.setdefault(message.next_hop, deque()).append(message)
+        self.held.inc(1, (message.next_hop,))
+
+    def cancel(self, message):
+        """
+        Gives the room of a reserved message back when its payload could
+        not be written.
+        """
+        with self.lock:
+            self.queued_bytes[message.next_hop] -= message.size
+            self.free(message)
+
+    def admit(self, next_hop, size):
+        """
+        Makes room for a message in the queue of a next hop, as the policy
+        allows. Must be called with the lock held.
+
+        Returns
+        -------
+            admitted : bool
+                whether the message fits
+        """
+        if size > self.max_bytes or self.max_messages < 1:
+            return False
+        queue = self.queues.get(next_hop, ())
+        self.expire(next_hop)
+        while len(queue) >= self.max_messages or \
+                self.queued_bytes.get(next_hop, 0) + size > self.max_bytes:
+            if self.policy == "drop-newest" or not queue:
+                return False
+            message = queue.popleft()
+            self.queued_bytes[next_hop] -= message.size
+            self.free(message)
+            self.dropped.inc(1, ("evicted",))
+        return True
+
+    def allocate(self, message):
+        """
+        Finds room for the frame of a message, in memory or at the end of
+        the current segment. Must be called with the lock held.
+
+        Returns
+        -------
+            view : memoryview
+                where to write the frame
+        """
+        if self.directory is None:
+            message.data = bytearray(message.size)
+            return memoryview(message.data)
+        segment = self.segment
+        if segment is None or segment.used + message.size > segment.size:
+            if segment is not None and segment.live == 0:
+                segment.close()
+            self.segment_index += 1
+            segment = self.segment = Segment(
+                os.path.join(self.directory,
+                             f"{self.segment_index:08d}.segment"),
+                max(self.segment_size, message.size))
+        message.segment = segment
+        message.offset = segment.used
+        segment.used += message.size
+        segment.live += 1
+        return memoryview(segment.map)[
+            message.offset:message.offset + message.size]
+
+    def pop(self, next_hop):
+        """
+        Takes the oldest message of a next hop that did not expire.
+
+        Returns
+        -------
+            message : SpooledMessage
+                the message, None when the queue is empty; frame gives its
+                bytes and it must be given to release or restore
+        """
+        with self.lock:
+            self.expire(next_hop)
+            queue = self.queues.get(next_hop)
+            if not queue:
+                return None
+            message = queue.popleft()
+            self.queued_bytes[next_hop] -= message.size
+            return message
+
+    def restore(self, message):
+        """
+        Puts a popped message back at the head of its queue, when it could
+        not be sent yet.
+        """
+        with self.lock:
+            self.queues.setdefault(message.next_hop, deque()).appendleft(
+                message)
+            self.queued_bytes[message.next_hop] = \
+                self.queued_bytes.get(message.next_hop, 0) + message.size
+
+    def frame(self, message):
+        """
+        Returns the encoded frame of a message, header and payload.
+        """
+        if message.segment is None:
+            return memoryview(message.data)
+        return memoryview(message.segment.map)[
+            message.offset:message.offset + message.size]
+
+    def expire(self, next_hop):
+        """
+        Drops the messages of a next hop that waited longer than the time
+        to live. Must be called with the lock held.
+        """
+        queue = self.queues.get(next_hop)
+        now = time.monotonic()
+        while queue and queue[0].expires <= now:
+            message = queue.popleft()
+            self.queued_bytes[next_hop] -= message.size
+            self.free(message)
+            self.dropped.inc(1, ("expired",))
+
+    def release(self, message):
+        """
+        Frees the frame of a popped message once it was sent.
+        """
+        with self.lock:
+            self.free(message)
+
+    def free(self, message):
+        """
+        Frees the frame of a message, deleting its segment once no frame in
+        it is waiting. Must be called with the lock held.
+        """
+        message.data = None
+        segment = message.segment
+        if segment is None:
+            return
+        message.segment = None
+        segment.live -= 1
+        if segment.live:
+            return
+        if segment is self.segment:
+            # Every frame written was taken out, write from the start again
+            segment.used = 0
+        else:
+            segment.close()
+
+    def close(self):
+        """
+        Drops every message and deletes the segment files.
+        """
+        with self.lock:
+            for queue in self.queues.values():
+                while queue:
+                    self.free(queue.popleft())
+            self.queues = {}
+            self.queued_bytes = {}
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+
+
+def read_into(stream, view):
+    """
+    Fills a memoryview from a binary stream.
+    """
+    while len(view):
+        received = stream.readinto(view)
+        if not received:
+            raise ProtocolError("Connection closed in the middle of a frame")
+        view = view[received:]
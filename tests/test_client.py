@@ -0,0 +1,69 @@
+"""
+Reception of a client: a frame that cannot be read drops its connection
+without killing anything else.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+import socket
+import pytest
+from client import TCPClient
+from route_store import NextHopMatrix
+from protocol import KIND_CONTROL, KIND_TEXT, Header, encode_frame
+
+
+@pytest.fixture
+def client():
+    return TCPClient("WA", "alice", 9001)
+
+
+@pytest.mark.parametrize("data", [
+    b"garbage that is not a frame",
+    # Truncated in the middle of the payload
+    encode_frame(Header(KIND_TEXT, "bob", "DC", "9001", "WA", 10), b"abc"),
+    # Not encrypted with the key of the session
+    encode_frame(Header(KIND_TEXT, "bob", "DC", "9001", "WA", 40),
+                 bytes(40)),
+    encode_frame(Header(KIND_CONTROL, flow_id=3), b"not a notice"),
+])
+def test_bad_frames_drop_the_connection(client, data):
+    router, connection = socket.socketpair()
+    with router:
+        router.sendall(data)
+        router.shutdown(socket.SHUT_WR)
+        client.handle_reception(connection)
+        assert client.active_receptions.value() == 0
+        assert connection.fileno() == -1
+
+
+def test_bad_notice_drops_the_connection(client):
+    router, connection = socket.socketpair()
+    payload = client.cipher.encrypt(b'{"moved": "9002"}', 3)
+    with router:
+        router.sendall(encode_frame(
+            Header(KIND_CONTROL, flow_id=3), payload))
+        router.shutdown(socket.SHUT_WR)
+        client.handle_reception(connection)
+    assert client.active_receptions.value() == 0
+    assert connection.fileno() == -1
+
+
+def test_route_store_is_opened_once(client, monkeypatch, tmp_path):
+    names = ["WA", "CA1", "DC"]
+    matrix = NextHopMatrix(names)
+    matrix.set_tree("CA1", {"CA1": ["CA1"], "WA": ["CA1", "WA"]})
+    (tmp_path / "Json").mkdir()
+    matrix.save(str(tmp_path / "Json" / "routes.bin"))
+    monkeypatch.chdir(tmp_path)
+    assert client.route_path("CA1") == ["CA1", "WA"]
+    store = client.route_store
+    assert client.route_path("CA1") == ["CA1", "WA"]
+    assert client.route_store is store
+    # The controller replaces the file when the routes change
+    matrix.set_tree("CA1", {"CA1": ["CA1"], "DC": ["CA1", "DC"],
+                            "WA": ["CA1", "DC", "WA"]})
+    matrix.set_tree("DC", {"DC": ["DC"], "WA": ["DC", "WA"]})
+    matrix.save(str(tmp_path / "Json" / "routes.bin"))
+    assert client.route_path("CA1") == ["CA1", "DC", "WA"]
+    assert client.route_store is not store
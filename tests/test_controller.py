@@ -0,0 +1,104 @@
+"""
+Routing state of the controller on the NSFNET: congestion changes the
+topology clients see, and survives a router leaving and coming back, and
+the trees recomputed incrementally are the ones a full recompute finds.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+import json
+import pytest
+from controller import Controller
+from shaping import CongestionTracker
+from topology_generator import generate_network, write_network
+
+
+def build_controller(directory, **options):
+    """
+    Builds a controller whose routers all registered, without sockets.
+    """
+    controller = Controller(
+        0, algorithm="dijkstra", routes_file=str(directory / "routes.bin"),
+        **options)
+    for name, node_id in controller.network["Nodes"].items():
+        controller.nsfnet.add_node(node_id, name)
+        controller.routers_quantity += 1
+    for link in controller.network["Links"]:
+        controller.nsfnet.add_link(
+            link["from"], link["to"], 1 / link["distance"])
+    controller.node_ports = list(controller.network["Ports"].values())
+    controller.compute_all_shortest_paths(controller.nsfnet)
+    return controller
+
+
+@pytest.fixture
+def controller(tmp_path):
+    controller = build_controller(
+        tmp_path, congestion=CongestionTracker(smoothing=1.0, hold_down=0))
+    controller.clock = lambda: 0.0
+    return controller
+
+
+def test_congestion_changes_the_topology_version(controller):
+    etag = json.loads(controller.topology_answer(None))["etag"]
+    controller.link_utilization("WA", {"CA1": 1.0})
+    weight = controller.nsfnet.graph["WA"]["CA1"]["weight"]
+    assert weight == pytest.approx(4 / 2100)
+    answer = json.loads(controller.topology_answer(etag))
+    assert answer["etag"] != etag
+    topology = answer["topology"]
+    names = topology["names"]
+    links = {
+        frozenset((names[source], names[destination])): bandwidth
+        for source, destination, bandwidth in zip(
+            topology["sources"], topology["destinations"],
+            topology["bandwidths"])}
+    assert links[frozenset(("WA", "CA1"))] == pytest.approx(weight)
+
+
+def test_rejoin_keeps_the_congestion(controller):
+    controller.remove_routers(["CA1"])
+    # WA keeps reporting its link towards CA1 while CA1 is away
+    controller.link_utilization("WA", {"CA1": 1.0})
+    controller.rejoin_router("CA1")
+    assert controller.nsfnet.graph["WA"]["CA1"]["weight"] == \
+        pytest.approx(4 / 2100)
+    assert controller.nsfnet.graph["CA1"]["CA2"]["weight"] == \
+        pytest.approx(1 / 1200)
+
+
+def routing_state(controller):
+    return {source: (controller.distances[source],
+                     controller.next_hop_table(source))
+            for source in controller.shortest_paths}
+
+
+def assert_matches_full_recompute(controller):
+    incremental = routing_state(controller)
+    controller.compute_all_shortest_paths(controller.nsfnet)
+    full = routing_state(controller)
+    assert incremental.keys() == full.keys()
+    for source, (distances, next_hops) in full.items():
+        assert incremental[source][0] == pytest.approx(distances)
+        assert incremental[source][1] == next_hops
+
+
+@pytest.mark.parametrize("network", ["nsfnet", "waxman"])
+def test_incremental_recompute_matches_full(tmp_path, network):
+    options = {}
+    if network == "waxman":
+        options["network_file"] = str(tmp_path / "network.json")
+        write_network(generate_network("waxman", 60, seed=3),
+                      options["network_file"])
+    controller = build_controller(tmp_path, **options)
+    graph = controller.nsfnet.graph
+    # The busiest routers are in the most trees
+    busiest = sorted(graph, key=graph.degree, reverse=True)
+    controller.remove_routers(busiest[:1])
+    assert_matches_full_recompute(controller)
+    controller.remove_routers(busiest[1:3])
+    assert_matches_full_recompute(controller)
+    for name in busiest[:3]:
+        controller.rejoin_router(name)
+        assert_matches_full_recompute(controller)
@@ -0,0 +1,60 @@
+"""
+Session encryption: a flow id used again by another sender, or by the
+same one after a restart, never gets the same key, and streams carry the
+salt of their key ahead of their chunks.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+import pytest
+from crypto import (
+    SALT_SIZE, SEALED_CHUNK_SIZE, STREAM_CHUNK_SIZE, CryptoError,
+    SessionCipher, plain_length, sealed_length)
+
+SESSION = 0x1234
+
+
+def test_senders_of_one_session_use_different_keys():
+    first, second, receiver = SessionCipher(), SessionCipher(), SessionCipher()
+    sealed = [sender.encrypt(b"same", SESSION) for sender in (first, second)]
+    assert sealed[0][:SALT_SIZE] != sealed[1][:SALT_SIZE]
+    assert first.key(b"message", SESSION, sealed[0][:SALT_SIZE]) is not \
+        second.key(b"message", SESSION, sealed[1][:SALT_SIZE])
+    assert [receiver.decrypt(payload, SESSION) for payload in sealed] == \
+        [b"same", b"same"]
+
+
+def test_a_session_keeps_its_salt():
+    cipher = SessionCipher()
+    payloads = [cipher.encrypt(b"message", SESSION) for _ in range(3)]
+    assert len({payload[:SALT_SIZE] for payload in payloads}) == 1
+
+
+def test_tampered_salt_fails_authentication():
+    cipher = SessionCipher()
+    payload = bytearray(cipher.encrypt(b"message", SESSION))
+    payload[0] ^= 1
+    with pytest.raises(CryptoError):
+        cipher.decrypt(bytes(payload), SESSION)
+
+
+@pytest.mark.parametrize("size", [0, 1, STREAM_CHUNK_SIZE,
+                                  2 * STREAM_CHUNK_SIZE + 5])
+def test_stream_round_trip(size):
+    data = (bytes(range(256)) * (size // 256 + 1))[:size]
+    sender = SessionCipher().stream(SESSION)
+    sealed = sender.salt
+    chunks = [data[position:position + STREAM_CHUNK_SIZE]
+              for position in range(0, size, STREAM_CHUNK_SIZE)] or [b""]
+    sealed += b"".join(
+        sender.seal(chunk, last=index == len(chunks) - 1)
+        for index, chunk in enumerate(chunks))
+    assert len(sealed) == sealed_length(size)
+    assert plain_length(len(sealed)) == size
+    receiver = SessionCipher().stream(SESSION, sealed[:SALT_SIZE])
+    opened = b"".join(
+        receiver.open(sealed[position:position + SEALED_CHUNK_SIZE],
+                      last=position + SEALED_CHUNK_SIZE >= len(sealed))
+        for position in range(SALT_SIZE, len(sealed), SEALED_CHUNK_SIZE))
+    assert opened == data
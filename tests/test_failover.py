@@ -0,0 +1,149 @@
+"""
+Failover of a real router: a next router that refuses connections is
+marked unreachable and the message goes to its backup, while a next router
+whose pooled connections are all in use is only busy.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+import io
+import json
+import socket
+import asyncio
+import pytest
+from router import Router
+from async_router import AsyncRouter
+from connection_pool import ConnectionPool
+from protocol import (
+    KIND_TEXT, KIND_TUNNEL, Header, read_frame, read_header,
+    read_inner_header)
+
+PAYLOAD = b"hello over the backup"
+
+
+def free_port():
+    """
+    Returns a port nothing listens on, connecting to it is refused.
+    """
+    with socket.socket() as probe:
+        probe.bind(("localhost", 0))
+        return probe.getsockname()[1]
+
+
+def listener():
+    server = socket.create_server(("localhost", 0))
+    server.settimeout(2)
+    return server
+
+
+def build_router(directory, backup, primary=None, engine=Router):
+    """
+    Builds the router A of a diamond A-B-D and A-C-D with E behind D, C
+    listening on backup and B on primary, refusing connections when not
+    given.
+    """
+    ports = {"A": free_port(),
+             "B": primary.getsockname()[1] if primary else free_port(),
+             "C": backup.getsockname()[1], "D": free_port(),
+             "E": free_port()}
+    links = [("A", "B"), ("A", "C"), ("B", "D"), ("C", "D"), ("D", "E")]
+    nodes = {name: node_id for node_id, name in enumerate(ports)}
+    topology = {
+        "Nodes": nodes,
+        "Ports": ports,
+        "Links": [{"from": nodes[first], "to": nodes[second],
+                   "distance": 1000} for first, second in links],
+    }
+    network_file = directory / "network.json"
+    network_file.write_text(json.dumps(topology))
+    if engine is AsyncRouter:
+        return AsyncRouter("A", max_per_peer=1,
+                           network_file=str(network_file))
+    return Router("A", pool=ConnectionPool(max_per_peer=1,
+                                           connect_timeout=0.2),
+                  network_file=str(network_file))
+
+
+@pytest.fixture
+def backup():
+    server = listener()
+    yield server
+    server.close()
+
+
+def forward(router, destination):
+    header = Header(KIND_TEXT, "alice", "A", "9002", destination,
+                    len(PAYLOAD))
+    router.handle_client(header, io.BytesIO(PAYLOAD), bytearray(4096))
+    return header
+
+
+def test_backup_carries_the_message(tmp_path, backup):
+    router = build_router(tmp_path, backup)
+    router.apply_routes({"version": 1, "full": True, "routes": {"D": "B"},
+                         "backups": {"D": "C"}})
+    forward(router, "D")
+    connection, _ = backup.accept()
+    with connection, connection.makefile("rb") as reader:
+        header, payload = read_frame(reader)
+    assert (header.kind, header.dst_router, payload) == \
+        (KIND_TEXT, "D", PAYLOAD)
+    assert "B" in router.unreachable
+    assert router.failovers.value(("B",)) == 1
+
+
+def test_backup_beyond_the_neighbors_is_tunneled(tmp_path, backup):
+    router = build_router(tmp_path, backup)
+    router.apply_routes({"version": 1, "full": True,
+                         "routes": {"D": "C", "E": "B"},
+                         "backups": {"E": "D"}})
+    forward(router, "E")
+    connection, _ = backup.accept()
+    with connection, connection.makefile("rb") as reader:
+        tunnel = read_header(reader)
+        inner = read_inner_header(reader)
+        payload = reader.read(inner.payload_length)
+    assert (tunnel.kind, tunnel.src_router, tunnel.dst_router) == \
+        (KIND_TUNNEL, "A", "D")
+    assert (inner.dst_router, payload) == ("E", PAYLOAD)
+
+
+def test_busy_next_hop_is_not_unreachable(tmp_path, backup):
+    busy = listener()
+    router = build_router(tmp_path, backup, busy)
+    router.apply_routes({"version": 1, "full": True, "routes": {"D": "B"},
+                         "backups": {"D": "C"}})
+    # The only connection the pool allows towards B stays in use
+    taken = router.pool.acquire("localhost", busy.getsockname()[1])
+    try:
+        forward(router, "D")
+    finally:
+        router.pool.release("localhost", busy.getsockname()[1], taken,
+                            reuse=False)
+        busy.close()
+    assert "B" not in router.unreachable
+    assert router.failovers.value(("B",)) == 0
+    backup.settimeout(0.2)
+    with pytest.raises(socket.timeout):
+        backup.accept()
+
+
+def test_backup_carries_the_message_async(tmp_path, backup):
+    router = build_router(tmp_path, backup, engine=AsyncRouter)
+    router.apply_routes({"version": 1, "full": True, "routes": {"D": "B"},
+                         "backups": {"D": "C"}})
+    header = Header(KIND_TEXT, "alice", "A", "9002", "D", len(PAYLOAD))
+
+    async def send():
+        reader = asyncio.StreamReader()
+        reader.feed_data(PAYLOAD)
+        reader.feed_eof()
+        await router.handle_client_async(header, reader)
+
+    asyncio.run(send())
+    connection, _ = backup.accept()
+    with connection, connection.makefile("rb") as reader:
+        received, payload = read_frame(reader)
+    assert (received.dst_router, payload) == ("D", PAYLOAD)
+    assert "B" in router.unreachable
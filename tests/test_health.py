@@ -0,0 +1,77 @@
+"""
+Failure detection: phi grows with the silence of a node relative to how
+regularly it answered so far, and the checker declares a node down once,
+with the time since its last answer.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+from health import HealthChecker, MissedHeartbeatsDetector, PhiAccrualDetector
+
+
+def heartbeats(detector, node, times):
+    for now in times:
+        detector.report(node, True, now)
+
+
+def test_unknown_node_is_not_suspected():
+    detector = PhiAccrualDetector()
+    assert detector.phi("R1", 100.0) == 0.0
+    assert not detector.is_down("R1", 100.0)
+
+
+def test_phi_grows_with_silence():
+    detector = PhiAccrualDetector()
+    heartbeats(detector, "R1", [float(second) for second in range(11)])
+    levels = [detector.phi("R1", 10.0 + silence)
+              for silence in (0.5, 1.0, 1.2, 1.5, 2.0)]
+    assert levels == sorted(levels)
+    assert not detector.is_down("R1", 11.2)
+    assert detector.is_down("R1", 12.0)
+
+
+def test_irregular_node_is_given_more_time():
+    regular, irregular = PhiAccrualDetector(), PhiAccrualDetector()
+    heartbeats(regular, "R1", [5.0 * beat for beat in range(21)])
+    # Answers every 4 or 6 seconds, 5 on average
+    heartbeats(irregular, "R1",
+               [5.0 * beat + (beat % 2) for beat in range(21)])
+    last = 100.0
+    assert regular.is_down("R1", last + 7)
+    assert not irregular.is_down("R1", last + 7)
+
+
+def test_forget_drops_the_history():
+    detector = PhiAccrualDetector()
+    heartbeats(detector, "R1", [0.0, 1.0])
+    detector.forget("R1")
+    assert detector.last_heartbeat("R1") is None
+    assert detector.phi("R1", 100.0) == 0.0
+
+
+def test_missed_heartbeats_detector():
+    detector = MissedHeartbeatsDetector(max_missed=3)
+    detector.report("R1", True, 0.0)
+    for now in (1.0, 2.0):
+        detector.report("R1", False, now)
+    assert not detector.is_down("R1", 2.0)
+    detector.report("R1", True, 3.0)
+    for now in (4.0, 5.0, 6.0):
+        detector.report("R1", False, now)
+    assert detector.is_down("R1", 6.0)
+    assert detector.last_heartbeat("R1") == 3.0
+
+
+def test_checker_declares_a_node_down_once():
+    checker = HealthChecker(lambda node: True, PhiAccrualDetector(),
+                            max_workers=1)
+    nodes = ["R1", "R2"]
+    for second in range(10):
+        assert checker.record(nodes, [True, True], second, second) == []
+    assert checker.record(nodes, [True, False], 10.0, 10.0) == []
+    assert checker.record(nodes, [True, False], 12.0, 12.0) == ["R2"]
+    assert checker.detection_latencies == [12.0 - 9.0]
+    # The history of R2 is gone, it starts over as just heard from
+    assert checker.record(nodes, [True, False], 13.0, 13.0) == []
+    checker.executor.shutdown()
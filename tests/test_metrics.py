@@ -0,0 +1,58 @@
+"""
+Per-thread metrics: the values of every thread add up, and the threads
+that ended do not pile up when nobody reads the metrics.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+import threading
+from metrics import Counter, Histogram
+
+
+def run_threads(count, target):
+    for _ in range(count):
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+
+
+def test_ended_threads_are_folded_without_reads():
+    counter = Counter("messages_total", "Messages", ("kind",))
+    run_threads(5000, lambda: counter.inc(1, ("text",)))
+    assert len(counter.threads) <= 16
+    assert counter.value(("text",)) == 5000
+    assert counter.collect() == {("text",): 5000}
+
+
+def test_live_threads_keep_their_values():
+    counter = Counter("messages_total", "Messages")
+    started = threading.Barrier(11)
+    done = threading.Event()
+
+    def update():
+        counter.inc(2)
+        started.wait()
+        done.wait()
+
+    threads = [threading.Thread(target=update) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    started.wait()
+    run_threads(100, counter.inc)
+    assert counter.value() == 120
+    assert len(counter.threads) <= 2 * 10 + 8 + 1
+    done.set()
+    for thread in threads:
+        thread.join()
+    assert counter.value() == 120
+
+
+def test_histogram_of_ended_threads():
+    histogram = Histogram("wait_seconds", "Waits", buckets=(0.1, 1.0))
+    run_threads(1000, lambda: histogram.observe(0.5))
+    assert len(histogram.threads) <= 16
+    lines = histogram.samples()
+    assert 'wait_seconds_bucket{le="0.1"} 0' in lines
+    assert 'wait_seconds_bucket{le="1"} 1000' in lines
+    assert "wait_seconds_count 1000" in lines
@@ -0,0 +1,195 @@
+"""
+Round trip, truncation and mutation tests of the frame codec. Frames come
+from untrusted peers, so decoding any bytes must either give a header or
+raise ProtocolError, never another exception.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+import io
+import random
+import asyncio
+import pytest
+from protocol import (
+    FIXED_HEADER, KINDS, MAX_PAYLOAD_LENGTH, Header, ProtocolError, TraceHop,
+    decode_fields, encode_frame, encode_trace, read_frame, read_header,
+    read_header_async, read_inner_header, tunnel_header)
+
+SEED = 20240611
+ROUNDS = 300
+ALPHABET = "abcXYZ0123456789 -_@.é漢🙂"
+
+
+def random_text(rng, longest=40):
+    return "".join(rng.choice(ALPHABET)
+                   for _ in range(rng.randint(0, longest)))
+
+
+def random_header(rng):
+    """
+    Builds a header with random fields, flow id and trace.
+    """
+    trace = None
+    if rng.random() < 0.5:
+        trace = [TraceHop(random_text(rng, 8), rng.uniform(0, 2e9),
+                          rng.uniform(0, 2e9))
+                 for _ in range(rng.randint(0, 6))]
+    return Header(rng.choice(KINDS), random_text(rng), random_text(rng),
+                  random_text(rng), random_text(rng),
+                  flow_id=rng.getrandbits(64), trace=trace)
+
+
+def random_frame(rng):
+    header = random_header(rng)
+    payload = rng.randbytes(rng.randint(0, 300))
+    return header, payload, encode_frame(header, payload)
+
+
+def decodes_or_fails(data):
+    """
+    Reads a frame from data and returns it, None when ProtocolError was
+    raised.
+    """
+    try:
+        return read_frame(io.BytesIO(data))
+    except ProtocolError:
+        return None
+
+
+def test_round_trip():
+    rng = random.Random(SEED)
+    for _ in range(ROUNDS):
+        header, payload, data = random_frame(rng)
+        assert read_frame(io.BytesIO(data)) == (header, payload)
+
+
+def test_frames_back_to_back():
+    rng = random.Random(SEED)
+    frames = [random_frame(rng) for _ in range(50)]
+    stream = io.BytesIO(b"".join(data for _, _, data in frames))
+    for header, payload, _ in frames:
+        assert read_frame(stream) == (header, payload)
+    assert read_frame(stream) == (None, b"")
+
+
+def test_round_trip_async():
+    rng = random.Random(SEED)
+    frames = [random_frame(rng) for _ in range(50)]
+
+    async def read_all():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"".join(data for _, _, data in frames))
+        reader.feed_eof()
+        for header, payload, _ in frames:
+            assert await read_header_async(reader) == header
+            assert await reader.readexactly(header.payload_length) == payload
+        assert await read_header_async(reader) is None
+
+    asyncio.run(read_all())
+
+
+def test_tunnel_round_trip():
+    rng = random.Random(SEED)
+    for _ in range(50):
+        header, payload, data = random_frame(rng)
+        tunnel = tunnel_header(header, "WA", "NY")
+        stream = io.BytesIO(tunnel.encode() + data)
+        assert read_header(stream) == tunnel
+        assert read_inner_header(stream) == header
+        assert stream.read() == payload
+
+
+def test_truncated_frames():
+    rng = random.Random(SEED)
+    for _ in range(50):
+        _, _, data = random_frame(rng)
+        assert read_frame(io.BytesIO(b"")) == (None, b"")
+        for end in range(1, len(data)):
+            with pytest.raises(ProtocolError):
+                read_frame(io.BytesIO(data[:end]))
+
+
+def test_truncated_headers_async():
+    rng = random.Random(SEED)
+
+    async def read(prefix):
+        reader = asyncio.StreamReader()
+        reader.feed_data(prefix)
+        reader.feed_eof()
+        return await read_header_async(reader)
+
+    for _ in range(20):
+        header = random_header(rng)
+        data = header.encode()
+        assert asyncio.run(read(b"")) is None
+        assert asyncio.run(read(data)) == header
+        for end in range(1, len(data)):
+            with pytest.raises(ProtocolError):
+                asyncio.run(read(data[:end]))
+
+
+def test_mutated_frames():
+    rng = random.Random(SEED)
+    for _ in range(ROUNDS):
+        _, _, data = random_frame(rng)
+        mutated = bytearray(data)
+        for _ in range(rng.randint(1, 4)):
+            position = rng.randrange(len(mutated))
+            mutated[position] = rng.randrange(256)
+        decodes_or_fails(bytes(mutated))
+
+
+def test_mutated_lengths():
+    rng = random.Random(SEED)
+    for _ in range(ROUNDS):
+        _, _, data = random_frame(rng)
+        mutated = bytearray(data)
+        # Corrupt the payload length and the length of the text fields
+        mutated[12:20] = rng.randbytes(8)
+        mutated[20:22] = rng.randbytes(2)
+        decodes_or_fails(bytes(mutated))
+
+
+def test_random_bytes():
+    rng = random.Random(SEED)
+    for _ in range(ROUNDS):
+        decodes_or_fails(rng.randbytes(rng.randint(0, 200)))
+        # Random bytes behind a valid fixed header reach the field decoder
+        fields = rng.randbytes(rng.randint(0, 120))
+        fixed = FIXED_HEADER.pack(b"TN", 1, rng.choice(KINDS), 1, 0,
+                                  len(fields))
+        decodes_or_fails(fixed + fields)
+        try:
+            decode_fields(fields)
+        except ProtocolError:
+            pass
+
+
+def test_oversized_payload_is_refused():
+    header = Header(KINDS[0])
+    data = bytearray(header.encode())
+    data[12:20] = (MAX_PAYLOAD_LENGTH + 1).to_bytes(8, "big")
+    with pytest.raises(ProtocolError):
+        read_header(io.BytesIO(bytes(data)))
+
+
+@pytest.mark.parametrize("header", [
+    Header(99),
+    Header(KINDS[0], src="x" * 0x10000),
+    Header(KINDS[0], flow_id=-1),
+    Header(KINDS[0], flow_id=1 << 64),
+    Header(KINDS[0], payload_length=MAX_PAYLOAD_LENGTH + 1),
+    Header(KINDS[0], trace=[TraceHop("x" * 0x10000, 0.0, 0.0)]),
+    Header(KINDS[0], trace=[TraceHop("WA", "now", 0.0)]),
+    Header(KINDS[0], trace=[TraceHop("R1", 0.0, 0.0)] * 0x10000),
+])
+def test_invalid_headers_do_not_encode(header):
+    with pytest.raises(ProtocolError):
+        header.encode()
+
+
+def test_encode_trace_limits():
+    with pytest.raises(ProtocolError):
+        encode_trace([TraceHop("", 0.0, 0.0)] * 0x10000)
+    assert encode_trace([]) == b"\x00\x00"
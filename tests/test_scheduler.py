@@ -0,0 +1,133 @@
+"""
+The scheduler of forwarded messages: classes are served in order, flows
+of a class share the turns by deficit round robin, control frames hold
+chunks back, and full classes make messages wait or refuse them.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+import time
+import asyncio
+import threading
+from scheduler import Scheduler
+from protocol import KIND_AUDIO, KIND_CONTROL, KIND_TEXT, Header
+
+
+def header(kind, flow_id):
+    return Header(kind, flow_id=flow_id)
+
+
+def grant_order(scheduler, chunks):
+    """
+    Queues chunks behind a turn held by another message, then frees that
+    turn and returns the chunks in the order they were granted.
+
+    Parameters
+    ----------
+        scheduler : Scheduler
+            a scheduler with a single worker
+        chunks : list
+            the kind, flow id and size of every chunk, in queueing order
+    """
+    order = []
+
+    async def send(ticket, flow_id, size):
+        await ticket.acquire_async(size)
+        order.append((flow_id, size))
+        ticket.release()
+
+    async def run():
+        holder = scheduler.admit(header(KIND_TEXT, 0))
+        await holder.acquire_async(1)
+        tickets = {}
+        tasks = []
+        for kind, flow_id, size in chunks:
+            if flow_id not in tickets:
+                tickets[flow_id] = scheduler.admit(header(kind, flow_id))
+            tasks.append(asyncio.create_task(
+                send(tickets[flow_id], flow_id, size)))
+            # Queue the chunks in the order given
+            await asyncio.sleep(0)
+        holder.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    return order
+
+
+def test_classes_are_served_in_order():
+    scheduler = Scheduler(workers=1)
+    order = grant_order(scheduler, [
+        (KIND_AUDIO, 1, 100), (KIND_TEXT, 2, 100), (KIND_CONTROL, 3, 100),
+        (KIND_AUDIO, 1, 100), (KIND_TEXT, 2, 100)])
+    assert [flow_id for flow_id, _ in order] == [3, 2, 2, 1, 1]
+
+
+def test_flows_share_bytes_not_chunks():
+    scheduler = Scheduler(workers=1, quantum=1000)
+    # Flow 1 sends chunks ten times as large as those of flow 2
+    chunks = [(KIND_AUDIO, 1, 1000)] * 3 + [(KIND_AUDIO, 2, 100)] * 30
+    order = grant_order(scheduler, chunks)
+    # Every round, a quantum of bytes each: one chunk of flow 1 for ten of
+    # flow 2
+    assert [flow_id for flow_id, _ in order] == ([1] + [2] * 10) * 3
+
+
+def test_control_holds_chunks_back():
+    scheduler = Scheduler(workers=1)
+    ticket = scheduler.admit(header(KIND_AUDIO, 1))
+    granted = threading.Event()
+
+    def send():
+        ticket.acquire(100)
+        granted.set()
+        ticket.release()
+
+    with scheduler.control():
+        thread = threading.Thread(target=send)
+        thread.start()
+        assert not granted.wait(0.1)
+    thread.join(1)
+    assert granted.is_set()
+
+
+def test_full_class_waits_then_refuses():
+    scheduler = Scheduler(max_messages={"bulk": 1}, max_waiting={"bulk": 1})
+    first = scheduler.admit(header(KIND_AUDIO, 1))
+    admitted = []
+    waiter = threading.Thread(
+        target=lambda: admitted.append(
+            scheduler.admit(header(KIND_AUDIO, 2))))
+    waiter.start()
+    while not scheduler.admitting["bulk"]:
+        time.sleep(0.001)
+    # One message already waits for room, the next is refused
+    assert scheduler.admit(header(KIND_AUDIO, 3)) is None
+    assert scheduler.rejected.value(("bulk",)) == 1
+    # Other classes have their own room
+    assert scheduler.admit(header(KIND_TEXT, 4)) is not None
+    first.close()
+    waiter.join(1)
+    assert admitted[0].flow_id == 2
+    assert scheduler.admitted["bulk"] == 1
+    admitted[0].close()
+    assert scheduler.admitted["bulk"] == 0
+
+
+def test_cancelled_wait_gives_the_turn_back():
+    scheduler = Scheduler(workers=1)
+
+    async def run():
+        holder = scheduler.admit(header(KIND_TEXT, 0))
+        await holder.acquire_async(1)
+        ticket = scheduler.admit(header(KIND_TEXT, 1))
+        task = asyncio.create_task(ticket.acquire_async(100))
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert scheduler.queued["text"] == 0
+        holder.release()
+        assert scheduler.active == 0
+
+    asyncio.run(run())
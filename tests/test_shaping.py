@@ -0,0 +1,117 @@
+"""
+Link shaping and congestion: token buckets hold a link to its rate on a
+fake clock, and the congestion tracker only flips a link past its marks
+and after its hold down.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+import pytest
+import shaping
+from shaping import CongestionTracker, LinkShaper, TokenBucket
+
+
+class Clock:
+    """
+    Stands for the time module, sleeping moves the clock forward.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(shaping, "time", clock)
+    return clock
+
+
+def test_burst_goes_at_once_then_debt_waits(clock):
+    bucket = TokenBucket(rate=1000, burst=500)
+    assert bucket.reserve(500) == 0.0
+    assert bucket.reserve(250) == pytest.approx(0.25)
+    clock.now += 0.25
+    assert bucket.reserve(100) == pytest.approx(0.1)
+
+
+def test_tokens_refill_up_to_the_burst(clock):
+    bucket = TokenBucket(rate=1000, burst=500)
+    bucket.reserve(500)
+    clock.now += 10.0
+    assert bucket.reserve(500) == 0.0
+    assert bucket.reserve(1) > 0
+
+
+def test_default_burst():
+    assert TokenBucket(rate=1e6).burst == 131072
+    assert TokenBucket(rate=1e9).burst == 1e7
+
+
+def test_consume_holds_the_rate(clock):
+    bucket = TokenBucket(rate=1e6, burst=1e5)
+    for _ in range(1000):
+        bucket.consume(1000)
+    # The burst went at once, the rest at the rate of the link
+    assert clock.now == pytest.approx((1e6 - 1e5) / 1e6)
+    assert bucket.sent == 1e6
+
+
+def test_shaper_measures_utilization(clock):
+    shaper = LinkShaper({"B": 1000.0, "C": 1000.0})
+    assert shaper.bucket("D") is None
+    shaper.bucket("B").reserve(500)
+    clock.now += 1.0
+    assert shaper.utilization() == {
+        "B": pytest.approx(0.5), "C": 0.0}
+    clock.now += 1.0
+    assert shaper.utilization()["B"] == 0.0
+
+
+def test_congestion_needs_the_smoothed_level_past_the_high_mark():
+    tracker = CongestionTracker(smoothing=0.5, hold_down=0)
+    assert tracker.report("A", {"B": 0.0}, 0.0) == {}
+    # 0.5 then 0.75, then 0.875 above the high mark
+    assert tracker.report("A", {"B": 1.0}, 1.0) == {}
+    assert tracker.report("A", {"B": 1.0}, 2.0) == {}
+    assert tracker.report("A", {"B": 1.0}, 3.0) == {("A", "B"): 4.0}
+    assert tracker.multiplier("B", "A") == 4.0
+
+
+def test_congestion_clears_below_the_low_mark_only():
+    tracker = CongestionTracker(smoothing=1.0, hold_down=0)
+    tracker.report("B", {"A": 0.9}, 0.0)
+    assert tracker.report("A", {"B": 0.6}, 1.0) == {}
+    # The busier direction of the link counts
+    assert tracker.report("B", {"A": 0.6}, 2.0) == {}
+    tracker.report("A", {"B": 0.1}, 3.0)
+    assert tracker.report("B", {"A": 0.4}, 4.0) == {("A", "B"): 1.0}
+
+
+def test_congestion_holds_its_state_down():
+    tracker = CongestionTracker(smoothing=1.0, hold_down=5.0)
+    assert tracker.report("A", {"B": 0.9}, 0.0) == {("A", "B"): 4.0}
+    assert tracker.report("A", {"B": 0.0}, 4.0) == {}
+    assert tracker.multiplier("A", "B") == 4.0
+    assert tracker.report("A", {"B": 0.0}, 5.0) == {("A", "B"): 1.0}
+
+
+def test_forget_clears_the_links_of_a_router():
+    tracker = CongestionTracker(smoothing=1.0, hold_down=0)
+    tracker.report("A", {"B": 0.9, "C": 0.9}, 0.0)
+    tracker.forget("B")
+    assert tracker.multiplier("A", "B") == 1.0
+    assert tracker.multiplier("A", "C") == 4.0
+    assert ("A", "B") not in tracker.smoothed
+
+
+def test_marks_must_be_ordered():
+    with pytest.raises(ValueError):
+        CongestionTracker(high=0.5, low=0.8)
@@ -0,0 +1,44 @@
+"""
+The simulation on the NSFNET: its routers forward as real routers do, and
+fail over to their backups when a next router goes down.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+import io
+from contextlib import redirect_stdout
+from simulation import Simulation
+
+
+def start_simulation():
+    with redirect_stdout(io.StringIO()):
+        # The round trip of the refused connection counts as queueing, a
+        # megabyte of buffer would not cover it on these links
+        simulation = Simulation(backup_routes=True, buffer_bytes=2**30)
+        simulation.start()
+        simulation.run(until=0.5)
+    return simulation
+
+
+def test_routers_know_their_neighbors():
+    simulation = start_simulation()
+    for name, router in simulation.routers.items():
+        assert router.neighbors == set(router.links)
+        assert router.routes_version > 0
+        assert router.next_router(name) is None
+
+
+def test_messages_fail_over_around_a_down_router():
+    simulation = start_simulation()
+    router = simulation.routers["WA"]
+    # The backup of WA towards UT is TX, behind CA2, so the message is
+    # tunneled to TX
+    assert (router.next_hops["UT"], router.backups["UT"]) == ("CA1", "TX")
+    simulation.fail_router("CA1", simulation.now)
+    simulation.send("WA", "UT", 1000, at=simulation.now + 0.001)
+    with redirect_stdout(io.StringIO()):
+        simulation.run(until=simulation.now + 0.2)
+    assert "CA1" in router.unreachable
+    assert simulation.stats.failovers == 1
+    assert simulation.stats.delivered == 1
@@ -0,0 +1,157 @@
+"""
+The spool of messages for unreachable next hops, in memory and in segment
+files: frames come out as they went in and in order, full queues follow
+their policy, and messages past their time to live are dropped.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+import io
+import os
+import pytest
+import spool as spool_module
+from spool import Spool
+from protocol import KIND_TEXT, Header, ProtocolError
+
+
+class Clock:
+    """
+    Stands for the time module.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(spool_module, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "segments"])
+def make_spool(request, tmp_path):
+    spools = []
+
+    def make_spool(**options):
+        if request.param == "segments":
+            options.setdefault("directory", str(tmp_path / "spool"))
+            options.setdefault("segment_size", 4096)
+        spools.append(Spool(**options))
+        return spools[-1]
+
+    yield make_spool
+    for spool in spools:
+        spool.close()
+
+
+def hold(spool, next_hop, text):
+    payload = text.encode()
+    header = Header(KIND_TEXT, "alice", "A", "9002", "D", len(payload))
+    return spool.hold(next_hop, header, io.BytesIO(payload))
+
+
+def take(spool, next_hop):
+    message = spool.pop(next_hop)
+    if message is None:
+        return None
+    frame = bytes(spool.frame(message))
+    spool.release(message)
+    return frame[-message.header.payload_length:].decode()
+
+
+def test_messages_come_out_in_order(make_spool):
+    spool = make_spool()
+    for text in ("one", "two"):
+        assert hold(spool, "B", text)
+    assert hold(spool, "C", "three")
+    assert sorted(spool.next_hops()) == ["B", "C"]
+    message = spool.pop("B")
+    header = message.header
+    assert bytes(spool.frame(message)) == header.encode() + b"one"
+    spool.release(message)
+    assert [take(spool, "B"), take(spool, "B")] == ["two", None]
+    assert spool.next_hops() == ["C"]
+    assert spool.held.value(("B",)) == 2
+
+
+def test_restore_puts_the_message_back_first(make_spool):
+    spool = make_spool()
+    hold(spool, "B", "one")
+    hold(spool, "B", "two")
+    message = spool.pop("B")
+    spool.restore(message)
+    assert spool.depths()[0] == {("B",): 2}
+    assert [take(spool, "B"), take(spool, "B")] == ["one", "two"]
+
+
+def test_drop_newest_refuses_when_full(make_spool):
+    spool = make_spool(max_messages=2)
+    assert hold(spool, "B", "one") and hold(spool, "B", "two")
+    assert not hold(spool, "B", "three")
+    # The queue of another next hop has its own room
+    assert hold(spool, "C", "four")
+    assert spool.dropped.value(("full",)) == 1
+    assert [take(spool, "B"), take(spool, "B")] == ["one", "two"]
+
+
+def test_drop_oldest_makes_room(make_spool):
+    spool = make_spool(max_messages=2, policy="drop-oldest")
+    for text in ("one", "two", "three"):
+        assert hold(spool, "B", text)
+    assert spool.dropped.value(("evicted",)) == 1
+    assert [take(spool, "B"), take(spool, "B")] == ["two", "three"]
+
+
+def test_bytes_are_bounded(make_spool):
+    spool = make_spool(max_bytes=200)
+    assert hold(spool, "B", "x" * 100)
+    assert not hold(spool, "B", "x" * 100)
+    assert not hold(spool, "C", "x" * 300)
+
+
+def test_expired_messages_are_dropped(make_spool, clock):
+    spool = make_spool(ttl=30.0)
+    hold(spool, "B", "old")
+    clock.now = 20.0
+    hold(spool, "B", "new")
+    clock.now = 30.0
+    assert take(spool, "B") == "new"
+    assert spool.dropped.value(("expired",)) == 1
+
+
+def test_truncated_payload_gives_the_room_back(make_spool):
+    spool = make_spool(max_messages=1)
+    header = Header(KIND_TEXT, "alice", "A", "9002", "D", 10)
+    with pytest.raises(ProtocolError):
+        spool.hold("B", header, io.BytesIO(b"short"))
+    assert spool.depths() == ({}, {("B",): 0})
+    assert hold(spool, "B", "whole")
+
+
+def test_segments_are_reused_and_deleted(tmp_path):
+    directory = tmp_path / "spool"
+    directory.mkdir()
+    (directory / "00000042.segment").write_bytes(b"left over")
+    spool = Spool(directory=str(directory), segment_size=4096)
+    assert os.listdir(directory) == []
+    for _ in range(3):
+        hold(spool, "B", "x" * 1500)
+    # The third frame did not fit in the first segment
+    assert len(os.listdir(directory)) == 2
+    for _ in range(3):
+        take(spool, "B")
+    assert len(os.listdir(directory)) == 1
+    assert spool.segment.used == 0
+    spool.close()
+    assert os.listdir(directory) == []
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        Spool(policy="drop-random")
@@ -0,0 +1,47 @@
+"""
+Generated topologies: every router gets its own port, none of the ports
+of the controller or of the load generator's clients.
+
+Run from the repository root:
+
+    python -m pytest tests
+"""
+import pytest
+import networkx as nx
+from topology_generator import (
+    CLIENT_PORTS, CONTROLLER_PORT, FIRST_CLIENT_PORT, TOPOLOGIES,
+    generate_network, router_ports)
+
+
+def reserved(port):
+    return port == CONTROLLER_PORT or \
+        FIRST_CLIENT_PORT <= port < FIRST_CLIENT_PORT + CLIENT_PORTS
+
+
+@pytest.mark.parametrize("kind", sorted(TOPOLOGIES))
+def test_topologies_are_connected(kind):
+    network = generate_network(kind, 1000)
+    ports = list(network["Ports"].values())
+    assert len(set(ports)) == 1000
+    assert not any(reserved(port) for port in ports)
+    graph = nx.Graph(
+        (link["from"], link["to"]) for link in network["Links"])
+    assert graph.number_of_nodes() == 1000
+    assert nx.is_connected(graph)
+
+
+def test_ports_skip_the_reserved_ones():
+    ports = router_ports(20000)
+    assert len(set(ports)) == 20000
+    assert not any(reserved(port) for port in ports)
+    assert ports[887] == CONTROLLER_PORT + 1
+    assert max(ports) <= 65535
+
+
+def test_too_many_routers():
+    ports = router_ports(1, 65535)
+    assert ports == [65535]
+    with pytest.raises(ValueError):
+        router_ports(2, 65535)
+    with pytest.raises(ValueError):
+        router_ports(10, 80)
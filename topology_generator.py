@@ -0,0 +1,317 @@
+import os
+import json
+import math
+import itertools
+import argparse
+import numpy as np
+import networkx as nx
+
+# Longest link, about the width of the NSFNET
+SPAN_KM = 4000
+MIN_DISTANCE = 300
+MAX_DISTANCE = 5000
+FIRST_PORT = 8001
+# Ports routers never get: the controller's, and those of the virtual
+# clients of the load generator
+CONTROLLER_PORT = 8888
+FIRST_CLIENT_PORT = 20000
+CLIENT_PORTS = 10000
+# The Waxman links are computed a block of rows at a time
+WAXMAN_BLOCK = 1024
+
+
+def random_distances(rng, count):
+    """
+    Draws link distances in kilometers within the range of the NSFNET.
+    """
+    return rng.integers(MIN_DISTANCE, MAX_DISTANCE, count, endpoint=True)
+
+
+def connect_components(graph, rng, distance):
+    """
+    Links every component of a graph to the largest one, so every router
+    can reach every other.
+
+    Parameters
+    ----------
+        graph : NetworkX graph
+            the topology, changed in place
+        rng : numpy.random.Generator
+            the random generator
+        distance : callable
+            gives the distance of a link between two routers
+    """
+    components = sorted(nx.connected_components(graph), key=len, reverse=True)
+    main = list(components[0])
+    for component in components[1:]:
+        node = int(rng.choice(list(component)))
+        other = main[rng.integers(len(main))]
+        graph.add_edge(node, other, distance=distance(node, other))
+
+
+def random_topology(size, rng, degree=4):
+    """
+    Builds an Erdos-Renyi topology with the given mean degree.
+
+    Parameters
+    ----------
+        size : int
+            the number of routers
+        rng : numpy.random.Generator
+            the random generator
+        degree : int, optional
+            the mean number of links per router (default is 4)
+
+    Returns
+    -------
+        graph : NetworkX graph
+            the topology, with a 'distance' on every link
+    """
+    graph = nx.gnm_random_graph(
+        size, size * degree // 2, seed=int(rng.integers(2**32)))
+    for (first, second), distance in zip(
+            graph.edges, random_distances(rng, graph.number_of_edges())):
+        graph[first][second]["distance"] = int(distance)
+    connect_components(
+        graph, rng, lambda *_: int(random_distances(rng, 1)[0]))
+    return graph
+
+
+def grid_topology(size, rng, degree=4):
+    """
+    Builds a grid as square as possible, the last row holding what is left.
+
+    Parameters
+    ----------
+        size : int
+            the number of routers
+        rng : numpy.random.Generator
+            the random generator
+        degree : int, optional
+            unused, a grid has 4 links per inner router
+
+    Returns
+    -------
+        graph : NetworkX graph
+            the topology, with a 'distance' on every link
+    """
+    columns = math.ceil(math.sqrt(size))
+    graph = nx.Graph()
+    graph.add_nodes_from(range(size))
+    for node in range(size):
+        if (node + 1) % columns and node + 1 < size:
+            graph.add_edge(node, node + 1)
+        if node + columns < size:
+            graph.add_edge(node, node + columns)
+    for (first, second), distance in zip(
+            graph.edges, random_distances(rng, graph.number_of_edges())):
+        graph[first][second]["distance"] = int(distance)
+    return graph
+
+
+def waxman_topology(size, rng, degree=4, alpha=0.15):
+    """
+    Builds a Waxman topology: routers are placed at random on a square and
+    two routers are linked with a probability that decays exponentially
+    with their distance. The probabilities are scaled to the mean degree,
+    so the topology stays as sparse as real networks at any size.
+
+    Parameters
+    ----------
+        size : int
+            the number of routers
+        rng : numpy.random.Generator
+            the random generator
+        degree : int, optional
+            the mean number of links per router (default is 4)
+        alpha : float, optional
+            the decay of the probability with the distance, relative to
+            the side of the square (default is 0.15)
+
+    Returns
+    -------
+        graph : NetworkX graph
+            the topology, with a 'distance' on every link
+    """
+    positions = rng.random((size, 2)).astype(np.float32)
+    decay = alpha * math.sqrt(2)
+
+    def lengths(rows, start):
+        return np.sqrt(((positions[rows, None, :]
+                         - positions[None, start:, :]) ** 2).sum(axis=2))
+
+    # The mean degree of a sample of routers gives the scale of the
+    # probabilities, without going through every pair twice
+    sample = rng.choice(size, min(size, WAXMAN_BLOCK), replace=False)
+    weight = (np.exp(-lengths(sample, 0) / decay).sum(axis=1) - 1).mean()
+    beta = min(1.0, degree / weight) if weight else 1.0
+
+    graph = nx.Graph()
+    graph.add_nodes_from(range(size))
+    for start in range(0, size, WAXMAN_BLOCK):
+        rows = np.arange(start, min(start + WAXMAN_BLOCK, size))
+        # Only the routers after the row, so each pair is drawn once
+        block = lengths(rows, start)
+        drawn = rng.random(block.shape, np.float32) < \
+            beta * np.exp(-block / decay)
+        drawn &= rows[:, None] < np.arange(start, size)[None, :]
+        for row, column in zip(*np.nonzero(drawn)):
+            graph.add_edge(int(rows[row]), start + int(column), distance=max(
+                1, round(float(block[row, column]) * SPAN_KM)))
+
+    def distance(first, second):
+        length = np.sqrt(((positions[first] - positions[second]) ** 2).sum())
+        return max(1, round(length * SPAN_KM))
+
+    connect_components(graph, rng, distance)
+    return graph
+
+
+def scale_free_topology(size, rng, degree=4):
+    """
+    Builds a Barabasi-Albert topology, where new routers link preferably to
+    routers that already have many links.
+
+    Parameters
+    ----------
+        size : int
+            the number of routers
+        rng : numpy.random.Generator
+            the random generator
+        degree : int, optional
+            the mean number of links per router (default is 4)
+
+    Returns
+    -------
+        graph : NetworkX graph
+            the topology, with a 'distance' on every link
+    """
+    graph = nx.barabasi_albert_graph(
+        size, max(1, min(degree // 2, size - 1)),
+        seed=int(rng.integers(2**32)))
+    for (first, second), distance in zip(
+            graph.edges, random_distances(rng, graph.number_of_edges())):
+        graph[first][second]["distance"] = int(distance)
+    return graph
+
+
+TOPOLOGIES = {
+    "random": random_topology,
+    "grid": grid_topology,
+    "waxman": waxman_topology,
+    "scale_free": scale_free_topology,
+}
+
+
+def generate_network(kind, size, seed=0, degree=4, first_port=FIRST_PORT):
+    """
+    Generates a topology in the format of network.json.
+
+    Parameters
+    ----------
+        kind : str
+            'random', 'grid', 'waxman' or 'scale_free'
+        size : int
+            the number of routers
+        seed : int, optional
+            the seed of the random generator (default is 0)
+        degree : int, optional
+            the mean number of links per router (default is 4)
+        first_port : int, optional
+            the port of the first router, the others follow skipping the
+            ports of the controller and of the load generator's clients
+            (default is 8001)
+
+    Returns
+    -------
+        network : dict
+            the Nodes, Ports and Links of the topology, routers named R1
+            to RN
+    """
+    if kind not in TOPOLOGIES:
+        raise ValueError(
+            f"Unknown topology {kind!r}, use one of "
+            f"{', '.join(sorted(TOPOLOGIES))}.")
+    if size < 2:
+        raise ValueError("A topology needs at least 2 routers.")
+    ports = router_ports(size, first_port)
+    graph = TOPOLOGIES[kind](size, np.random.default_rng(seed), degree)
+    names = [f"R{node + 1}" for node in range(size)]
+    return {
+        "Nodes": {name: node + 1 for node, name in enumerate(names)},
+        "Ports": dict(zip(names, ports)),
+        "Links": [
+            {"from": first + 1, "to": second + 1, "distance": distance}
+            for first, second, distance in graph.edges(data="distance")
+        ],
+    }
+
+
+def router_ports(size, first_port=FIRST_PORT):
+    """
+    Picks the ports of the routers from first_port on, skipping the port of
+    the controller and those of the load generator's clients.
+
+    Parameters
+    ----------
+        size : int
+            the number of routers
+        first_port : int, optional
+            the port of the first router (default is 8001)
+
+    Returns
+    -------
+        ports : list
+            the port of every router
+    """
+    last_client_port = FIRST_CLIENT_PORT + CLIENT_PORTS
+    candidates = itertools.chain(
+        range(first_port, FIRST_CLIENT_PORT),
+        range(max(first_port, last_client_port), 65536))
+    ports = list(itertools.islice(
+        (port for port in candidates if port != CONTROLLER_PORT), size))
+    if first_port < 1024 or len(ports) < size:
+        raise ValueError(
+            f"{size} routers do not fit in the ports from {first_port}, "
+            f"without {CONTROLLER_PORT} and {FIRST_CLIENT_PORT} to "
+            f"{last_client_port - 1}.")
+    return ports
+
+
+def write_network(network, filename):
+    """
+    Writes a topology as network.json, replacing the file at once.
+
+    Parameters
+    ----------
+        network : dict
+            the topology, as generate_network returns it
+        filename : str
+            the name of the file
+    """
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, 'w', encoding='utf-8-sig') as file:
+        json.dump(network, file, indent=4)
+    os.replace(temp_filename, filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic network.json.")
+    parser.add_argument("kind", choices=sorted(TOPOLOGIES))
+    parser.add_argument("size", type=int, help="number of routers")
+    parser.add_argument(
+        "--output", required=True, help="file to write the topology to")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--degree", type=int, default=4, help="mean links per router")
+    parser.add_argument(
+        "--first-port", type=int, default=FIRST_PORT,
+        help="port of the first router")
+    args = parser.parse_args()
+
+    network = generate_network(
+        args.kind, args.size, args.seed, args.degree, args.first_port)
+    write_network(network, args.output)
+    print(f"Wrote {args.kind} topology of {args.size} routers and "
+          f"{len(network['Links'])} links to {args.output}")